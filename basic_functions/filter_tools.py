@@ -0,0 +1,531 @@
+import os
+import math
+import warnings
+import multiprocessing
+import numpy as np
+from scipy import ndimage
+from osgeo import gdal, gdal_array
+
+from basic_functions.pool_tools import bounded_imap
+
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    # NumPy < 1.20
+    from numpy.lib.stride_tricks import as_strided
+
+    def sliding_window_view(array, window_shape):
+        shape = (array.shape[0] - window_shape[0] + 1, array.shape[1] - window_shape[1] + 1) + tuple(window_shape)
+        return as_strided(array, shape=shape, strides=array.strides * 2, writeable=False)
+
+
+"""
+------
+NOTES:
+------
+All filters work on square windows of odd size. Arrays are processed tile by tile: each tile is extended by a halo of
+window // 2 pixels, taken from the neighbouring pixels or, at the array borders, created according to the edge mode.
+This way, the temporary memory only depends on the tile size, not on the array size.
+
+The cost per pixel of the filters in FILTER_MODES does not grow with the window area: mean, sum and std use summed-area
+tables, min and max the separable van Herk/Gil-Werman algorithm and median (for integer data) a running histogram.
+"""
+
+FILTER_MODES = ('mean', 'median', 'min', 'max', 'sum', 'std')
+
+# tile size for the kernels whose cost and memory do not depend on the window size (a multiple of the output block size
+# of filter_raster)
+BOX_TILE_SIZE = 1024
+
+# running histogram medians are used for integer data with windows of at least this size and a value range below
+# this number of histogram bins, otherwise scipy.ndimage.median_filter
+MIN_HISTOGRAM_WINDOW = 7
+MAX_HISTOGRAM_BINS = 4096
+
+# functions for which moving_window uses the specialized kernels of filter_array
+FUNCTION_MODES = {np.nanmean: 'mean',
+                  np.nanmedian: 'median',
+                  np.nanmin: 'min',
+                  np.nanmax: 'max',
+                  np.nanstd: 'std'}
+
+# output block size of filter_raster
+BLOCK_SIZE = 256
+
+# edge modes (as named by scipy.ndimage) and their numpy.pad equivalents
+EDGE_MODES = {'nearest': 'edge',
+              'reflect': 'symmetric',
+              'mirror': 'reflect',
+              'constant': 'constant'}
+
+
+def _check_window(array, window, edge_mode):
+    # type: (np.ndarray, int, str) -> None
+    if array.ndim != 2:
+        raise ValueError('Input array must be 2-dimensional!')
+    if window < 1 or window % 2 == 0:
+        raise ValueError('Window size must be odd!')
+    if edge_mode not in EDGE_MODES:
+        raise ValueError('Edge mode {e} not supported! Must be one of: {m}'.format(
+            e=edge_mode, m=', '.join(sorted(EDGE_MODES))))
+
+
+def _tiles(rows, cols, tile_size):
+    # type: (int, int, int) -> iter
+    """
+    Iterate over the tiles (first row, last row + 1, first column, last column + 1) of an array
+    """
+    for r in range(0, rows, tile_size):
+        for c in range(0, cols, tile_size):
+            yield r, min(r + tile_size, rows), c, min(c + tile_size, cols)
+
+
+def _padded_tile(array, tile, halo, edge_mode='nearest', cval=0):
+    # type: (np.ndarray, tuple, int, str, float) -> np.ndarray
+    """
+    Extract a tile with a halo of neighbouring pixels. Where the halo exceeds the array, it is created according to the
+    edge mode.
+
+    :param array: Input array
+    :param tile: Tile as (first row, last row + 1, first column, last column + 1)
+    :param halo: Width of the halo
+    :param edge_mode: One of: nearest (repeat edge pixels), reflect (mirror including the edge pixels), mirror (mirror
+        excluding the edge pixels), constant (fill with cval)
+    :param cval: Fill value for edge mode "constant"
+    :return: Array of shape (tile rows + 2 * halo, tile columns + 2 * halo)
+    """
+    top, bottom, left, right = _halo_bounds(tile, halo, array.shape[0], array.shape[1])
+    return _pad_halo(array[top:bottom, left:right], tile, halo, (top, bottom, left, right), edge_mode, cval)
+
+
+def _halo_bounds(tile, halo, rows, cols):
+    # type: (tuple, int, int, int) -> tuple
+    """
+    Bounds (first row, last row + 1, first column, last column + 1) of a tile plus halo, clipped to the array
+    """
+    r0, r1, c0, c1 = tile
+    return max(r0 - halo, 0), min(r1 + halo, rows), max(c0 - halo, 0), min(c1 + halo, cols)
+
+
+def _pad_halo(data, tile, halo, bounds, edge_mode='nearest', cval=0):
+    # type: (np.ndarray, tuple, int, tuple, str, float) -> np.ndarray
+    """
+    Complete the halo of a tile, which was read within the clipped bounds, according to the edge mode
+    """
+    r0, r1, c0, c1 = tile
+    top, bottom, left, right = bounds
+    pad = ((halo - (r0 - top), halo - (bottom - r1)), (halo - (c0 - left), halo - (right - c1)))
+    if any(p for side in pad for p in side):
+        if edge_mode == 'constant':
+            data = np.pad(data, pad, 'constant', constant_values=cval)
+        else:
+            data = np.pad(data, pad, EDGE_MODES[edge_mode])
+    return data
+
+
+def _box_sum(data, window):
+    # type: (np.ndarray, int) -> np.ndarray
+    """
+    Sum of all windows of a padded tile via a summed-area table (integral image): each window sum is taken from four
+    table values, so the cost per pixel does not depend on the window size.
+
+    :param data: Padded tile (float64)
+    :param window: Window size
+    :return: Window sums, of shape (tile rows, tile columns)
+    """
+    table = np.zeros((data.shape[0] + 1, data.shape[1] + 1), dtype=np.float64)
+    np.cumsum(data, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table[window:, window:] - table[:-window, window:] - table[window:, :-window] + table[:-window, :-window]
+
+
+def _running_extreme(data, window, axis, mode):
+    # type: (np.ndarray, int, int, str) -> np.ndarray
+    """
+    Minimum or maximum of all windows along one axis with the van Herk/Gil-Werman algorithm: the axis is split into
+    blocks of the window size, and each window is combined from the suffix extreme of one block and the prefix extreme
+    of the next one. This needs three comparisons per pixel, independent of the window size.
+
+    :param data: Padded tile
+    :param window: Window size
+    :param axis: Axis along which to filter
+    :param mode: "min" or "max"
+    :return: Array which is shorter by window - 1 along the axis
+    """
+    ufunc = np.minimum if mode == 'min' else np.maximum
+    if data.dtype.kind == 'f':
+        fill = np.inf if mode == 'min' else -np.inf
+    elif data.dtype.kind == 'b':
+        fill = mode == 'min'
+    else:
+        fill = np.iinfo(data.dtype).max if mode == 'min' else np.iinfo(data.dtype).min
+    data = np.moveaxis(data, axis, -1)
+    n = data.shape[-1]
+    blocks = -(-n // window)
+    padded = np.full(data.shape[:-1] + (blocks * window, ), fill, dtype=data.dtype)
+    padded[..., :n] = data
+    padded = padded.reshape(data.shape[:-1] + (blocks, window))
+    prefix = ufunc.accumulate(padded, axis=-1).reshape(data.shape[:-1] + (blocks * window, ))
+    suffix = ufunc.accumulate(padded[..., ::-1], axis=-1)[..., ::-1].reshape(data.shape[:-1] + (blocks * window, ))
+    result = ufunc(suffix[..., :n - window + 1], prefix[..., window - 1:n])
+    return np.moveaxis(result, -1, axis)
+
+
+def _huang_median(data, window):
+    # type: (np.ndarray, int) -> np.ndarray
+    """
+    Median of all windows of a padded integer tile with Huang's running histogram. All rows of the tile are processed
+    at once: while the window slides along the columns, the leaving column is removed from and the entering column is
+    added to the histogram of each row, and the median pointer of each row is moved until the count of values below it
+    is right again.
+
+    :param data: Padded tile (non-negative integer values)
+    :param window: Window size
+    :return: Window medians, of shape (tile rows, tile columns)
+    """
+    halo = window // 2
+    rows = data.shape[0] - 2 * halo
+    cols = data.shape[1] - 2 * halo
+    bins = int(data.max()) + 1
+    half = window ** 2 // 2
+    # the histograms of all rows are stored in one flat array, row after row
+    offset = (np.arange(rows) * bins)[:, np.newaxis, np.newaxis]
+    histogram = np.zeros(rows * bins, dtype=np.intp)
+    np.add.at(histogram, (sliding_window_view(data[:, :window], (window, window))[:, 0] + offset).ravel(), 1)
+    histogram = histogram.reshape(rows, bins)
+    offset = offset[..., 0]
+    # start with the median of the first window and the number of values below it
+    cumulative = np.cumsum(histogram, axis=1)
+    median = np.argmax(cumulative > half, axis=1)
+    below = cumulative[np.arange(rows), median] - histogram[np.arange(rows), median]
+    out = np.empty((rows, cols), dtype=np.intp)
+    out[:, 0] = median
+    flat = histogram.ravel()
+    index = np.arange(rows)
+    for c in range(1, cols):
+        # the values of the leaving and the entering column, for all windows along the rows: shape (rows, window)
+        leaving = sliding_window_view(data[:, c - 1], window)
+        entering = sliding_window_view(data[:, c + window - 1], window)
+        np.add.at(flat, (leaving + offset).ravel(), -1)
+        np.add.at(flat, (entering + offset).ravel(), 1)
+        below -= (leaving < median[:, np.newaxis]).sum(axis=1)
+        below += (entering < median[:, np.newaxis]).sum(axis=1)
+        # move the median pointer down, as long as more than half of the values are below it
+        move = np.flatnonzero(below > half)
+        while move.size:
+            median[move] -= 1
+            below[move] -= histogram[move, median[move]]
+            move = move[below[move] > half]
+        # move the median pointer up, as long as not more than half of the values are below or at it
+        move = np.flatnonzero(below + histogram[index, median] <= half)
+        while move.size:
+            below[move] += histogram[move, median[move]]
+            median[move] += 1
+            move = move[below[move] + histogram[move, median[move]] <= half]
+        out[:, c] = median
+    return out
+
+
+def _filter_tile(data, window, mode):
+    # type: (np.ndarray, int, str) -> np.ndarray
+    """
+    Filter a padded tile and return its inner part (without halo). NaN values are ignored; windows without any valid
+    value become NaN.
+    """
+    halo = window // 2
+    inner = (slice(halo, data.shape[0] - halo), slice(halo, data.shape[1] - halo))
+    invalid = np.isnan(data) if data.dtype.kind == 'f' else None
+    if mode in ('mean', 'sum', 'std'):
+        data = data.astype(np.float64)
+        if invalid is not None and invalid.any():
+            valid = ~invalid
+            data = np.where(valid, data, 0.)
+            count = _box_sum(valid.astype(np.float64), window)
+        else:
+            valid = None
+            count = np.full((data.shape[0] - 2 * halo, data.shape[1] - 2 * halo), float(window ** 2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if mode == 'sum':
+                result = _box_sum(data, window)
+            elif mode == 'mean':
+                result = _box_sum(data, window) / count
+            else:
+                # shift the values by their mean for numerical stability, the variance does not change
+                shift = data[valid].mean() if valid is not None else data.mean()
+                shifted = np.where(valid, data - shift, 0.) if valid is not None else data - shift
+                total = _box_sum(shifted, window)
+                squares = _box_sum(shifted ** 2, window)
+                result = np.sqrt(np.maximum(squares / count - (total / count) ** 2, 0.))
+        result[count == 0] = np.nan
+        return result
+    if mode in ('min', 'max'):
+        if invalid is not None and invalid.any():
+            data = np.where(invalid, np.inf if mode == 'min' else -np.inf, data)
+        else:
+            invalid = None
+        # the filter is separable: rows first, then columns
+        result = _running_extreme(_running_extreme(data, window, 1, mode), window, 0, mode)
+        if invalid is not None:
+            result[np.isinf(result)] = np.nan
+        return result
+    if mode == 'median':
+        if invalid is None:
+            if data.dtype.kind in 'iub' and window >= MIN_HISTOGRAM_WINDOW:
+                low = int(data.min())
+                if int(data.max()) - low < MAX_HISTOGRAM_BINS:
+                    return (_huang_median(data.astype(np.intp) - low, window) + low).astype(data.dtype)
+            return ndimage.median_filter(data, window)[inner]
+        if not invalid.any():
+            return ndimage.median_filter(data, window)[inner]
+        # the window stack is processed in chunks of rows to keep it at about 16 million values
+        stack = sliding_window_view(data, (window, window))
+        step = max(1, 2 ** 24 // (stack.shape[1] * window ** 2))
+        result = np.empty(stack.shape[:2], dtype=data.dtype)
+        with warnings.catch_warnings():
+            # windows without any valid value
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for r in range(0, stack.shape[0], step):
+                result[r:r + step] = np.nanmedian(stack[r:r + step], axis=(-2, -1))
+        return result
+    raise ValueError('Mode {m} not supported! Must be one of: {f}'.format(m=mode, f=', '.join(FILTER_MODES)))
+
+
+def _default_tile_size(window):
+    # type: (int) -> int
+    """
+    Tile size for which the window stack of a tile (tile pixels * window²) stays at about 16 million values
+    """
+    return max(16, int(math.sqrt(2 ** 24 / float(window ** 2))))
+
+
+def filter_array(array, window, mode='mean', edge_mode='nearest', cval=0, tile_size=None):
+    # type: (np.ndarray, int, str, str, float, int) -> np.ndarray
+    """
+    Apply a moving window filter to a 2D array. The output has the same size as the input. NaN values are ignored.
+
+    :param array: Input array (must be 2D)
+    :param window: Window size. Must be odd!
+    :param mode: Statistic to calculate within the window. One of: mean, median, min, max, sum, std
+    :param edge_mode: How to extend the array at its borders. One of: nearest (repeat edge pixels; default), reflect
+        (mirror including the edge pixels), mirror (mirror excluding the edge pixels), constant (fill with cval)
+    :param cval: Fill value for edge mode "constant"
+    :param tile_size: Size of the tiles which are processed one after the other. Defaults to BOX_TILE_SIZE.
+    :return: Filtered array. Float64 for mean, sum and std, otherwise the input data type.
+    """
+    _check_window(array, window, edge_mode)
+    if mode not in FILTER_MODES:
+        raise ValueError('Mode {m} not supported! Must be one of: {f}'.format(m=mode, f=', '.join(FILTER_MODES)))
+    if not tile_size:
+        tile_size = BOX_TILE_SIZE
+    if mode in ('mean', 'sum', 'std'):
+        dtype = np.float64
+    else:
+        dtype = array.dtype
+    out = np.empty(array.shape, dtype=dtype)
+    for tile in _tiles(array.shape[0], array.shape[1], tile_size):
+        data = _padded_tile(array, tile, window // 2, edge_mode, cval)
+        out[tile[0]:tile[1], tile[2]:tile[3]] = _filter_tile(data, window, mode)
+    return out
+
+
+def moving_window(array, window, function, edge_mode='nearest', cval=0, tile_size=None, **kwargs):
+    # type: (np.ndarray, int, callable, str, float, int, any) -> np.ndarray
+    """
+    Apply any function to the moving window of each pixel. The function is called with a read-only view of all windows
+    of a tile, of shape (rows, columns, window, window), and must reduce the last two axes, e.g. numpy.nanmean. The
+    functions in FUNCTION_MODES are delegated to filter_array, if called without additional arguments.
+
+    :param array: Input array (must be 2D)
+    :param window: Window size. Must be odd!
+    :param function: Function to apply, called as function(windows, axis=(-2, -1), **kwargs)
+    :param edge_mode: How to extend the array at its borders. One of: nearest (repeat edge pixels; default), reflect
+        (mirror including the edge pixels), mirror (mirror excluding the edge pixels), constant (fill with cval)
+    :param cval: Fill value for edge mode "constant"
+    :param tile_size: Size of the tiles which are processed one after the other. Defaults to a size that keeps the
+        window stack of each tile at about 16 million values.
+    :param kwargs: Additional keyword arguments passed to the function
+    :return: Filtered array (float64)
+    """
+    _check_window(array, window, edge_mode)
+    if not kwargs and FUNCTION_MODES.get(function):
+        return filter_array(array, window, FUNCTION_MODES[function], edge_mode, cval, tile_size).astype(np.float64)
+    if not tile_size:
+        tile_size = _default_tile_size(window)
+    out = np.empty(array.shape, dtype=np.float64)
+    for tile in _tiles(array.shape[0], array.shape[1], tile_size):
+        data = _padded_tile(array, tile, window // 2, edge_mode, cval)
+        out[tile[0]:tile[1], tile[2]:tile[3]] = function(sliding_window_view(data, (window, window)), axis=(-2, -1),
+                                                         **kwargs)
+    return out
+
+
+_RASTER = {}
+
+
+def _init_worker(image, window, mode, edge_mode, cval):
+    _RASTER['ds'] = gdal.Open(image, gdal.GA_ReadOnly)
+    _RASTER['window'] = window
+    _RASTER['mode'] = mode
+    _RASTER['edge_mode'] = edge_mode
+    _RASTER['cval'] = cval
+
+
+def _tile_stats(values):
+    # type: (np.ndarray) -> tuple
+    """
+    Statistics of the valid values of a tile as (count, mean, sum of squared deviations, minimum, maximum)
+    """
+    if values.size == 0:
+        return 0, 0., 0., np.inf, -np.inf
+    values = values.astype(np.float64)
+    mean = values.mean()
+    return values.size, mean, ((values - mean) ** 2).sum(), values.min(), values.max()
+
+
+def _merge_stats(a, b):
+    # type: (tuple, tuple) -> tuple
+    """
+    Merge the statistics of two tiles (see _tile_stats) with the pairwise update of Chan et al.
+    """
+    count = a[0] + b[0]
+    if count == 0:
+        return a
+    delta = b[1] - a[1]
+    mean = a[1] + delta * b[0] / float(count)
+    m2 = a[2] + b[2] + delta ** 2 * a[0] * b[0] / float(count)
+    return count, mean, m2, min(a[3], b[3]), max(a[4], b[4])
+
+
+def _filter_raster_tile(args):
+    """
+    Read one tile of one band with its halo, filter it and calculate its statistics (worker of filter_raster)
+
+    :param args: Tuple of (band index in the output, band number in the input, tile, NoData value, output data type)
+    :return: Tuple of (band index in the output, tile, filtered array, statistics)
+    """
+    index, band, tile, no_data, np_dtype = args
+    ds = _RASTER['ds']
+    window = _RASTER['window']
+    halo = window // 2
+    bounds = _halo_bounds(tile, halo, ds.RasterYSize, ds.RasterXSize)
+    top, bottom, left, right = bounds
+    data = ds.GetRasterBand(band).ReadAsArray(left, top, right - left, bottom - top)
+    # NoData becomes NaN, so that it is ignored by the filters
+    if no_data is not None:
+        invalid = data == no_data
+        if invalid.any():
+            data = np.where(invalid, np.nan, data.astype(np.float64))
+    data = _pad_halo(data, tile, halo, bounds, _RASTER['edge_mode'], _RASTER['cval'])
+    result = _filter_tile(data, window, _RASTER['mode'])
+    # NoData pixels stay NoData
+    r0, r1, c0, c1 = tile
+    if data.dtype.kind == 'f':
+        missing = np.isnan(result) | np.isnan(data[halo:halo + r1 - r0, halo:halo + c1 - c0])
+    else:
+        missing = np.zeros(result.shape, dtype=bool)
+    if np.dtype(np_dtype).kind in 'iub' and result.dtype.kind == 'f':
+        result = np.rint(result)
+    if no_data is not None:
+        result[missing] = no_data
+    result = result.astype(np_dtype)
+    return index, tile, result, _tile_stats(result[~missing])
+
+
+def filter_raster(image, output, window, mode='mean', bands=None, edge_mode='nearest', cval=0, no_data=None,
+                  of='GTiff', co=None, tile_size=None, processes=None, overwrite=True):
+    # type: (str, str, int, str, list, str, float, float, str, list, int, int, bool) -> None
+    """
+    Apply a moving window filter to a raster, tile by tile. Each tile is read with a halo of window // 2 pixels, so the
+    output has the same size as the input and there are no artefacts at tile borders. Tiles of all bands are filtered
+    in parallel by a pool of processes, while the main process writes them to a tiled output. Band statistics are
+    accumulated during the writing, so that no second pass over the output is necessary.
+
+    :param image: Input raster
+    :param output: Output raster. Has the data type of the input raster, except for mean, sum and std of integer
+        rasters, which are written as Float32 (Float64 for 32 bit integers) to avoid rounding and overflows.
+    :param window: Window size. Must be odd!
+    :param mode: Statistic to calculate within the window. One of: mean, median, min, max, sum, std
+    :param bands: Bands of the input to filter (counting starts at 1). Defaults to all bands.
+    :param edge_mode: How to extend the raster at its borders. One of: nearest (repeat edge pixels; default), reflect
+        (mirror including the edge pixels), mirror (mirror excluding the edge pixels), constant (fill with cval)
+    :param cval: Fill value for edge mode "constant"
+    :param no_data: NoData value of the input and the output. Defaults to the NoData value of each input band. NoData
+        pixels are ignored by the filter and stay NoData, windows without any valid pixel become NoData.
+    :param of: The desired format of the output file as provided by the GDAL raster formats
+            (see: http://www.gdal.org/formats_list.html).
+    :param co: Advanced raster creation options such as band interleave or compression. For GTiff, TILED=YES is
+        added, if no tiling is specified.
+    :param tile_size: Size of the tiles. Defaults to BOX_TILE_SIZE.
+    :param processes: Number of processes. Defaults to the number of CPUs.
+    :param overwrite: Overwrite output file, if it already exists.
+    :return: None
+    """
+    if mode not in FILTER_MODES:
+        raise ValueError('Mode {m} not supported! Must be one of: {f}'.format(m=mode, f=', '.join(FILTER_MODES)))
+    if window < 1 or window % 2 == 0:
+        raise ValueError('Window size must be odd!')
+    if edge_mode not in EDGE_MODES:
+        raise ValueError('Edge mode {e} not supported! Must be one of: {m}'.format(
+            e=edge_mode, m=', '.join(sorted(EDGE_MODES))))
+    if os.path.exists(output) and overwrite is False:
+        raise ValueError('Output file {f} already exists and shall not be overwritten! Please '
+                         'choose another name or delete it first!'.format(f=output))
+    ds = gdal.Open(image, gdal.GA_ReadOnly)
+    if ds is None:
+        raise IOError('Could not open {i}'.format(i=image))
+    cols = ds.RasterXSize
+    rows = ds.RasterYSize
+    if bands is None:
+        bands = range(1, ds.RasterCount + 1)
+    bands = [int(b) for b in bands]
+    dtype = ds.GetRasterBand(bands[0]).DataType
+    np_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dtype)
+    if mode in ('mean', 'sum', 'std') and np.dtype(np_dtype).kind in 'iub':
+        np_dtype = np.float64 if np.dtype(np_dtype).itemsize >= 4 else np.float32
+        dtype = gdal_array.NumericTypeCodeToGDALTypeCode(np_dtype)
+    if no_data is None:
+        nodata = [ds.GetRasterBand(b).GetNoDataValue() for b in bands]
+    else:
+        nodata = [no_data] * len(bands)
+    co = list(co) if co else []
+    if of.lower() == 'gtiff' and not any(c.lower().startswith('tiled') for c in co):
+        co += ['TILED=YES', 'BLOCKXSIZE={b}'.format(b=BLOCK_SIZE), 'BLOCKYSIZE={b}'.format(b=BLOCK_SIZE)]
+    drv = gdal.GetDriverByName(of)
+    if os.path.exists(output):
+        drv.Delete(output)
+    out_ds = drv.Create(output, cols, rows, len(bands), dtype, co)
+    if out_ds is None:
+        raise IOError('Could not create {o}'.format(o=output))
+    out_ds.SetGeoTransform(ds.GetGeoTransform())
+    out_ds.SetProjection(ds.GetProjection())
+    for i, band in enumerate(bands):
+        out_band = out_ds.GetRasterBand(i + 1)
+        out_band.SetDescription(ds.GetRasterBand(band).GetDescription())
+        if nodata[i] is not None:
+            out_band.SetNoDataValue(nodata[i])
+    ds = None
+    if not tile_size:
+        tile_size = BOX_TILE_SIZE
+    tasks = [(i, band, tile, nodata[i], np_dtype) for tile in _tiles(rows, cols, tile_size)
+             for i, band in enumerate(bands)]
+    initargs = (image, window, mode, edge_mode, cval)
+    if processes == 1:
+        _init_worker(*initargs)
+        pool = None
+        results = map(_filter_raster_tile, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=initargs)
+        results = bounded_imap(pool, _filter_raster_tile, tasks, 2 * (processes or multiprocessing.cpu_count()))
+    stats = [_tile_stats(np.empty(0))] * len(bands)
+    for i, tile, result, tile_stats in results:
+        out_ds.GetRasterBand(i + 1).WriteArray(result, tile[2], tile[0])
+        stats[i] = _merge_stats(stats[i], tile_stats)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for i in range(len(bands)):
+        count, mean, m2, minimum, maximum = stats[i]
+        if count:
+            out_ds.GetRasterBand(i + 1).SetStatistics(float(minimum), float(maximum), float(mean),
+                                                      float(np.sqrt(m2 / count)))
+    out_ds = None
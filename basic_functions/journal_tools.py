@@ -0,0 +1,90 @@
+import os
+import json
+import numpy as np
+
+
+"""
+------
+NOTES:
+------
+Long running tools which update a vector layer chunk by chunk record the FIDs already processed in a journal (JSON),
+so that an interrupted run can be resumed. The FIDs are stored as ranges [first, last] of consecutive FIDs. A chunk may
+only be journaled after its features have been flushed to disk with sync_layer().
+"""
+
+
+def fid_ranges(fids):
+    # type: (np.ndarray) -> list
+    """
+    Compress FIDs into a list of ranges [first, last] of consecutive FIDs
+    """
+    fids = np.unique(fids)
+    if fids.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(fids) != 1)
+    firsts = np.concatenate(([fids[0]], fids[breaks + 1]))
+    lasts = np.concatenate((fids[breaks], [fids[-1]]))
+    return [[int(f), int(l)] for f, l in zip(firsts, lasts)]
+
+
+def in_ranges(fids, ranges):
+    # type: (np.ndarray, list) -> np.ndarray
+    """
+    Get a mask of all FIDs within the given ranges [first, last]
+
+    :param fids: FIDs
+    :param ranges: List of ranges [first, last], in any order
+    :return: Boolean array of the shape of fids
+    """
+    fids = np.asarray(fids, dtype=np.int64)
+    if len(ranges) == 0:
+        return np.zeros(fids.shape, dtype=bool)
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    ranges = ranges[np.argsort(ranges[:, 0], kind='mergesort')]
+    # highest last FID of all ranges starting at or before each range
+    lasts = np.maximum.accumulate(ranges[:, 1])
+    index = np.searchsorted(ranges[:, 0], fids, side='right') - 1
+    return (index >= 0) & (fids <= lasts[np.maximum(index, 0)])
+
+
+def read_journal(journal):
+    # type: (str) -> dict
+    """
+    Read a journal written by write_journal()
+    """
+    with open(journal, 'r') as f:
+        return json.load(f)
+
+
+def write_journal(journal, content):
+    # type: (str, dict) -> bool
+    """
+    Write the journal atomically, so that a crash never leaves a broken journal
+
+    :param journal: Journal file
+    :param content: JSON serializable content
+    :return: True
+    """
+    temp = journal + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(content, f)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(journal):
+        os.remove(journal)
+    os.rename(temp, journal)
+    return True
+
+
+def sync_layer(lyr):
+    # type: (ogr.Layer) -> bool
+    """
+    Flush all pending changes of a layer to disk. Committing a transaction is not enough for formats without
+    transactions (e.g. ESRI Shapefile).
+
+    :param lyr: Layer
+    :return: True
+    """
+    if lyr.SyncToDisk() != 0:
+        raise IOError('Could not flush layer {n} to disk!'.format(n=lyr.GetName()))
+    return True
@@ -0,0 +1,24 @@
+import multiprocessing
+from collections import deque
+
+
+def bounded_imap(pool, func, tasks, max_pending):
+    # type: (multiprocessing.Pool, callable, iter, int) -> iter
+    """
+    Like pool.imap(), but with at most "max_pending" tasks submitted and not yet consumed. pool.imap() pulls the whole
+    task generator into its queue at once and buffers all finished results, so memory would grow with the input size.
+
+    :param pool: Process (or thread) pool
+    :param func: Function to apply
+    :param tasks: Iterable of arguments
+    :param max_pending: Maximum number of tasks in flight
+    :return: Generator of results, in the order of the tasks
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task, )))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
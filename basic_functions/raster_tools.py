@@ -13,6 +13,7 @@ from skimage.filters import rank
 from skimage.segmentation import felzenszwalb
 
 from basic_functions.call_cmd import run_cmd
+from basic_functions import zonal_tools
 import vector_tools
 
 
@@ -903,54 +904,95 @@ def remove_small_areas(array, min_size):
     return out
 
 
-def zonal_statistics(image, vector, no_data=None, mode='med', id_column=None, col_name='DN', col_width=10, col_precision=4, outfile=None, overwrite=False):
-    # type: (str, str, int or float, str, str, str, int, int, str, bool) -> None
+def zonal_statistics(image, vector, no_data=None, mode='med', id_column=None, col_name='DN', col_width=10,
+                     col_precision=4, outfile=None, overwrite=False, strategy='auto', explain=False):
+    # type: (str, str, int or float, str, str, str, int, int, str, bool, str, bool) -> None
     """
-    Calculate zonal statistics of a raster within polygons
+    Calculate zonal statistics of a raster within polygons. Raster and polygons need to share the same spatial
+    reference system.
 
     :param image: Input image
     :param vector: Input vector file
     :param no_data: NoData value of raster
     :param mode: Statistics that shall be calculated. Must be one of: med, mean, min, max, std, majority
-    :param id_column: Attribute column that holds the unique feature ID. If None, an automatic ID will be generated
-            internally.
+    :param id_column: Deprecated and ignored. Features are identified by their FID.
     :param col_name: New attribute name
     :param col_width: New field width
     :param col_precision: New field precision
     :param outfile: Output vector file. If None, the input file will be updated.
     :param overwrite: Overwrite output file, if it already exists
+    :param strategy: "grid" (rasterize all polygons into one in-memory ID grid), "window" (rasterize and read the
+        bounding box of each polygon separately) or "auto" (choose by zonal_tools.plan_strategy())
+    :param explain: Only print the cost estimates of both strategies and the chosen one, without calculating
     :return:
     """
-    # TODO: implement gdal.RasterizeLayer without using subprocess
-
     mode = mode.lower()
     if mode not in ('med', 'mean', 'min', 'max', 'std', 'majority'):
         raise ValueError('Mode {m} not implemented! Must be one of: med, mean, min, max, std, majority')
-    auto_id = False
-    if not id_column:
-        print('Generating automatic id...')
-        id_column = '_auto_id_'
-        vector_tools.create_field(vector, id_column, ogr.OFTInteger, 10, 0)
-        auto_id = True
-    print('Creating ID raster...')
-    id_raster = os.path.join(os.path.dirname(outfile), '__id_raster_TMP__.tif')
-    layername = os.path.splitext(os.path.basename(vector))[0]
-    res = get_raster_properties(image)[5][1]
-    xmin, xmax, ymin, ymax = get_raster_extent(image)
-    id_raster_nodata = -9999
-    cmd = ['gdal_rasterize', '-a', id_column, '-te', str(xmin), str(ymin), str(xmax), str(ymax), '-tr',
-           str(res), str(res), '-tap', '-ot', 'Int32', '-a_nodata', str(id_raster_nodata), '-l', layername, vector, id_raster]
-    if os.path.exists(id_raster):
-        delete_ds(id_raster)
-    run_cmd(cmd)
+    if strategy not in ('auto', 'grid', 'window'):
+        raise ValueError('Strategy {s} not implemented! Must be one of: auto, grid, window'.format(s=strategy))
+    if id_column:
+        warnings.warn('id_column is deprecated and ignored! Features are identified by their FID.')
     ds_raster = gdal.Open(image, gdal.GA_ReadOnly)
-    raster_data = ds_raster.GetRasterBand(1).ReadAsArray()
-    if no_data is not None:
-        raster_data = np.ma.masked_equal(raster_data, no_data)
+    band = ds_raster.GetRasterBand(1)
+    if no_data is None:
+        no_data = band.GetNoDataValue()
+    # read geometries once
+    ds_vector = ogr.Open(vector)
+    lyr = ds_vector.GetLayer()
+    lyr_defn = lyr.GetLayerDefn()
+    lyr.SetIgnoredFields([lyr_defn.GetFieldDefn(f).GetName() for f in range(lyr_defn.GetFieldCount())] + ['OGR_STYLE'])
+    fids = []
+    envelopes = []
+    wkbs = []
+    for feat in lyr:
+        geom = feat.GetGeometryRef()
+        if geom is None:
+            continue
+        fids.append(feat.GetFID())
+        envelopes.append(geom.GetEnvelope())
+        wkbs.append(geom.ExportToWkb())
+    lyr = None
+    ds_vector = None
+    windows = zonal_tools.pixel_windows(envelopes, ds_raster.GetGeoTransform(), ds_raster.RasterXSize,
+                                        ds_raster.RasterYSize)
+    chosen, estimates = zonal_tools.plan_strategy(ds_raster, windows)
+    if strategy == 'auto':
+        strategy = chosen
+    if explain:
+        zonal_tools.print_estimates(estimates, strategy)
+        band = None
+        ds_raster = None
+        return
+    if not band.DataType in (gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_Int16, gdal.GDT_UInt32, gdal.GDT_Int32) and \
+            mode == 'majority':
+        warnings.warn('Mode "majority" only works with integer values! Converting accordingly!')
+    print('Calculating {m} per polygon ({s} strategy)...'.format(m=mode, s=strategy))
+    values = np.full(len(fids), np.nan)
+    separate = np.ones(len(fids), dtype=bool)
+    if strategy == 'grid' and len(fids) > 0:
+        zones, xoff, yoff, separate = zonal_tools.rasterize_zones(ds_raster, windows, wkbs)
+        data = band.ReadAsArray(xoff, yoff, zones.shape[1], zones.shape[0]).ravel()
+        zones = zones.ravel()
+        valid = zones > 0
+        if no_data is not None:
+            valid &= data != no_data
+        if data.dtype.kind == 'f':
+            valid &= ~np.isnan(data)
+        values = zonal_tools.grouped_statistics(zones[valid] - 1, data[valid], len(fids), mode)
+        if separate.any():
+            print('{n} overlapping polygons are calculated separately...'.format(n=int(separate.sum())))
+    # polygons of the window strategy and overlapping polygons of the grid strategy
+    for i in tqdm(np.flatnonzero(separate), desc='Progress'):
+        mask = zonal_tools.rasterize_window(ds_raster, windows[i], [wkbs[i]]).ravel() == 1
+        data = band.ReadAsArray(*[int(w) for w in windows[i]]).ravel()[mask]
+        if no_data is not None:
+            data = data[data != no_data]
+        if data.dtype.kind == 'f':
+            data = data[~np.isnan(data)]
+        values[i] = zonal_tools.grouped_statistics(np.zeros(data.size, dtype=np.int64), data, 1, mode)[0]
+    band = None
     ds_raster = None
-    ds_id = gdal.Open(id_raster, gdal.GA_ReadOnly)
-    id_array = ds_id.GetRasterBand(1).ReadAsArray()
-    ds_id = None
     if outfile:
         vector_tools.copy_ds(vector, outfile, overwrite)
     else:
@@ -959,41 +1001,24 @@ def zonal_statistics(image, vector, no_data=None, mode='med', id_column=None, co
         vector_tools.create_field(outfile, col_name, ogr.OFTInteger, col_width, 0)
     else:
         vector_tools.create_field(outfile, col_name, ogr.OFTReal, col_width, col_precision)
+    rows = dict(zip(fids, range(len(fids))))
     ds_vector = ogr.Open(outfile, 1)
     lyr = ds_vector.GetLayer()
-    print('Calculating {m} per unique ID...'.format(m=mode))
-    if not raster_data.dtype == 'int' and mode == 'majority':
-        warnings.warn('Mode "majority" only works with integer values! Converting accordingly!')
-    all_ids = np.unique(id_array[id_array != id_raster_nodata])
-    for fid in tqdm(all_ids, desc='Progress'):
-        segment = np.where(id_array == fid)
-        if mode == 'med':
-            data = np.ma.median(raster_data[segment])
-        elif mode == 'mean':
-            data = np.ma.mean(raster_data[segment])
-        elif mode == 'min':
-            data = np.ma.min(raster_data[segment])
-        elif mode == 'max':
-            data = np.ma.max(raster_data[segment])
-        elif mode == 'stdv':
-            data = np.ma.std(raster_data[segment])
-        elif mode == 'majority':
-            data = int(np.bincount(raster_data[segment].astype(int).flatten()).argmax())
-        else:
-            data = None
-        feat = lyr.GetFeature(fid)
-        if data.dtype == 'int':
-            feat.SetField(col_name, int(data))
+    index = lyr.FindFieldIndex(col_name, 1)
+    lyr.StartTransaction()
+    for feat in lyr:
+        row = rows.get(feat.GetFID())
+        if row is None or np.isnan(values[row]):
+            continue
+        if mode == 'majority':
+            feat.SetField(index, int(values[row]))
         else:
-            feat.SetField(col_name, float(data))
+            feat.SetField(index, float(values[row]))
         lyr.SetFeature(feat)
-        feat = None
+    lyr.CommitTransaction()
     lyr = None
     ds_vector = None
     vector_tools.create_spatial_index(outfile)
-    delete_ds(id_raster)
-    if auto_id:
-        vector_tools.delete_field(vector, id_column)
     return
 
 
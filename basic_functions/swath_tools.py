@@ -0,0 +1,205 @@
+import math
+import numpy as np
+from scipy.spatial import cKDTree
+from osgeo import osr
+
+
+"""
+------
+NOTES:
+------
+Satellite swaths (e.g. Sentinel-3 OLCI or SLSTR) come as arrays in sensor geometry, with latitude and longitude of each
+pixel. SwathResampler projects these coordinates once, searches the swath pixels for each target pixel with a KD-tree
+and keeps the resulting indices (and weights). Any number of bands can then be resampled to the target grid with
+vectorized gathers.
+"""
+
+RESAMPLING_MODES = ('nearest', 'bilinear')
+
+# number of points which are projected or queried at once
+CHUNK_SIZE = 2 ** 20
+
+
+class SwathResampler:
+    def __init__(self, lat, lon, epsg=None, resolution=300, mode='nearest', max_distance=None, threads=-1):
+        # type: (np.ndarray, np.ndarray, int, float, str, float, int) -> None
+        """
+        Build the mapping from a swath to a regular target grid.
+
+        :param lat: Latitudes of the swath pixels (2D, NaN where invalid)
+        :param lon: Longitudes of the swath pixels (2D, NaN where invalid)
+        :param epsg: EPSG code of the target grid. Defaults to the UTM zone of the swath center.
+        :param resolution: Pixel size of the target grid, in units of the target coordinate system
+        :param mode: Resampling mode. One of: nearest, bilinear
+        :param max_distance: Maximum distance between a target pixel center and its nearest swath pixel. Target pixels
+            further away stay empty. Defaults to 1.5 times the larger one of the swath pixel spacing and the resolution.
+        :param threads: Number of threads for the KD-tree queries. -1 means all CPUs.
+        """
+        if mode not in RESAMPLING_MODES:
+            raise ValueError('Mode {m} not supported! Must be one of: {r}'.format(m=mode,
+                                                                                   r=', '.join(RESAMPLING_MODES)))
+        if lat.shape != lon.shape or lat.ndim != 2:
+            raise ValueError('Latitudes and longitudes must be 2D arrays of the same shape!')
+        self.mode = mode
+        self.shape = lat.shape
+        self.epsg = epsg if epsg else self.utm_epsg(lat, lon)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(self.epsg)
+        self.wkt = srs.ExportToWkt()
+        x, y = self._project(lat.ravel(), lon.ravel(), self.epsg)
+        valid = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+        if valid.size == 0:
+            raise ValueError('No valid coordinates in the swath!')
+        # target grid, aligned to the resolution
+        xmin = math.floor(np.min(x[valid]) / resolution) * resolution
+        xmax = math.ceil(np.max(x[valid]) / resolution) * resolution
+        ymin = math.floor(np.min(y[valid]) / resolution) * resolution
+        ymax = math.ceil(np.max(y[valid]) / resolution) * resolution
+        self.cols = max(int(round((xmax - xmin) / resolution)), 1)
+        self.rows = max(int(round((ymax - ymin) / resolution)), 1)
+        self.geotrans = (xmin, resolution, 0., ymax, 0., -resolution)
+        tree = cKDTree(np.column_stack((x[valid], y[valid])))
+        if max_distance is None:
+            sample = valid[::max(1, valid.size // 10000)]
+            spacing = np.median(tree.query(np.column_stack((x[sample], y[sample])), k=2, workers=threads)[0][:, 1])
+            max_distance = 1.5 * max(spacing, resolution)
+        # nearest swath pixel of each target pixel center
+        target = []
+        nearest = []
+        for start in range(0, self.rows * self.cols, CHUNK_SIZE):
+            pixels = np.arange(start, min(start + CHUNK_SIZE, self.rows * self.cols))
+            px = xmin + (pixels % self.cols + 0.5) * resolution
+            py = ymax - (pixels // self.cols + 0.5) * resolution
+            distance, index = tree.query(np.column_stack((px, py)), distance_upper_bound=max_distance,
+                                         workers=threads)
+            found = np.isfinite(distance)
+            target.append(pixels[found])
+            nearest.append(valid[index[found]])
+        tree = None
+        self._target = np.concatenate(target)
+        nearest = np.concatenate(nearest)
+        if mode == 'nearest':
+            self._index = nearest[np.newaxis, :]
+            self._weights = np.ones((1, nearest.size), dtype=np.float32)
+        else:
+            px = xmin + (self._target % self.cols + 0.5) * resolution
+            py = ymax - (self._target // self.cols + 0.5) * resolution
+            self._index, self._weights = self._bilinear(x.reshape(self.shape), y.reshape(self.shape), nearest, px, py)
+
+    @staticmethod
+    def utm_epsg(lat, lon):
+        # type: (np.ndarray, np.ndarray) -> int
+        """
+        EPSG code of the UTM zone at the center of a swath
+
+        :param lat: Latitudes (NaN where invalid)
+        :param lon: Longitudes (NaN where invalid)
+        :return: EPSG code
+        """
+        zone = int(math.floor((float(np.nanmean(lon)) + 180) / 6) + 1)
+        return (32600 if float(np.nanmean(lat)) >= 0 else 32700) + zone
+
+    @staticmethod
+    def _project(lat, lon, epsg):
+        # type: (np.ndarray, np.ndarray, int) -> tuple
+        """
+        Project geographic coordinates (WGS84) in chunks. Invalid coordinates stay NaN.
+        """
+        if epsg == 4326:
+            return lon.astype(np.float64), lat.astype(np.float64)
+        src = osr.SpatialReference()
+        src.ImportFromEPSG(4326)
+        dst = osr.SpatialReference()
+        dst.ImportFromEPSG(epsg)
+        for srs in (src, dst):
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src, dst)
+        x = np.full(lat.size, np.nan)
+        y = np.full(lat.size, np.nan)
+        valid = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+        for start in range(0, valid.size, CHUNK_SIZE):
+            chunk = valid[start:start + CHUNK_SIZE]
+            points = np.array(transform.TransformPoints(np.column_stack((lon[chunk], lat[chunk])).tolist()))
+            x[chunk] = points[:, 0]
+            y[chunk] = points[:, 1]
+        return x, y
+
+    @staticmethod
+    def _bilinear(x, y, nearest, px, py):
+        # type: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) -> tuple
+        """
+        Bilinear indices and weights in swath geometry. The fractional swath row and column of each target pixel are
+        found from its nearest swath pixel and the local derivatives of the swath coordinates. Where these are not
+        available (e.g. at invalid neighbours), the nearest swath pixel is used.
+
+        :param x: Projected x coordinates of the swath (2D)
+        :param y: Projected y coordinates of the swath (2D)
+        :param nearest: Flat index of the nearest swath pixel of each target pixel
+        :param px: x coordinates of the target pixel centers
+        :param py: y coordinates of the target pixel centers
+        :return: Tuple of (flat swath indices, weights), each of shape (4, target pixels)
+        """
+        rows, cols = x.shape
+        r, c = np.divmod(nearest, cols)
+        # central differences, one-sided at the swath borders
+        r_lo = np.maximum(r - 1, 0)
+        r_hi = np.minimum(r + 1, rows - 1)
+        c_lo = np.maximum(c - 1, 0)
+        c_hi = np.minimum(c + 1, cols - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dx_dc = (x[r, c_hi] - x[r, c_lo]) / (c_hi - c_lo)
+            dy_dc = (y[r, c_hi] - y[r, c_lo]) / (c_hi - c_lo)
+            dx_dr = (x[r_hi, c] - x[r_lo, c]) / (r_hi - r_lo)
+            dy_dr = (y[r_hi, c] - y[r_lo, c]) / (r_hi - r_lo)
+            det = dx_dc * dy_dr - dx_dr * dy_dc
+            dx = px - x[r, c]
+            dy = py - y[r, c]
+            row = r + (dx_dc * dy - dy_dc * dx) / det
+            col = c + (dy_dr * dx - dx_dr * dy) / det
+        fallback = ~(np.isfinite(row) & np.isfinite(col))
+        row[fallback] = r[fallback]
+        col[fallback] = c[fallback]
+        row = np.clip(row, 0, rows - 1)
+        col = np.clip(col, 0, cols - 1)
+        r0 = np.minimum(np.floor(row).astype(np.int64), max(rows - 2, 0))
+        c0 = np.minimum(np.floor(col).astype(np.int64), max(cols - 2, 0))
+        r1 = np.minimum(r0 + 1, rows - 1)
+        c1 = np.minimum(c0 + 1, cols - 1)
+        fr = (row - r0).astype(np.float32)
+        fc = (col - c0).astype(np.float32)
+        index = np.stack((r0 * cols + c0, r0 * cols + c1, r1 * cols + c0, r1 * cols + c1))
+        weights = np.stack(((1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc))
+        return index, weights
+
+    def resample(self, data, no_data=np.nan):
+        # type: (np.ndarray, float) -> np.ndarray
+        """
+        Resample one or more bands of the swath to the target grid. NaN values in the input are ignored; with bilinear
+        resampling, the weights of the remaining neighbours are normalized.
+
+        :param data: Array of shape (rows, columns) or (bands, rows, columns), in the shape of the coordinates
+        :param no_data: Value of target pixels without data
+        :return: Float32 array of shape (target rows, target columns) or (bands, target rows, target columns)
+        """
+        if data.shape[-2:] != self.shape:
+            raise ValueError('Data of shape {d} does not match the swath of shape {s}!'.format(d=data.shape[-2:],
+                                                                                                s=self.shape))
+        single = data.ndim == 2
+        data = data.reshape((-1, self.shape[0] * self.shape[1]))
+        out = np.full((data.shape[0], self.rows * self.cols), no_data, dtype=np.float32)
+        for b in range(data.shape[0]):
+            values = data[b][self._index].astype(np.float32)
+            if self.mode == 'nearest':
+                out[b, self._target] = np.where(np.isnan(values[0]), no_data, values[0])
+                continue
+            valid = ~np.isnan(values)
+            weights = np.where(valid, self._weights, 0)
+            total = weights.sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = (np.where(valid, values, 0) * weights).sum(axis=0) / total
+            filled = total > 0
+            out[b, self._target[filled]] = result[filled]
+        if single:
+            return out.reshape((self.rows, self.cols))
+        return out.reshape((-1, self.rows, self.cols))
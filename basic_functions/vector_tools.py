@@ -1,10 +1,16 @@
 import os
+import math
+import numbers
 import warnings
+import multiprocessing
+import numpy as np
 import pandas as pd
+from xml.sax.saxutils import escape
 from tqdm import tqdm
-from osgeo import ogr, osr, gdal
+from osgeo import ogr, osr, gdal, gdal_array
 from collections import Counter
 import raster_tools
+from basic_functions.pool_tools import bounded_imap
 
 OGR_FIELD_TYPES = [
     ogr.OFTBinary,
@@ -21,6 +27,14 @@ OGR_FIELD_TYPES = [
     ogr.OFTWideStringList
 ]
 
+# field types that can be widened into each other when merging schemas of several files
+OGR_NUMERIC_FIELD_TYPES = (ogr.OFTInteger, ogr.OFTInteger64, ogr.OFTReal)
+
+# drivers whose datasources understand SQL statements like GROUP BY or UPDATE natively
+SQL_DRIVERS = ('GPKG', 'SQLite')
+
+GEOMETRY_OPERATIONS = ('buffer', 'simplify', 'simplify_topology', 'make_valid', 'convex_hull', 'centroid')
+
 
 def read_spatial_data_to_df(filepath, truth_column, prediction_columm, nodata=None):
     # type: (str, str, str, int or float) -> (pd.DataFrame, list)
@@ -123,50 +137,94 @@ def create_spatial_index(ds_name):
     return
 
 
-def create_field(ds_name, field_name, field_type, field_width, field_precision=None, initial_value=None, silent=False):
-    # type: (str, str, ogr.FieldDefn, int, int, any, bool) -> None
+def _sql_literal(value):
+    # type: (any) -> str
     """
-    Create a new attribute field
+    Format a Python or NumPy value as SQL literal. None, NaN and infinity become NULL.
+
+    :param value: Value
+    :return: SQL literal
+    """
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, (bool, np.bool_)):
+        return str(int(value))
+    elif isinstance(value, (numbers.Real, np.integer, np.floating)):
+        value = _to_python(value)
+        # NaN and infinity are no valid SQL numbers
+        if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+            return 'NULL'
+        return repr(value)
+    return "'{v}'".format(v=str(value).replace("'", "''"))
+
+
+def create_fields(ds_name, fields, silent=False, batch_size=50000):
+    # type: (str, list or tuple, bool, int) -> None
+    """
+    Create several new attribute fields at once. Initial values are set by one UPDATE statement for SQL capable
+    formats (see SQL_DRIVERS) or in one single transactional pass over all features otherwise.
 
     :param ds_name: Input file (will be updated)
-    :param field_name: New field name
-    :param field_type: OGR field type. One of: ogr.OFTBinary, ogr.OFTDate, ogr.OFTDateTime, ogr.OFTInteger,
-            ogr.OFTIntegerList, ogr.OFTReal, ogr.OFTRealList, ogr.OFTString, ogr.OFTStringList, ogr.OFTTime,
-            ogr.OFTWideString, ogr.OFTWideStringList
-    :param field_width: Field width. For safety, use one more than the lenght of your maximum value
-    :param field_precision: Field precision (only needed for floating point field)
-    :param initial_value: Default value for all features. Data type needs to match the chosen field_type
+    :param fields: List of tuples (field_name, field_type, field_width[, field_precision[, initial_value]]). See
+            create_field() for details.
     :param silent: Suppress print messages
+    :param batch_size: Number of features updated per transaction (only for formats which are not SQL capable)
     :return: --
     """
     if not os.path.exists(ds_name):
         raise IOError('Input file {f} does not exist!'.format(f=ds_name))
-    if len(field_name) > 10:
-        warnings.warn('Field name {n} contains more than 10 characters and will therefore be truncated to 10 for '
-                      'safety!'.format(n=field_name))
-    if field_type not in OGR_FIELD_TYPES:
-        raise ValueError('Given field type not supported by OGR! Use one of the following: {types}'.format(
-            types=', '.join([t for t in OGR_FIELD_TYPES])))
+    fields = [tuple(field) + (None,) * (5 - len(field)) for field in fields]
+    names = [field[0].lower() for field in fields]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise KeyError('Field name(s) {n} given more than once!'.format(n=', '.join(duplicates)))
+    for field_name, field_type, _width, _precision, _value in fields:
+        if len(field_name) > 10:
+            warnings.warn('Field name {n} contains more than 10 characters and will therefore be truncated to 10 for '
+                          'safety!'.format(n=field_name))
+        if field_type not in OGR_FIELD_TYPES:
+            raise ValueError('Given field type not supported by OGR! Use one of the following: {types}'.format(
+                types=', '.join([str(t) for t in OGR_FIELD_TYPES])))
     if not silent:
-        print('Creating field {f} as new attribute for {ds}...'.format(f=field_name, ds=ds_name))
+        print('Creating field(s) {f} as new attribute(s) for {ds}...'.format(
+            f=', '.join([field[0] for field in fields]), ds=ds_name))
     ds = ogr.Open(ds_name, 1)
     lyr = ds.GetLayer()
     field_defn = lyr.GetLayerDefn()
     fieldnames = [field_defn.GetFieldDefn(f).name.lower() for f in range(field_defn.GetFieldCount())]
-    if field_name.lower() in fieldnames:
-        lyr = None
-        ds = None
-        raise KeyError('Chosen field name "{n}" already exists!'.format(n=field_name))
-    field_defn = ogr.FieldDefn(field_name, field_type)
-    field_defn.SetWidth(int(field_width))
-    if field_precision:
-        field_defn.SetPrecision(int(field_precision))
-    lyr.CreateField(field_defn)
-    if initial_value is not None:
-        for feature in tqdm(lyr, desc='Setting initial value'):
-            feature.SetField(field_name, initial_value)
-            lyr.SetFeature(feature)
-    repack(ds, lyr)
+    for field_name, _type, _width, _precision, _value in fields:
+        if field_name.lower() in fieldnames:
+            lyr = None
+            ds = None
+            raise KeyError('Chosen field name "{n}" already exists!'.format(n=field_name))
+    initial_values = []
+    for field_name, field_type, field_width, field_precision, initial_value in fields:
+        field_defn = ogr.FieldDefn(field_name, field_type)
+        field_defn.SetWidth(int(field_width))
+        if field_precision:
+            field_defn.SetPrecision(int(field_precision))
+        lyr.CreateField(field_defn)
+        if initial_value is not None:
+            index = lyr.GetLayerDefn().GetFieldCount() - 1
+            initial_values.append((index, lyr.GetLayerDefn().GetFieldDefn(index).GetName(), initial_value))
+    if initial_values:
+        if ds.GetDriver().GetName() in SQL_DRIVERS:
+            ds.ExecuteSQL('UPDATE "{l}" SET {values}'.format(l=lyr.GetName(), values=', '.join(
+                ['"{f}" = {v}'.format(f=name, v=_sql_literal(value)) for _index, name, value in initial_values])))
+        else:
+            count = 0
+            lyr.StartTransaction()
+            for feature in tqdm(lyr, desc='Setting initial values'):
+                for index, _name, value in initial_values:
+                    feature.SetField(index, value)
+                lyr.SetFeature(feature)
+                count += 1
+                if count % batch_size == 0:
+                    lyr.CommitTransaction()
+                    lyr.StartTransaction()
+            lyr.CommitTransaction()
+    if ds.GetDriver().GetName() == 'ESRI Shapefile':
+        repack(ds, lyr)
     lyr = None
     ds = None
     if not silent:
@@ -174,6 +232,26 @@ def create_field(ds_name, field_name, field_type, field_width, field_precision=N
     return
 
 
+def create_field(ds_name, field_name, field_type, field_width, field_precision=None, initial_value=None, silent=False):
+    # type: (str, str, ogr.FieldDefn, int, int, any, bool) -> None
+    """
+    Create a new attribute field. Use create_fields() to create several fields at once.
+
+    :param ds_name: Input file (will be updated)
+    :param field_name: New field name
+    :param field_type: OGR field type. One of: ogr.OFTBinary, ogr.OFTDate, ogr.OFTDateTime, ogr.OFTInteger,
+            ogr.OFTIntegerList, ogr.OFTReal, ogr.OFTRealList, ogr.OFTString, ogr.OFTStringList, ogr.OFTTime,
+            ogr.OFTWideString, ogr.OFTWideStringList
+    :param field_width: Field width. For safety, use one more than the lenght of your maximum value
+    :param field_precision: Field precision (only needed for floating point field)
+    :param initial_value: Default value for all features. Data type needs to match the chosen field_type
+    :param silent: Suppress print messages
+    :return: --
+    """
+    create_fields(ds_name, [(field_name, field_type, field_width, field_precision, initial_value)], silent)
+    return
+
+
 def delete_field(ds_name, field_name):
     # type: (str, str) -> None
     """
@@ -213,25 +291,229 @@ def repack(ds, lyr):
     return
 
 
-def close_rings(ds_name):
-    # type: (str) -> None
+def write_features(lyr, features, batch_size=50000):
+    # type: (ogr.Layer, iter, int) -> int
+    """
+    Write features into a layer, bundled into transactions of "batch_size" features each. For formats like
+    GeoPackage this avoids one implicit transaction per feature. Formats without transaction support simply ignore
+    the transaction calls.
+
+    :param lyr: Output layer
+    :param features: Iterable (e.g. a generator) of ogr.Feature objects matching the layer definition
+    :param batch_size: Number of features per transaction
+    :return: Number of written features
+    """
+    count = 0
+    lyr.StartTransaction()
+    for feat in features:
+        lyr.CreateFeature(feat)
+        feat = None
+        count += 1
+        if count % batch_size == 0:
+            lyr.CommitTransaction()
+            lyr.StartTransaction()
+    lyr.CommitTransaction()
+    return count
+
+
+def _wkb_chunks(lyr, chunk_size):
+    # type: (ogr.Layer, int) -> iter
+    """
+    Read a layer sequentially and yield its features as picklable chunks, e.g. for sending them to worker processes
+
+    :param lyr: Input layer
+    :param chunk_size: Number of features per chunk
+    :return: Generator of lists of (WKB geometry or None, list of attribute values)
+    """
+    field_count = lyr.GetLayerDefn().GetFieldCount()
+    chunk = []
+    lyr.ResetReading()
+    for feat in lyr:
+        geom = feat.GetGeometryRef()
+        wkb = bytes(geom.ExportToWkb()) if geom is not None else None
+        chunk.append((wkb, [feat.GetField(i) for i in range(field_count)]))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _features_from_wkb(items, defn):
+    # type: (iter, ogr.FeatureDefn) -> iter
+    """
+    Turn (WKB, attribute values) tuples back into features
+
+    :param items: Iterable of (WKB geometry or None, list of attribute values in the order of "defn")
+    :param defn: Output feature definition
+    :return: Generator of ogr.Feature
+    """
+    for wkb, attributes in items:
+        feat = ogr.Feature(defn)
+        if wkb is not None:
+            feat.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb))
+        for i, value in enumerate(attributes):
+            if value is not None:
+                feat.SetField(i, value)
+        yield feat
+
+
+def _geometry_dimension(geom_type):
+    # type: (int) -> int
+    """
+    Geometric dimension of an OGR geometry type (0: points, 1: lines, 2: polygons)
+    """
+    geom_type = ogr.GT_Flatten(geom_type)
+    if geom_type in (ogr.wkbLineString, ogr.wkbMultiLineString):
+        return 1
+    elif geom_type in (ogr.wkbPolygon, ogr.wkbMultiPolygon):
+        return 2
+    return 0
+
+
+def _layer_dimension(lyr):
+    # type: (ogr.Layer) -> int
+    """
+    Geometric dimension of the features of a layer (0: points, 1: lines, 2: polygons). Layers of a generic geometry type
+    (e.g. wkbUnknown or wkbGeometryCollection) are scanned for the highest dimension of their actual geometries.
+    """
+    geom_type = ogr.GT_Flatten(lyr.GetGeomType())
+    if geom_type in (ogr.wkbPoint, ogr.wkbMultiPoint, ogr.wkbLineString, ogr.wkbMultiLineString, ogr.wkbPolygon,
+                     ogr.wkbMultiPolygon):
+        return _geometry_dimension(geom_type)
+    lyr_defn = lyr.GetLayerDefn()
+    lyr.SetIgnoredFields([lyr_defn.GetFieldDefn(i).GetName() for i in range(lyr_defn.GetFieldCount())] + ['OGR_STYLE'])
+    dimension = 0
+    lyr.ResetReading()
+    for feat in lyr:
+        geom = feat.GetGeometryRef()
+        if geom is not None and not geom.IsEmpty():
+            dimension = max(dimension, geom.GetDimension())
+            if dimension == 2:
+                break
+    lyr.ResetReading()
+    lyr.SetIgnoredFields([])
+    return dimension
+
+
+def _multi_type(dimension):
+    # type: (int) -> int
+    """
+    Multipart OGR geometry type of a geometric dimension (0: points, 1: lines, 2: polygons)
+    """
+    return (ogr.wkbMultiPoint, ogr.wkbMultiLineString, ogr.wkbMultiPolygon)[dimension]
+
+
+def _force_multi(geom, dimension):
+    # type: (ogr.Geometry, int) -> ogr.Geometry
+    """
+    Turn a geometry of the given dimension into its multipart type
+    """
+    return (ogr.ForceToMultiPoint, ogr.ForceToMultiLineString, ogr.ForceToMultiPolygon)[dimension](geom)
+
+
+def _unique_field_name(name, existing, max_length=10):
+    # type: (str, list, int) -> str
+    """
+    Adjust a field name until it does not clash with any of the existing (lower case) field names
+
+    :param name: Desired field name
+    :param existing: List of existing field names in lower case
+    :param max_length: Maximum field name length (10 for ESRI Shapefiles) or None for no limit
+    :return: Unique field name
+    """
+    unique = name[:max_length] if max_length else name
+    n = 1
+    while unique.lower() in existing:
+        suffix = '_{n}'.format(n=n)
+        unique = (name[:max_length - len(suffix)] if max_length else name) + suffix
+        n += 1
+    return unique
+
+
+def _has_open_rings(geom):
+    # type: (ogr.Geometry) -> bool
     """
-    Close rings within a polygon vector file.
+    Check if any ring of a (multi)polygon is not closed
 
-    :param ds_name:
+    :param geom: Input geometry
+    :return: True, if at least one ring is open
+    """
+    geom_type = ogr.GT_Flatten(geom.GetGeometryType())
+    if geom_type == ogr.wkbPolygon:
+        for i in range(geom.GetGeometryCount()):
+            ring = geom.GetGeometryRef(i)
+            n = ring.GetPointCount()
+            if n > 0 and ring.GetPoint(0) != ring.GetPoint(n - 1):
+                return True
+    elif geom_type in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+        for i in range(geom.GetGeometryCount()):
+            if _has_open_rings(geom.GetGeometryRef(i)):
+                return True
+    return False
+
+
+def close_rings(ds_name, outfile=None, of=None, batch_size=50000, overwrite=False):
+    # type: (str, str, str, int, bool) -> None
+    """
+    Close rings within a polygon vector file. The file is updated in place, touching only features with open rings,
+    within transactions of "batch_size" features. If an output file is given or the input format does not support
+    updates, all features are streamed into a new file instead.
+
+    :param ds_name: Input file (will be updated, unless "outfile" is given or the format does not allow updates)
+    :param outfile: Output file. Defaults to "<input>_closed.<ext>" if the input can not be updated.
+    :param of: Output format according to OGR driver standard. Defaults to the format of the input file.
+    :param batch_size: Number of features per transaction
+    :param overwrite: Overwrite the output file, if it already exists
     :return: --
     """
-    ds = ogr.Open(ds_name, 1)
+    ds = None if outfile else ogr.Open(ds_name, 1)
+    if ds is not None and ds.GetLayer().TestCapability(ogr.OLCRandomWrite):
+        lyr = ds.GetLayer()
+        count = 0
+        lyr.StartTransaction()
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            if geom is None or not _has_open_rings(geom):
+                continue
+            geom.CloseRings()
+            lyr.SetFeature(feat)
+            count += 1
+            if count % batch_size == 0:
+                lyr.CommitTransaction()
+                lyr.StartTransaction()
+        lyr.CommitTransaction()
+        if ds.GetDriver().GetName() == 'ESRI Shapefile':
+            repack(ds, lyr)
+        lyr = None
+        ds = None
+        return
+    ds = None
+    if not outfile:
+        outfile = '{base}_closed{ext}'.format(base=os.path.splitext(ds_name)[0], ext=os.path.splitext(ds_name)[1])
+        warnings.warn('{f} can not be updated! Writing closed rings to {o}'.format(f=ds_name, o=outfile))
+    ds = ogr.Open(ds_name, 0)
     lyr = ds.GetLayer()
-    copies = []
-    for feat in lyr:
-        if feat.geometry():
-            feat.geometry().CloseRings()
-            copies.append(feat)
-            lyr.DeleteFeature(feat.GetFID())
-    for copy in copies:
-        lyr.CreateFeature(copy)
-    repack(ds, lyr)
+    if not of:
+        of = ds.GetDriver().GetName()
+    out_ds, out_lyr = create_ds(outfile, of, lyr.GetGeomType(), lyr.GetSpatialRef(), overwrite=overwrite)
+    lyr_defn = lyr.GetLayerDefn()
+    for i in range(lyr_defn.GetFieldCount()):
+        out_lyr.CreateField(lyr_defn.GetFieldDefn(i))
+    out_defn = out_lyr.GetLayerDefn()
+
+    def closed_features():
+        for feat in lyr:
+            out_feat = ogr.Feature(out_defn)
+            out_feat.SetFrom(feat)
+            geom = out_feat.GetGeometryRef()
+            if geom is not None:
+                geom.CloseRings()
+            yield out_feat
+
+    write_features(out_lyr, closed_features(), batch_size)
+    out_lyr = None
+    out_ds = None
     lyr = None
     ds = None
     return
@@ -462,55 +744,181 @@ def reproject(ds_name, epsg, outfile, overwrite=False):
     return
 
 
-def merge(files, outfile, overwrite=True):
-    # type: (list or tuple, str, bool) -> None
+def _widen_field_type(type_a, type_b):
+    # type: (int, int) -> int
     """
-    Merge vector files (assuming they share the same coordinate system)
+    Get a field type that is able to hold the values of two other field types
 
-    :param files: List of input files of the same geometry type (e.g. all polygons)
-    :param outfile: Output file
-    :param overwrite: Overwrite output, if it already exists
+    :param type_a: OGR field type
+    :param type_b: OGR field type
+    :return: OGR field type
+    """
+    if type_a == type_b:
+        return type_a
+    if type_a in OGR_NUMERIC_FIELD_TYPES and type_b in OGR_NUMERIC_FIELD_TYPES:
+        if ogr.OFTReal in (type_a, type_b):
+            return ogr.OFTReal
+        return ogr.OFTInteger64
+    return ogr.OFTString
+
+
+def _union_schema(layers, field_mapping=None):
+    # type: (list, dict) -> (list, list)
+    """
+    Build a unified attribute schema from several layers. Fields are matched by their (case-insensitive) name after
+    applying "field_mapping". Fields of different types are widened to a common type (integer -> real -> string).
+
+    :param layers: List of OGR layers
+    :param field_mapping: Dictionary of {input field name: output field name}, used for all layers
+    :return: Tuple of (list of output ogr.FieldDefn, list of [(input index, output index), ...] per layer)
+    """
+    mapping = {}
+    if field_mapping:
+        mapping = {key.lower(): value for key, value in field_mapping.items()}
+    out_defns = []
+    out_names = []
+    index_maps = []
+    for lyr in layers:
+        lyr_defn = lyr.GetLayerDefn()
+        index_map = []
+        for i in range(lyr_defn.GetFieldCount()):
+            field_defn = lyr_defn.GetFieldDefn(i)
+            name = mapping.get(field_defn.GetName().lower(), field_defn.GetName())
+            if name.lower() not in out_names:
+                out_defn = ogr.FieldDefn(name, field_defn.GetType())
+                out_defn.SetWidth(field_defn.GetWidth())
+                out_defn.SetPrecision(field_defn.GetPrecision())
+                out_defns.append(out_defn)
+                out_names.append(name.lower())
+            else:
+                out_defn = out_defns[out_names.index(name.lower())]
+                out_defn.SetType(_widen_field_type(out_defn.GetType(), field_defn.GetType()))
+                out_defn.SetWidth(max(out_defn.GetWidth(), field_defn.GetWidth()))
+                out_defn.SetPrecision(max(out_defn.GetPrecision(), field_defn.GetPrecision()))
+            index_map.append((i, out_names.index(name.lower())))
+        index_maps.append(index_map)
+    return out_defns, index_maps
+
+
+def _merged_features(layers, index_maps, out_defn, source_names=None, source_index=None):
+    # type: (list, list, ogr.FeatureDefn, list, int) -> iter
+    """
+    Read all layers sequentially and yield their features translated into the output schema
+
+    :param layers: List of OGR layers
+    :param index_maps: List of [(input index, output index), ...] per layer, as returned by _union_schema()
+    :param out_defn: Output feature definition
+    :param source_names: Source name per layer, written into the field at "source_index"
+    :param source_index: Index of the output field holding the source name
+    :return: Generator of ogr.Feature
+    """
+    string_fields = [out_defn.GetFieldDefn(i).GetType() == ogr.OFTString for i in range(out_defn.GetFieldCount())]
+    for l, lyr in enumerate(layers):
+        lyr.ResetReading()
+        feat = lyr.GetNextFeature()
+        while feat is not None:
+            out_feat = ogr.Feature(out_defn)
+            out_feat.SetGeometry(feat.GetGeometryRef())
+            for src, dst in index_maps[l]:
+                if not feat.IsFieldSet(src) or feat.GetField(src) is None:
+                    continue
+                if string_fields[dst]:
+                    out_feat.SetField(dst, feat.GetFieldAsString(src))
+                else:
+                    out_feat.SetField(dst, feat.GetField(src))
+            if source_index is not None:
+                out_feat.SetField(source_index, source_names[l])
+            yield out_feat
+            feat = lyr.GetNextFeature()
+
+
+def _write_union_vrt(files, outfile, source_field=None):
+    # type: (list or tuple, str, str) -> None
+    """
+    Write an OGR VRT file that virtually unifies the layers of the given files
+
+    :param files: Input files
+    :param outfile: Output VRT file
+    :param source_field: Field name that holds the name of the source layer
     :return: --
     """
-    geom_types = []
+    lyr_name = os.path.splitext(os.path.basename(outfile))[0]
+    xml = ['<OGRVRTDataSource>', '  <OGRVRTUnionLayer name="{n}">'.format(n=escape(lyr_name))]
     for f in files:
-        create_spatial_index(f)
         ds = ogr.Open(f)
-        lyr = ds.GetLayer()
-        geom_types.append(lyr.GetGeomType())
-        lyr = None
+        src_lyr_name = ds.GetLayer().GetName()
         ds = None
-    if len(set(geom_types)) != 1:
-        raise AttributeError('Input files have different geometry types!')
-    # initiate output
+        xml += ['    <OGRVRTLayer name="{n}">'.format(n=escape(src_lyr_name)),
+                '      <SrcDataSource relativeToVRT="0">{f}</SrcDataSource>'.format(f=escape(os.path.abspath(f))),
+                '      <SrcLayer>{n}</SrcLayer>'.format(n=escape(src_lyr_name)),
+                '    </OGRVRTLayer>']
+    xml.append('    <FieldStrategy>Union</FieldStrategy>')
+    if source_field:
+        xml.append('    <SourceLayerFieldName>{f}</SourceLayerFieldName>'.format(f=escape(source_field)))
+    xml += ['  </OGRVRTUnionLayer>', '</OGRVRTDataSource>']
+    with open(outfile, 'w') as vrt:
+        vrt.write('\n'.join(xml) + '\n')
+    return
+
+
+def merge(files, outfile, overwrite=True, field_mapping=None, source_field=None, vrt=False, of=None,
+          batch_size=50000):
+    # type: (list or tuple, str, bool, dict, str, bool, str, int) -> None
+    """
+    Merge vector files (assuming they share the same coordinate system). The attribute fields of all files are
+    unified into one schema, each input is read sequentially and the output is written in bulk transactions.
+
+    :param files: List of input files of the same geometry type (e.g. all polygons)
+    :param outfile: Output file
+    :param overwrite: Overwrite output, if it already exists
+    :param field_mapping: Dictionary of {input field name: output field name} to rename fields, e.g. to unify
+            differently named fields of several inputs. Not supported for "vrt=True".
+    :param source_field: Name of an additional field that holds the name of the source file (or layer, in case of
+            "vrt=True")
+    :param vrt: Only write an OGR VRT file that virtually unifies all inputs instead of copying any features. The
+            output file should have the extension ".vrt".
+    :param of: Output format according to OGR driver standard. Defaults to the format of the first input file.
+    :param batch_size: Number of features written per transaction
+    :return: --
+    """
     if os.path.exists(outfile) and overwrite is True:
-        delete_ds(outfile)
+        if vrt:
+            os.remove(outfile)
+        else:
+            delete_ds(outfile)
     elif os.path.exists(outfile) and overwrite is False:
         raise ValueError('Output file {out} already exists and shall not be overwritten! Please choose another name or '
                          'set overwrite=True.'.format(out=outfile))
-    ds = ogr.Open(files[0])
-    lyr = ds.GetLayer()
+    if vrt:
+        if field_mapping:
+            warnings.warn('Parameter "field_mapping" is not supported for VRT output and will be ignored!')
+        _write_union_vrt(files, outfile, source_field)
+        return
+    datasources = [ogr.Open(f) for f in files]
+    layers = [ds.GetLayer() for ds in datasources]
+    geom_types = [lyr.GetGeomType() for lyr in layers]
+    if len(set(geom_types)) != 1:
+        raise AttributeError('Input files have different geometry types!')
+    if not of:
+        of = datasources[0].GetDriver().GetName()
     srs = osr.SpatialReference()
-    srs.ImportFromWkt(lyr.GetSpatialRef().ExportToWkt())
-    drv = ds.GetDriver()
-    lyr = None
-    ds = None
-    out_ds, out_lyr = create_ds(outfile, drv.GetName(), geom_types[0], srs)
-    feature_defn = out_lyr.GetLayerDefn()
-    # merge
-    for f in files:
-        ds = ogr.Open(f)
-        lyr = ds.GetLayer()
-        for feature in range(lyr.GetFeatureCount()):
-            feat = lyr.GetFeature(feature)
-            out_feat = ogr.Feature(feature_defn)
-            out_feat.SetGeometry(feat.GetGeometryRef())
-            out_lyr.CreateFeature(out_feat)
-            out_feat = None
-            feat = None
-    repack(out_ds, out_lyr)
-    out_lyr = None
+    srs.ImportFromWkt(layers[0].GetSpatialRef().ExportToWkt())
+    field_defns, index_maps = _union_schema(layers, field_mapping)
+    out_ds, out_lyr = create_ds(outfile, of, geom_types[0], srs, overwrite)
+    for field_defn in field_defns:
+        out_lyr.CreateField(field_defn)
+    source_index = None
+    source_names = None
+    if source_field:
+        out_lyr.CreateField(ogr.FieldDefn(source_field, ogr.OFTString))
+        source_index = out_lyr.GetLayerDefn().GetFieldCount() - 1
+        source_names = [os.path.basename(f) for f in files]
+    features = _merged_features(layers, index_maps, out_lyr.GetLayerDefn(), source_names, source_index)
+    write_features(out_lyr, features, batch_size)
+    layers = None
+    datasources = None
     out_lyr = None
+    out_ds = None
     create_spatial_index(outfile)
     return
 
@@ -622,16 +1030,151 @@ def spatial_join(polygons, points, outfile, fields, mode='majority', count_field
     return
 
 
-def intersect(files, outfile, overwrite=True):
-    # type: (list or tuple, str, bool) -> None
+def _keep_dimension(geom, dimension):
+    # type: (ogr.Geometry, int) -> ogr.Geometry or None
+    """
+    Drop all parts of a geometry that do not have the given dimension (e.g. lines and points resulting from the
+    intersection of touching polygons)
+
+    :param geom: Input geometry
+    :param dimension: Geometric dimension to keep (0: points, 1: lines, 2: polygons)
+    :return: Geometry of the given dimension or None, if nothing is left
+    """
+    if geom is None or geom.IsEmpty():
+        return None
+    if ogr.GT_Flatten(geom.GetGeometryType()) != ogr.wkbGeometryCollection:
+        return geom if geom.GetDimension() == dimension else None
+    parts = [geom.GetGeometryRef(i) for i in range(geom.GetGeometryCount())]
+    parts = [part for part in parts if part.GetDimension() == dimension and not part.IsEmpty()]
+    if not parts:
+        return None
+    union = parts[0].Clone()
+    for part in parts[1:]:
+        union = union.Union(part)
+    return union
+
+
+def _overlay_worker(args):
+    # type: (tuple) -> list
+    """
+    Intersect a chunk of features with all candidate features of another file. Candidates are found through a spatial
+    filter on the bounding box of each feature, which makes use of the spatial index of the other file.
+
+    :param args: Tuple of (chunk as returned by _wkb_chunks(), other file, geometric dimension to keep)
+    :return: List of (WKB multipart geometry, attributes of chunk feature + attributes of other feature)
+    """
+    chunk, other, dimension = args
+    ds = ogr.Open(other)
+    lyr = ds.GetLayer()
+    field_count = lyr.GetLayerDefn().GetFieldCount()
+    results = []
+    for wkb, attributes in chunk:
+        if wkb is None:
+            continue
+        geom = ogr.CreateGeometryFromWkb(wkb)
+        xmin, xmax, ymin, ymax = geom.GetEnvelope()
+        lyr.SetSpatialFilterRect(xmin, ymin, xmax, ymax)
+        for feat in lyr:
+            other_geom = feat.GetGeometryRef()
+            if other_geom is None or not geom.Intersects(other_geom):
+                continue
+            intersection = _keep_dimension(geom.Intersection(other_geom), dimension)
+            if intersection is None:
+                continue
+            intersection = _force_multi(intersection, dimension)
+            results.append((bytes(intersection.ExportToWkb()),
+                            attributes + [feat.GetField(i) for i in range(field_count)]))
+    lyr = None
+    ds = None
+    return results
+
+
+def _intersect_pair(wkbs):
+    # type: (tuple) -> bytes or None
+    """
+    Intersect two WKB geometries
+
+    :param wkbs: Tuple of two WKB geometries (or None for an empty geometry)
+    :return: WKB of the intersection or None, if it is empty
+    """
+    if wkbs[0] is None or wkbs[1] is None:
+        return None
+    intersection = ogr.CreateGeometryFromWkb(wkbs[0]).Intersection(ogr.CreateGeometryFromWkb(wkbs[1]))
+    if intersection is None or intersection.IsEmpty():
+        return None
+    return bytes(intersection.ExportToWkb())
+
+
+def _overlay(ds_name, other, outfile, of, processes, chunk_size):
+    # type: (str, str, str, str, int, int) -> None
+    """
+    Write the pairwise intersections of all features of two files, holding the attributes of both sides
+
+    :param ds_name: First input file
+    :param other: Second input file (should have a spatial index)
+    :param outfile: Output file
+    :param of: Output format according to OGR driver standard
+    :param processes: Number of worker processes
+    :param chunk_size: Number of features of the first file sent to a worker at once
+    :return: --
+    """
+    ds = ogr.Open(ds_name)
+    lyr = ds.GetLayer()
+    other_ds = ogr.Open(other)
+    other_lyr = other_ds.GetLayer()
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(lyr.GetSpatialRef().ExportToWkt())
+    # intersections of e.g. polygons and lines are lines
+    dimension = min(_layer_dimension(lyr), _layer_dimension(other_lyr))
+    # intersections may have several parts, even if the input features have one
+    out_ds, out_lyr = create_ds(outfile, of, _multi_type(dimension), srs, overwrite=True)
+    max_length = 10 if of == 'ESRI Shapefile' else None
+    existing = []
+    for defn in (lyr.GetLayerDefn(), other_lyr.GetLayerDefn()):
+        for i in range(defn.GetFieldCount()):
+            field_defn = defn.GetFieldDefn(i)
+            name = _unique_field_name(field_defn.GetName(), existing, max_length)
+            out_defn = ogr.FieldDefn(name, field_defn.GetType())
+            out_defn.SetWidth(field_defn.GetWidth())
+            out_defn.SetPrecision(field_defn.GetPrecision())
+            out_lyr.CreateField(out_defn)
+            existing.append(name.lower())
+    other_lyr = None
+    other_ds = None
+    pool = multiprocessing.Pool(processes)
+    tasks = ((chunk, other, dimension) for chunk in _wkb_chunks(lyr, chunk_size))
+    chunks = bounded_imap(pool, _overlay_worker, tasks, 2 * (processes or multiprocessing.cpu_count()))
+    results = (item for chunk in chunks for item in chunk)
+    write_features(out_lyr, _features_from_wkb(results, out_lyr.GetLayerDefn()))
+    pool.close()
+    pool.join()
+    out_lyr = None
+    out_ds = None
+    lyr = None
+    ds = None
+    return
+
+
+def intersect(files, outfile, overwrite=True, mode='overlay', processes=None, chunk_size=1000):
+    # type: (list or tuple, str, bool, str, int, int) -> None
     """
     Intersect vector files (assuming they share the same coordinate system)
 
     :param files: List of input files of the same geometry type (e.g. all polygons)
     :param outfile: Output file
     :param overwrite: Overwrite output, if it already exists
+    :param mode: Intersection mode. One of: <br>
+        - overlay: One output feature per intersecting pair of features, holding the attributes of both. Candidate
+          pairs are found through the spatial index of the files. More than two files are intersected one after
+          another. <br>
+        - single: One single output geometry, which is the intersection of all features of all files, reduced
+          pairwise in a balanced tree.
+    :param processes: Number of worker processes. Defaults to the number of CPUs.
+    :param chunk_size: Number of features sent to a worker process at once (only used in mode "overlay")
     :return: --
     """
+    if mode not in ('overlay', 'single'):
+        raise ValueError('Mode must be "overlay" or "single"!')
     geom_types = []
     for f in files:
         create_spatial_index(f)
@@ -652,72 +1195,198 @@ def intersect(files, outfile, overwrite=True):
     lyr = ds.GetLayer()
     srs = osr.SpatialReference()
     srs.ImportFromWkt(lyr.GetSpatialRef().ExportToWkt())
-    drv = ds.GetDriver()
+    drv_name = ds.GetDriver().GetName()
     lyr = None
     ds = None
-    out_ds, out_lyr = create_ds(outfile, drv.GetName(), geom_types[0], srs)
-    # intersect
-    intersection = ogr.Geometry(geom_types[0])
-    for f in files:
-        ds = ogr.Open(f)
-        lyr = ds.GetLayer()
-        for feature in range(lyr.GetFeatureCount()):
-            feat = lyr.GetFeature(feature)
-            if intersection.IsEmpty() is True:
-                intersection = intersection.Union(feat.GetGeometryRef())
+    if mode == 'overlay':
+        current = files[0]
+        temp_files = []
+        for i, other in enumerate(files[1:]):
+            if i == len(files) - 2:
+                target = outfile
             else:
-                intersection = intersection.Intersection(feat.GetGeometryRef())
-            feat = None
-        lyr = None
+                target = os.path.join(os.path.dirname(os.path.abspath(outfile)), '__intersect_{i}_TMP__{ext}'.format(
+                    i=i, ext=os.path.splitext(outfile)[1]))
+                temp_files.append(target)
+            _overlay(current, other, target, drv_name, processes, chunk_size)
+            current = target
+        for temp in temp_files:
+            delete_ds(temp)
+    else:
+        # intersect
+        geoms = []
+        for f in files:
+            ds = ogr.Open(f)
+            lyr = ds.GetLayer()
+            geoms += [bytes(feat.GetGeometryRef().ExportToWkb()) for feat in lyr if feat.GetGeometryRef()]
+            lyr = None
+            ds = None
+        pool = multiprocessing.Pool(processes)
+        while len(geoms) > 1:
+            pairs = list(zip(geoms[0::2], geoms[1::2]))
+            leftover = [geoms[-1]] if len(geoms) % 2 == 1 else []
+            geoms = pool.map(_intersect_pair, pairs) + leftover
+            if None in geoms:
+                geoms = [None]
+        pool.close()
+        pool.join()
+        ds = ogr.Open(files[0])
+        dimension = _layer_dimension(ds.GetLayer())
         ds = None
-    feature_defn = out_lyr.GetLayerDefn()
-    feature = ogr.Feature(feature_defn)
-    feature.SetGeometry(intersection)
-    out_lyr.CreateFeature(feature)
-    feature = None
-    repack(out_ds, out_lyr)
-    lyr = None
-    ds = None
+        out_ds, out_lyr = create_ds(outfile, drv_name, _multi_type(dimension), srs)
+        feature_defn = out_lyr.GetLayerDefn()
+        feature = ogr.Feature(feature_defn)
+        if geoms and geoms[0] is not None:
+            intersection = _keep_dimension(ogr.CreateGeometryFromWkb(geoms[0]), dimension)
+            if intersection is not None:
+                feature.SetGeometry(_force_multi(intersection, dimension))
+        out_lyr.CreateFeature(feature)
+        feature = None
+        out_lyr = None
+        out_ds = None
     create_spatial_index(outfile)
     return
 
 
-def buffering(ds_name, dist, outfile, overwrite):
-    # type: (str, int or float, str, bool) -> None
+def _apply_geometry_operation(geom, operation, param=None):
+    # type: (ogr.Geometry, str, any) -> ogr.Geometry
     """
-    Buffer a vector file by a given distance
+    Apply one of the operations from GEOMETRY_OPERATIONS to a geometry
 
-    :param ds_name: Input file
-    :param dist: Buffer distance in map units (as defined within the spatial reference)
-    :param outfile: Output file
+    :param geom: Input geometry
+    :param operation: Name of the operation
+    :param param: Parameter of the operation (distance for "buffer", tolerance for "simplify" and
+            "simplify_topology")
+    :return: Resulting geometry
+    """
+    if operation == 'buffer':
+        return geom.Buffer(param)
+    elif operation == 'simplify':
+        return geom.Simplify(param)
+    elif operation == 'simplify_topology':
+        return geom.SimplifyPreserveTopology(param)
+    elif operation == 'make_valid':
+        if hasattr(geom, 'MakeValid'):
+            return geom.MakeValid()
+        return geom.Buffer(0)
+    elif operation == 'convex_hull':
+        return geom.ConvexHull()
+    elif operation == 'centroid':
+        return geom.Centroid()
+    raise ValueError('Unknown geometry operation {o}!'.format(o=operation))
+
+
+def _geometry_worker(args):
+    # type: (tuple) -> list
+    """
+    Apply a geometry operation to a chunk of features
+
+    :param args: Tuple of (chunk as returned by _wkb_chunks(), operation, parameter, geometric dimension of the output
+            or None). If a dimension is given, parts of other dimensions are dropped and the result is made multipart.
+    :return: Chunk with the resulting geometries and untouched attributes
+    """
+    chunk, operation, param, dimension = args
+    results = []
+    for wkb, attributes in chunk:
+        if wkb is not None:
+            geom = _apply_geometry_operation(ogr.CreateGeometryFromWkb(wkb), operation, param)
+            if dimension is not None:
+                geom = _keep_dimension(geom, dimension)
+                if geom is not None:
+                    geom = _force_multi(geom, dimension)
+            wkb = bytes(geom.ExportToWkb()) if geom is not None else None
+        results.append((wkb, attributes))
+    return results
+
+
+def geometry_operation(ds_name, outfile, operation, param=None, of=None, processes=None, chunk_size=1000,
+                       spatial_index=True, overwrite=False):
+    # type: (str, str, str, any, str, int, int, bool, bool) -> None
+    """
+    Apply a geometry operation to all features of a vector file. Features are sent to a pool of worker processes in
+    chunks and written back in their original order, including all of their attributes. Except for convex hulls and
+    centroids, the output geometries are multipart.
+
+    :param ds_name: Input filename
+    :param outfile: Output filename
+    :param operation: One of GEOMETRY_OPERATIONS: <br>
+        - buffer: Buffer by distance "param" (in map units) <br>
+        - simplify: Simplify within distance tolerance "param" <br>
+        - simplify_topology: Simplify within distance tolerance "param", preserving the topology <br>
+        - make_valid: Repair invalid geometries <br>
+        - convex_hull: Convex hull of each geometry <br>
+        - centroid: Centroid of each geometry
+    :param param: Parameter of the operation (see above)
+    :param of: Output format according to OGR driver standard. Defaults to the format of the input file.
+    :param processes: Number of worker processes. Defaults to the number of CPUs. Use 1 to run without a process pool.
+    :param chunk_size: Number of features sent to a worker process at once
+    :param spatial_index: Create a spatial index for the output file
     :param overwrite: Overwrite output file, if it already exists
     :return: --
     """
-    create_spatial_index(ds_name)
+    if operation not in GEOMETRY_OPERATIONS:
+        raise ValueError('Operation must be one of: {o}'.format(o=', '.join(GEOMETRY_OPERATIONS)))
+    if operation in ('buffer', 'simplify', 'simplify_topology') and param is None:
+        raise ValueError('Operation {o} requires a parameter!'.format(o=operation))
     ds = ogr.Open(ds_name, 0)
     lyr = ds.GetLayer()
-    drv = ds.GetDriver()
+    if not of:
+        of = ds.GetDriver().GetName()
+    # buffers, simplified and repaired geometries may have several parts (make_valid may even return collections of
+    # polygons and collapsed lines), so these are written as multipart geometries of one dimension
+    dimension = None
+    if operation == 'convex_hull':
+        geom_type = ogr.wkbPolygon
+    elif operation == 'centroid':
+        geom_type = ogr.wkbPoint
+    else:
+        dimension = 2 if operation == 'buffer' else _layer_dimension(lyr)
+        geom_type = _multi_type(dimension)
     srs = osr.SpatialReference()
     srs.ImportFromWkt(lyr.GetSpatialRef().ExportToWkt())
-    out_ds, out_lyr = create_ds(outfile, drv.GetName(), lyr.GetGeomType(), srs, overwrite)
-    defn = out_lyr.GetLayerDefn()
-    for feat in lyr:
-        geom = feat.GetGeometryRef()
-        geom_buff = geom.Buffer(dist)
-        out_feat = ogr.Feature(defn)
-        out_feat.SetGeometry(geom_buff)
-        out_lyr.CreateFeature(out_feat)
+    out_ds, out_lyr = create_ds(outfile, of, geom_type, srs, overwrite)
+    lyr_defn = lyr.GetLayerDefn()
+    for i in range(lyr_defn.GetFieldCount()):
+        out_lyr.CreateField(lyr_defn.GetFieldDefn(i))
+    tasks = ((chunk, operation, param, dimension) for chunk in _wkb_chunks(lyr, chunk_size))
+    if processes == 1:
+        pool = None
+        chunks = (_geometry_worker(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        chunks = bounded_imap(pool, _geometry_worker, tasks, 2 * (processes or multiprocessing.cpu_count()))
+    results = (item for chunk in chunks for item in chunk)
+    write_features(out_lyr, _features_from_wkb(results, out_lyr.GetLayerDefn()))
+    if pool:
+        pool.close()
+        pool.join()
     lyr = None
     ds = None
-    repack(out_ds, out_lyr)
     out_lyr = None
     out_ds = None
-    create_spatial_index(outfile)
+    if spatial_index:
+        create_spatial_index(outfile)
     return
 
 
-def simplify(ds_name, tolerance, outfile, overwrite=False):
-    # type: (str, int or float, str, bool) -> None
+def buffering(ds_name, dist, outfile, overwrite, processes=None):
+    # type: (str, int or float, str, bool, int) -> None
+    """
+    Buffer a vector file by a given distance
+
+    :param ds_name: Input file
+    :param dist: Buffer distance in map units (as defined within the spatial reference)
+    :param outfile: Output file
+    :param overwrite: Overwrite output file, if it already exists
+    :param processes: Number of worker processes. Defaults to the number of CPUs.
+    :return: --
+    """
+    geometry_operation(ds_name, outfile, 'buffer', dist, processes=processes, overwrite=overwrite)
+    return
+
+
+def simplify(ds_name, tolerance, outfile, overwrite=False, processes=None):
+    # type: (str, int or float, str, bool, int) -> None
     """
     Simplify the geometries of a vector file within a given distance tolerance
 
@@ -725,111 +1394,364 @@ def simplify(ds_name, tolerance, outfile, overwrite=False):
     :param tolerance: Distance tolerance for simplification
     :param outfile: Output filename
     :param overwrite: Overwrite output file, if it already exists
+    :param processes: Number of worker processes. Defaults to the number of CPUs.
     :return: --
     """
-    create_spatial_index(ds_name)
+    geometry_operation(ds_name, outfile, 'simplify', tolerance, processes=processes, overwrite=overwrite)
+    return
+
+
+def _union_wkbs(wkbs):
+    # type: (list) -> bytes or None
+    """
+    Union a list of (multi)polygon WKB geometries
+
+    :param wkbs: List of WKB geometries
+    :return: WKB of the union or None, if there is nothing to union
+    """
+    multi = ogr.Geometry(ogr.wkbMultiPolygon)
+    for wkb in wkbs:
+        geom = ogr.CreateGeometryFromWkb(wkb)
+        if ogr.GT_Flatten(geom.GetGeometryType()) == ogr.wkbPolygon:
+            multi.AddGeometry(geom)
+        else:
+            for i in range(geom.GetGeometryCount()):
+                part = geom.GetGeometryRef(i)
+                if ogr.GT_Flatten(part.GetGeometryType()) == ogr.wkbPolygon:
+                    multi.AddGeometry(part)
+    if multi.GetGeometryCount() == 0:
+        return None
+    return bytes(multi.UnionCascaded().ExportToWkb())
+
+
+def _dissolve_tile_worker(args):
+    # type: (tuple) -> tuple
+    """
+    Union the given features of one group and tile
+
+    :param args: Tuple of (input file, group value, (column, row), list of FIDs)
+    :return: Tuple of (group value, (column, row), WKB of the union or None)
+    """
+    ds_name, value, tile, fids = args
     ds = ogr.Open(ds_name, 0)
     lyr = ds.GetLayer()
-    out_ds, out_lyr = create_ds(outfile, ds.GetDriver().GetName(), lyr.GetGeomType(), lyr.GetSpatialRef(), overwrite)
-    defn = out_lyr.GetLayerDefn()
-    for feat in lyr:
+    wkbs = []
+    for fid in fids:
+        feat = lyr.GetFeature(fid)
         geom = feat.GetGeometryRef()
-        geom_buff = geom.Simplify(tolerance)
-        out_feat = ogr.Feature(defn)
-        out_feat.SetGeometry(geom_buff)
-        out_lyr.CreateFeature(out_feat)
+        geom.CloseRings()
+        wkbs.append(bytes(geom.ExportToWkb()))
+        feat = None
     lyr = None
     ds = None
-    repack(out_ds, out_lyr)
-    out_lyr = None
-    out_ds = None
-    create_spatial_index(outfile)
-    return
+    return value, tile, _union_wkbs(wkbs)
+
+
+def _dissolve_tiles(lyr, group_field, tiles):
+    # type: (ogr.Layer, str, int) -> dict
+    """
+    Assign each feature to the tile that holds the centre of its bounding box. Only the envelope is used, so features
+    whose geometry does not touch that tile (e.g. L- or ring-shaped polygons) are assigned as well.
+
+    :param lyr: Input layer
+    :param group_field: Attribute field to group by or None
+    :param tiles: Number of tiles along each axis
+    :return: Dictionary of (group value, (column, row)) as keys and lists of FIDs as values
+    """
+    xmin, xmax, ymin, ymax = lyr.GetExtent()
+    x_step = (xmax - xmin) / tiles
+    y_step = (ymax - ymin) / tiles
+    defn = lyr.GetLayerDefn()
+    index = lyr.FindFieldIndex(group_field, 1) if group_field else -1
+    lyr.SetIgnoredFields([defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount()) if i != index] +
+                         ['OGR_STYLE'])
+    groups = {}
+    lyr.ResetReading()
+    for feat in lyr:
+        geom = feat.GetGeometryRef()
+        if geom is None:
+            continue
+        gxmin, gxmax, gymin, gymax = geom.GetEnvelope()
+        col = min(int(((gxmin + gxmax) / 2. - xmin) / x_step), tiles - 1) if x_step > 0 else 0
+        row = min(int(((gymin + gymax) / 2. - ymin) / y_step), tiles - 1) if y_step > 0 else 0
+        value = feat.GetField(index) if index >= 0 else None
+        groups.setdefault((value, (max(col, 0), max(row, 0))), []).append(feat.GetFID())
+    lyr.SetIgnoredFields([])
+    return groups
+
+
+def _dissolve_merge_worker(args):
+    # type: (tuple) -> tuple
+    """
+    Union the results of neighbouring tiles into the tile of the next coarser level
+
+    :param args: Tuple of (group value, (column, row) of the coarser tile, list of WKB geometries)
+    :return: Tuple of (group value, (column, row), WKB of the union or None)
+    """
+    value, tile, wkbs = args
+    return value, tile, _union_wkbs(wkbs)
 
 
-def dissolve(ds_name, outfile, multipoly=False, overwrite=False):
-    # type: (str, str, bool, bool) -> None
+def dissolve(ds_name, outfile, multipoly=False, overwrite=False, group_field=None, tiles=None, processes=None):
+    # type: (str, str, bool, bool, str, int, int) -> None
     """
-    Dissolve a vector file
+    Dissolve a vector file. The layer extent is split into tiles which are dissolved in parallel, then neighbouring
+    tiles are merged level by level (2x2 tiles at once) until one geometry per group is left.
 
     :param ds_name: Input filename
     :param outfile: Output filename
     :param multipoly: True for multipart polygon, False for many singlepart polygons
     :param overwrite: Overwrite output file, if it already exists
+    :param group_field: Attribute field to dissolve by. One output geometry is created per unique value, which is
+            kept as attribute. If None, all features are dissolved together.
+    :param tiles: Number of tiles along each axis. Defaults to roughly 5000 features per tile.
+    :param processes: Number of worker processes. Defaults to the number of CPUs.
     :return: --
     """
-    create_spatial_index(ds_name)
     ds = ogr.Open(ds_name, 0)
     lyr = ds.GetLayer()
-    out_ds, out_lyr = create_ds(outfile, ds.GetDriver().GetName(), lyr.GetGeomType(), lyr.GetSpatialRef(), overwrite)
+    if group_field and lyr.FindFieldIndex(group_field, 1) < 0:
+        raise AttributeError('Desired field {f} does not exist!'.format(f=group_field))
+    if not tiles:
+        tiles = max(1, int(math.ceil(math.sqrt(lyr.GetFeatureCount() / 5000.))))
+    groups = _dissolve_tiles(lyr, group_field, tiles)
+    geom_type = lyr.GetGeomType() if multipoly is True else ogr.wkbMultiPolygon
+    out_ds, out_lyr = create_ds(outfile, ds.GetDriver().GetName(), geom_type, lyr.GetSpatialRef(), overwrite)
+    if group_field:
+        out_lyr.CreateField(lyr.GetLayerDefn().GetFieldDefn(lyr.FindFieldIndex(group_field, 1)))
     defn = out_lyr.GetLayerDefn()
-    multi = ogr.Geometry(ogr.wkbMultiPolygon)
-    for feat in lyr:
-        if feat.geometry():
-            feat.geometry().CloseRings()
-            wkt = feat.geometry().ExportToWkt()
-            multi.AddGeometryDirectly(ogr.CreateGeometryFromWkt(wkt))
-    union = multi.UnionCascaded()
-    if multipoly is True:
-        for geom in union:
-            poly = ogr.CreateGeometryFromWkb(geom.ExportToWkb())
-            feat = ogr.Feature(defn)
-            feat.SetGeometry(poly)
-            out_lyr.CreateFeature(feat)
-            feat = None
-    else:
-        out_feat = ogr.Feature(defn)
-        out_feat.SetGeometry(union)
-        out_lyr.CreateFeature(out_feat)
-        out_lyr = None
-        out_ds = None
-    repack(out_ds, out_lyr)
     lyr = None
     ds = None
+    tasks = [(ds_name, value, tile, fids) for (value, tile), fids in groups.items()]
+    pool = multiprocessing.Pool(processes)
+    results = pool.map(_dissolve_tile_worker, tasks)
+    # merge tiles hierarchically
+    while True:
+        levels = {}
+        for value, (col, row), wkb in results:
+            if wkb is not None:
+                levels.setdefault((value, (col // 2, row // 2)), []).append(wkb)
+        if all(tile == (0, 0) for value, tile in levels.keys()) and all(
+                len(wkbs) == 1 for wkbs in levels.values()):
+            results = [(value, tile, wkbs[0]) for (value, tile), wkbs in levels.items()]
+            break
+        results = pool.map(_dissolve_merge_worker, [(value, tile, wkbs) for (value, tile), wkbs in levels.items()])
+    pool.close()
+    pool.join()
+    features = []
+    for value, tile, wkb in results:
+        union = ogr.CreateGeometryFromWkb(wkb)
+        if multipoly is True:
+            if ogr.GT_Flatten(union.GetGeometryType()) == ogr.wkbPolygon:
+                parts = [union]
+            else:
+                parts = [union.GetGeometryRef(i).Clone() for i in range(union.GetGeometryCount())]
+        else:
+            parts = [ogr.ForceToMultiPolygon(union)]
+        for part in parts:
+            feat = ogr.Feature(defn)
+            feat.SetGeometry(part)
+            if group_field and value is not None:
+                feat.SetField(0, value)
+            features.append(feat)
+    write_features(out_lyr, features)
+    out_lyr = None
+    out_ds = None
     create_spatial_index(outfile)
     return
 
 
-def rasterize_vector(ds_name, field, outfile, resolution, dtype, no_data, of='GTiff', co=None, overwrite=False):
-    # type: (str, str, str, int, str, int or float, str, list, bool) -> None
+def _rasterize_tile(args):
+    # type: (tuple) -> tuple
     """
-    Rasterize a vector layer
+    Rasterize all features of a layer that fall into one tile of the output grid into an in-memory raster
+
+    :param args: Tuple of (input vector file, attribute field or None, burn value, all touched, (xoff, yoff, xsize,
+            ysize) of the tile, output geotransform, output projection as WKT, GDAL data type, NoData value)
+    :return: Tuple of (xoff, yoff, array or None, if no feature touches the tile)
+    """
+    ds_name, field, burn_value, all_touched, window, geotrans, proj, dtype, no_data = args
+    xoff, yoff, xsize, ysize = window
+    tile_geotrans = (geotrans[0] + xoff * geotrans[1], geotrans[1], 0, geotrans[3] + yoff * geotrans[5], 0,
+                     geotrans[5])
+    xmin = tile_geotrans[0]
+    xmax = xmin + xsize * geotrans[1]
+    ymax = tile_geotrans[3]
+    ymin = ymax + ysize * geotrans[5]
+    ds = ogr.Open(ds_name, 0)
+    lyr = ds.GetLayer()
+    tile = ogr.CreateGeometryFromWkt('POLYGON (({x0} {y0}, {x1} {y0}, {x1} {y1}, {x0} {y1}, {x0} {y0}))'.format(
+        x0=xmin, x1=xmax, y0=ymin, y1=ymax))
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(proj)
+    lyr_srs = lyr.GetSpatialRef()
+    if lyr_srs is not None and not srs.IsSame(lyr_srs):
+        lyr_srs = lyr_srs.Clone()
+        for s in (srs, lyr_srs):
+            if hasattr(s, 'SetAxisMappingStrategy'):
+                s.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        tile.AssignSpatialReference(srs)
+        tile.TransformTo(lyr_srs)
+    lyr.SetSpatialFilter(tile)
+    if lyr.GetFeatureCount() == 0:
+        return xoff, yoff, None
+    mem_ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, dtype)
+    mem_ds.SetGeoTransform(tile_geotrans)
+    mem_ds.SetProjection(proj)
+    mem_ds.GetRasterBand(1).Fill(no_data)
+    options = ['ALL_TOUCHED={t}'.format(t='TRUE' if all_touched else 'FALSE')]
+    if field:
+        options.append('ATTRIBUTE={f}'.format(f=field))
+        gdal.RasterizeLayer(mem_ds, [1], lyr, options=options)
+    else:
+        gdal.RasterizeLayer(mem_ds, [1], lyr, burn_values=[burn_value], options=options)
+    data = mem_ds.GetRasterBand(1).ReadAsArray()
+    mem_ds = None
+    lyr = None
+    ds = None
+    return xoff, yoff, data
+
+
+def rasterize_vector(ds_name, field, outfile, resolution=None, dtype='Float32', no_data=0, of='GTiff', co=None,
+                     overwrite=False, reference=None, burn_value=1, all_touched=True, tile_size=2048, processes=None):
+    # type: (str, str, str, int or float, str, int or float, str, list, bool, str, int or float, bool, int, int) -> None
+    """
+    Rasterize a vector layer. The output grid is either taken from a reference raster or aligned to multiples of the
+    resolution (like gdal_rasterize -tap), so that no edges get lost. Large outputs are rasterized in tiles by a pool
+    of worker processes, each of them only reading the features within its tile.
 
     :param ds_name: Input vector file name
-    :param field: Attribute field that shall be converted to raster values
+    :param field: Attribute field that shall be converted to raster values. If None, "burn_value" is used.
     :param outfile: Output file name
-    :param resolution: Output resolution
+    :param resolution: Output resolution. Not needed if "reference" is given.
     :param dtype: Output data type. One of (Byte, UInt16, Int16, UInt32, Int32, Float32, Float64, CInt16, CInt32,
             CFloat32, CFloat64)
     :param no_data: NoData value for output raster
     :param of: Output format as defined at http://www.gdal.org/formats_list.html
-    :param co: Advanced raster creation options such as band interleave or compression. <br<>
+    :param co: Advanced raster creation options such as band interleave or compression. Defaults to a tiled and
+            compressed output for GTiff. <br>
             Example: co=['compress=lzw']
     :param overwrite: Overwrite output file if it already exists
+    :param reference: Reference raster whose grid (extent, resolution and projection) shall be used for the output
+    :param burn_value: Value burned into the raster for all features, if no "field" is given
+    :param all_touched: Burn all pixels touched by a feature (True) or only those whose centre is within it (False)
+    :param tile_size: Edge length of the tiles (in pixels) that are rasterized separately
+    :param processes: Number of worker processes. Defaults to the number of CPUs. Use 1 to run without a process pool.
     :return: --
     """
     ds_shp = ogr.Open(ds_name)
     lyr = ds_shp.GetLayer()
-    proj = lyr.GetSpatialRef()
-    lyr = None
-    ds_shp = None
-    xmin, ymin, xmax, ymax = get_extent(ds_name)
-    geotrans = (xmin, resolution, 0, ymax, 0, -resolution)
-    cols = int((xmax - xmin) / resolution)
-    rows = int((ymax - ymin) / resolution)
-    ds = raster_tools.create_ds(outfile, cols, rows, 1, gdal.GetDataTypeByName(dtype), of=of, co=co, overwrite=overwrite)
+    if field and lyr.FindFieldIndex(field, 1) < 0:
+        raise AttributeError('Desired field {f} does not exist!'.format(f=field))
+    if reference:
+        cols, rows, _bandnum, _dtype, proj, geotrans = raster_tools.get_raster_properties(reference)
+    elif resolution:
+        xmin, xmax, ymin, ymax = lyr.GetExtent()
+        xmin = math.floor(xmin / resolution) * resolution
+        xmax = math.ceil(xmax / resolution) * resolution
+        ymin = math.floor(ymin / resolution) * resolution
+        ymax = math.ceil(ymax / resolution) * resolution
+        geotrans = (xmin, resolution, 0, ymax, 0, -resolution)
+        cols = max(1, int(round((xmax - xmin) / resolution)))
+        rows = max(1, int(round((ymax - ymin) / resolution)))
+        proj = lyr.GetSpatialRef().ExportToWkt()
+    else:
+        raise ValueError('Either "resolution" or "reference" must be given!')
+    if co is None and of == 'GTiff':
+        co = ['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+    gdal_dtype = gdal.GetDataTypeByName(dtype)
+    ds = raster_tools.create_ds(outfile, cols, rows, 1, gdal_dtype, of=of, co=co, overwrite=overwrite)
     ds.SetGeoTransform(geotrans)
-    ds.SetProjection(proj.ExportToWkt())
-    gdal.RasterizeLayer(ds, [1], lyr, options=['ALL_TOUCHED=TRUE', 'ATTRIBUTE={f}'.format(f=field)])
-    ds.GetRasterBand(1).SetNoDataValue(no_data)
+    ds.SetProjection(proj)
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(no_data)
+    tasks = []
+    for yoff in range(0, rows, tile_size):
+        for xoff in range(0, cols, tile_size):
+            window = (xoff, yoff, min(tile_size, cols - xoff), min(tile_size, rows - yoff))
+            tasks.append((ds_name, field, burn_value, all_touched, window, geotrans, proj, gdal_dtype, no_data))
+    if processes == 1:
+        pool = None
+        tiles = (_rasterize_tile(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        tiles = bounded_imap(pool, _rasterize_tile, tasks, 2 * (processes or multiprocessing.cpu_count()))
+    windows = {(task[4][0], task[4][1]): task[4] for task in tasks}
+    for xoff, yoff, data in tqdm(tiles, total=len(tasks), desc='Rasterizing tiles'):
+        if data is None:
+            _xoff, _yoff, xsize, ysize = windows[(xoff, yoff)]
+            data = np.full((ysize, xsize), no_data, dtype=gdal_array.GDALTypeCodeToNumericTypeCode(gdal_dtype))
+        band.WriteArray(data, xoff, yoff)
+    if pool:
+        pool.close()
+        pool.join()
+    band = None
     ds = None
+    lyr = None
+    ds_shp = None
     return
 
 
+def _execute_sql(ds, sql):
+    # type: (ogr.DataSource, str) -> ogr.Layer or None
+    """
+    Execute an SQL statement with the native dialect of SQL capable formats (see SQL_DRIVERS) or with the SQLite dialect
+    of OGR otherwise, which works on layers of any format
+
+    :param ds: Input dataset
+    :param sql: SQL statement
+    :return: Result set (to be released with ds.ReleaseResultSet()) or None, if the statement failed (e.g. GDAL built
+            without SQLite)
+    """
+    dialect = '' if ds.GetDriver().GetName() in SQL_DRIVERS else 'SQLite'
+    try:
+        return ds.ExecuteSQL(sql, dialect=dialect)
+    except RuntimeError:
+        return None
+
+
+def _read_columns(lyr, fields):
+    # type: (ogr.Layer, list) -> list
+    """
+    Read whole attribute columns of a layer, skipping the geometry and all other fields while reading. This is the
+    fallback for datasets where _execute_sql() fails.
+
+    :param lyr: Input layer
+    :param fields: List of field names
+    :return: List of lists of attribute values (one per field)
+    """
+    defn = lyr.GetLayerDefn()
+    wanted = [f.lower() for f in fields]
+    ignored = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())
+               if defn.GetFieldDefn(i).GetName().lower() not in wanted]
+    lyr.SetIgnoredFields(ignored + ['OGR_GEOMETRY', 'OGR_STYLE'])
+    indices = [lyr.FindFieldIndex(f, 1) for f in fields]
+    columns = [[] for _f in fields]
+    lyr.ResetReading()
+    for feat in lyr:
+        for column, index in zip(columns, indices):
+            column.append(feat.GetField(index))
+    lyr.SetIgnoredFields([])
+    return columns
+
+
+def _to_python(value):
+    # type: (any) -> any
+    """
+    Convert a NumPy scalar into its Python equivalent
+
+    :param value: NumPy scalar (or any other value)
+    :return: Python value
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
 def get_unique_attributes(ds_name, field, show=False):
     # type: (str, str, bool) -> dict
     """
-    Return a dictionary of unique attribute values for the given attribute field and their respective occurrence counts
+    Return a dictionary of unique attribute values for the given attribute field and their respective occurrence counts.
+    The counting is done by one GROUP BY statement (see _execute_sql()). Only if that fails, the given attribute column
+    is read and counted with NumPy.
 
     :param ds_name: Input dataset
     :param field: Attribute field
@@ -840,12 +1762,23 @@ def get_unique_attributes(ds_name, field, show=False):
     lyr = ds.GetLayer()
     if lyr.FindFieldIndex(field, 1) < 0:
         raise AttributeError('Desired field {f} does not exist!'.format(f=field))
-    attributes = [f.GetField(field) for f in lyr]
-    out_dict = dict(Counter(attributes))
+    result = _execute_sql(ds, 'SELECT "{f}", COUNT(*) FROM "{l}" GROUP BY "{f}"'.format(f=field, l=lyr.GetName()))
+    if result is not None:
+        out_dict = {feat.GetField(0): feat.GetField(1) for feat in result}
+        ds.ReleaseResultSet(result)
+    else:
+        attributes = _read_columns(lyr, [field])[0]
+        out_dict = {}
+        if None in attributes:
+            out_dict[None] = attributes.count(None)
+            attributes = [a for a in attributes if a is not None]
+        if attributes:
+            values, counts = np.unique(np.array(attributes), return_counts=True)
+            out_dict.update({_to_python(v): int(c) for v, c in zip(values, counts)})
     lyr = None
     ds = None
     if show is True:
-        print('Total number of features: {n}'.format(n=len(attributes)))
+        print('Total number of features: {n}'.format(n=sum(out_dict.values())))
         print('Unique values for field {f}: {n}'.format(f=field, n=len(out_dict.keys())))
         print(''.join(['Attribute', '\t', 'Count', '\n']))
         for k in sorted(out_dict.keys()):
@@ -856,7 +1789,8 @@ def get_unique_attributes(ds_name, field, show=False):
 def attribute_mapping(ds_name, field, map_field, show=False):
     # type: (str, str, str, bool) -> dict
     """
-    Get a dictionary of attributes and the corresponding attribute for each feature
+    Get a dictionary of attributes and the corresponding attribute for each feature. The mapping is done by one GROUP
+    BY statement (see _execute_sql()). Only if that fails, the two attribute columns are read and mapped with NumPy.
 
     :param ds_name: Input file
     :param field: Main attribute field
@@ -868,16 +1802,23 @@ def attribute_mapping(ds_name, field, map_field, show=False):
     lyr = ds.GetLayer()
     if lyr.FindFieldIndex(field, 1) < 0 or lyr.FindFieldIndex(map_field, 1) < 0:
         raise AttributeError('Desired field {f} does not exist!'.format(f=field))
-    out_dict = {}
-    for feature in lyr:
-        key = str(feature.GetField(field))
-        value = feature.GetField(map_field)
-        if key not in out_dict.keys():
-            out_dict[key] = value
+    # SQLite takes the bare column "map_field" from the row holding the minimum FID, i.e. the first occurrence
+    fid_column = lyr.GetFIDColumn() or 'rowid'
+    result = _execute_sql(ds, 'SELECT "{f}", "{m}", MIN("{fid}") FROM "{l}" GROUP BY "{f}"'.format(
+        f=field, m=map_field, fid=fid_column, l=lyr.GetName()))
+    if result is not None:
+        out_dict = {str(feat.GetField(0)): feat.GetField(1) for feat in result}
+        ds.ReleaseResultSet(result)
+    else:
+        keys, values = _read_columns(lyr, [field, map_field])
+        out_dict = {}
+        if keys:
+            unique_keys, first = np.unique(np.array([str(k) for k in keys]), return_index=True)
+            out_dict = {_to_python(k): values[i] for k, i in zip(unique_keys, first)}
     lyr = None
     ds = None
     if show is True:
-        print 'Attribute', '\t', 'Mapped Value', '\n'
+        print('\t'.join(['Attribute', 'Mapped Value', '\n']))
         for k in sorted(out_dict.keys()):
-            print k, '\t', out_dict[k]
+            print('\t'.join([str(k), str(out_dict[k])]))
     return out_dict
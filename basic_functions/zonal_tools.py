@@ -0,0 +1,246 @@
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+
+"""
+------
+NOTES:
+------
+Statistics of a raster within polygons (zones) are calculated with one of two strategies:
+
+"grid": rasterize all polygons into one in-memory ID grid covering their extent and aggregate in one grouped pass
+"window": rasterize and read the bounding box of each polygon separately
+
+An ID grid holds only one polygon per pixel, so polygons sharing pixels with others are sampled by their own windows in
+both strategies. This way, the choice of the strategy only affects the runtime, never the results.
+"""
+
+# rough cost model for the choice of the strategy
+COST_READ = 1e-9            # seconds per byte read from the image
+COST_PIXEL = 5e-9           # seconds per pixel rasterized or aggregated
+COST_POLYGON = 5e-4         # seconds of overhead per polygon window (MEM datasets, rasterization)
+MAX_GRID_MEMORY = 2 ** 31   # bytes the ID grid strategy may use
+
+# accepted names of the statistics of grouped_statistics
+STATISTICS = {'median': 'median',
+              'med': 'median',
+              'mean': 'mean',
+              'min': 'min',
+              'max': 'max',
+              'majority': 'majority',
+              'stdv': 'std',
+              'std': 'std'}
+
+
+def pixel_windows(envelopes, geotrans, cols, rows):
+    # type: (np.ndarray, tuple, int, int) -> np.ndarray
+    """
+    Convert polygon envelopes (x_min, x_max, y_min, y_max) to pixel windows (xoff, yoff, cols, rows) within a raster
+
+    :param envelopes: Envelopes as returned by ogr.Geometry.GetEnvelope()
+    :param geotrans: Geotransform of the raster
+    :param cols: Number of columns of the raster
+    :param rows: Number of rows of the raster
+    :return: Array of shape (polygons, 4)
+    """
+    envelopes = np.asarray(envelopes, dtype=float).reshape(-1, 4)
+    x0 = np.clip(np.floor((envelopes[:, 0] - geotrans[0]) / geotrans[1]), 0, cols - 1)
+    x1 = np.clip(np.ceil((envelopes[:, 1] - geotrans[0]) / geotrans[1]), 0, cols)
+    y0 = np.clip(np.floor((envelopes[:, 3] - geotrans[3]) / geotrans[5]), 0, rows - 1)
+    y1 = np.clip(np.ceil((envelopes[:, 2] - geotrans[3]) / geotrans[5]), 0, rows)
+    return np.column_stack((x0, y0, np.maximum(x1 - x0, 1), np.maximum(y1 - y0, 1))).astype(np.int64)
+
+
+def plan_strategy(ds, windows, bands=1, threads=1):
+    # type: (gdal.Dataset, np.ndarray, int, int) -> (str, dict)
+    """
+    Estimate I/O, memory and runtime of both strategies from the polygon windows, the raster grid and its block size,
+    and pick the cheaper one. The ID grid strategy is only chosen if its memory footprint stays below MAX_GRID_MEMORY.
+
+    :param ds: Raster dataset
+    :param windows: Pixel windows (xoff, yoff, cols, rows) of the polygons
+    :param bands: Number of bands to read
+    :param threads: Number of threads reading windows in parallel
+    :return: Chosen strategy ("grid" or "window") and the estimates of both strategies ("pixels", "blocks", "read" and
+        "memory" in bytes, "seconds") as dictionary
+    """
+    band = ds.GetRasterBand(1)
+    block_x, block_y = band.GetBlockSize()
+    itemsize = gdal.GetDataTypeSize(band.DataType) // 8
+    band = None
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+    if len(windows) == 0:
+        windows = np.zeros((1, 4), dtype=np.int64)
+    x0 = windows[:, 0]
+    y0 = windows[:, 1]
+    x1 = x0 + windows[:, 2]
+    y1 = y0 + windows[:, 3]
+    block_bytes = block_x * block_y * itemsize * bands
+    # grid: one ID grid and one coverage grid over the extent of all polygons, all blocks within it are read
+    grid_pixels = int((x1.max() - x0.min()) * (y1.max() - y0.min()))
+    grid_blocks = int((-(-x1.max() // block_x) - x0.min() // block_x) * (-(-y1.max() // block_y) - y0.min() // block_y))
+    grid = {'pixels': grid_pixels,
+            'blocks': grid_blocks,
+            'read': grid_blocks * block_bytes,
+            'memory': grid_pixels * (4 + 4 + 1 + itemsize + 8)}
+    grid['seconds'] = grid['read'] * COST_READ + grid_pixels * COST_PIXEL * (2 + bands)
+    # window: blocks touched by each window, mostly served from the block cache when the windows are spatially sorted
+    window_pixels = int((windows[:, 2] * windows[:, 3]).sum())
+    window_blocks = int(min(((-(-x1 // block_x) - x0 // block_x) * (-(-y1 // block_y) - y0 // block_y)).sum(),
+                            grid_blocks))
+    window = {'pixels': window_pixels,
+              'blocks': window_blocks,
+              'read': window_blocks * block_bytes,
+              'memory': int((windows[:, 2] * windows[:, 3]).max()) * (1 + itemsize * bands) * threads}
+    window['seconds'] = window['read'] * COST_READ + (window_pixels * COST_PIXEL * (1 + bands) +
+                                                     len(windows) * COST_POLYGON) / threads
+    if grid['memory'] <= MAX_GRID_MEMORY and grid['seconds'] <= window['seconds']:
+        strategy = 'grid'
+    else:
+        strategy = 'window'
+    return strategy, {'grid': grid, 'window': window}
+
+
+def print_estimates(estimates, strategy):
+    # type: (dict, str) -> None
+    """
+    Print the estimates of plan_strategy() as table, followed by the chosen strategy
+    """
+    print('{s:<10}{p:>16}{b:>12}{r:>14}{m:>14}{t:>12}'.format(s='Strategy', p='Pixels', b='Blocks', r='Read (MB)',
+                                                              m='Memory (MB)', t='Time (s)'))
+    for name in ('grid', 'window'):
+        e = estimates[name]
+        print('{s:<10}{p:>16}{b:>12}{r:>14.1f}{m:>14.1f}{t:>12.1f}'.format(
+            s=name, p=e['pixels'], b=e['blocks'], r=e['read'] / 1024. ** 2, m=e['memory'] / 1024. ** 2,
+            t=e['seconds']))
+    print('Chosen strategy: {s}'.format(s=strategy))
+
+
+def rasterize_window(ds, window, wkbs, values=None, add=False):
+    # type: (gdal.Dataset, tuple, list, list, bool) -> np.ndarray
+    """
+    Rasterize geometries (WKB) into an in-memory grid aligned to a raster window
+
+    :param ds: Raster dataset
+    :param window: Pixel window (xoff, yoff, cols, rows) within the raster
+    :param wkbs: Geometries as WKB, in the spatial reference system of the raster
+    :param values: Values to burn, one per geometry. Defaults to 1 for all geometries.
+    :param add: Add up the values of overlapping geometries instead of keeping the last one
+    :return: Int32 array of shape (rows, cols), 0 outside of all geometries
+    """
+    xoff, yoff, cols, rows = [int(w) for w in window]
+    geotrans = ds.GetGeoTransform()
+    ds_mem = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Int32)
+    ds_mem.SetGeoTransform((geotrans[0] + xoff * geotrans[1], geotrans[1], 0., geotrans[3] + yoff * geotrans[5], 0.,
+                            geotrans[5]))
+    ds_mem.SetProjection(ds.GetProjection())
+    ds_vec = ogr.GetDriverByName('Memory').CreateDataSource('')
+    lyr = ds_vec.CreateLayer('zones', osr.SpatialReference(wkt=ds.GetProjection()), ogr.wkbUnknown)
+    lyr.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+    for i, wkb in enumerate(wkbs):
+        feat = ogr.Feature(lyr.GetLayerDefn())
+        feat.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
+        feat.SetField(0, int(values[i]) if values is not None else 1)
+        lyr.CreateFeature(feat)
+        feat = None
+    options = ['ATTRIBUTE=zone']
+    if add:
+        options.append('MERGE_ALG=ADD')
+    gdal.RasterizeLayer(ds_mem, [1], lyr, options=options)
+    array = ds_mem.GetRasterBand(1).ReadAsArray()
+    lyr = None
+    ds_vec = None
+    ds_mem = None
+    return array
+
+
+def rasterize_zones(ds, windows, wkbs):
+    # type: (gdal.Dataset, np.ndarray, list) -> (np.ndarray, int, int, np.ndarray)
+    """
+    Rasterize sequential IDs (1 ... n, 0 being background) of the polygons into an in-memory grid, aligned to the raster
+    and covering only the extent of the polygons. Where polygons overlap, the grid only holds one of them, so all
+    polygons whose windows contain a pixel covered more than once are flagged; they have to be sampled separately.
+
+    :param ds: Raster dataset
+    :param windows: Pixel windows (xoff, yoff, cols, rows) of the polygons
+    :param wkbs: Polygon geometries as WKB, in the spatial reference system of the raster
+    :return: ID grid (ID i belongs to polygon i - 1), its pixel offset (xoff, yoff) within the raster and a boolean
+        array, True for the flagged polygons
+    """
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+    if len(wkbs) == 0:
+        return np.zeros((0, 0), dtype=np.int32), 0, 0, np.zeros(0, dtype=bool)
+    xoff = int(windows[:, 0].min())
+    yoff = int(windows[:, 1].min())
+    cols = int((windows[:, 0] + windows[:, 2]).max()) - xoff
+    rows = int((windows[:, 1] + windows[:, 3]).max()) - yoff
+    ids = rasterize_window(ds, (xoff, yoff, cols, rows), wkbs, range(1, len(wkbs) + 1))
+    shared = rasterize_window(ds, (xoff, yoff, cols, rows), wkbs, add=True) > 1
+    overlapping = np.zeros(len(wkbs), dtype=bool)
+    if shared.any():
+        # count the shared pixels within each window from a summed-area table
+        table = np.zeros((rows + 1, cols + 1), dtype=np.int64)
+        table[1:, 1:] = shared.cumsum(axis=0).cumsum(axis=1)
+        x0 = windows[:, 0] - xoff
+        y0 = windows[:, 1] - yoff
+        x1 = x0 + windows[:, 2]
+        y1 = y0 + windows[:, 3]
+        overlapping = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0] > 0
+    return ids, xoff, yoff, overlapping
+
+
+def grouped_statistics(zones, data, count, mode):
+    # type: (np.ndarray, np.ndarray, int, str) -> np.ndarray
+    """
+    Calculate a statistic of many zones at once, with one bincount (mean, std) or one sort (all others) in total
+
+    :param zones: Zone index (0 ... count - 1) of each value
+    :param data: Values
+    :param count: Number of zones
+    :param mode: One of: median (med), mean, min, max, majority, std (stdv). Majority works on integers, other values
+        are truncated.
+    :return: Statistic per zone, NaN for zones without any value
+    """
+    mode = STATISTICS.get(mode)
+    values = np.full(count, np.nan)
+    # e.g. polygons covering only NoData pixels
+    if mode is None or len(zones) == 0:
+        return values
+    sizes = np.bincount(zones, minlength=count)
+    filled = sizes > 0
+    if mode in ('mean', 'std'):
+        data = data.astype(float)
+        means = np.bincount(zones, weights=data, minlength=count)[filled] / sizes[filled]
+        if mode == 'mean':
+            values[filled] = means
+        else:
+            mean = np.zeros(count)
+            mean[filled] = means
+            squares = np.bincount(zones, weights=(data - mean[zones]) ** 2, minlength=count)
+            values[filled] = np.sqrt(squares[filled] / sizes[filled])
+        return values
+    if mode == 'majority':
+        data = data.astype(np.int64)
+    # sort by zone, then by value
+    order = np.lexsort((data, zones))
+    zones = zones[order]
+    data = data[order]
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))[filled]
+    ends = starts + sizes[filled] - 1
+    if mode == 'min':
+        values[filled] = data[starts]
+    elif mode == 'max':
+        values[filled] = data[ends]
+    elif mode == 'median':
+        values[filled] = (data[starts + (ends - starts) // 2].astype(float) +
+                          data[starts + (ends - starts + 1) // 2]) / 2.
+    else:
+        # longest run of equal values per zone, on ties the smallest value (like numpy.bincount(...).argmax())
+        run_starts = np.flatnonzero(np.concatenate(([True], (zones[1:] != zones[:-1]) | (data[1:] != data[:-1]))))
+        run_lengths = np.diff(np.append(run_starts, len(data)))
+        run_zones = zones[run_starts]
+        run_values = data[run_starts]
+        order = np.lexsort((run_values, -run_lengths, run_zones))
+        first = np.concatenate(([True], run_zones[order][1:] != run_zones[order][:-1]))
+        values[run_zones[order][first]] = run_values[order][first]
+    return values
@@ -3,11 +3,237 @@ import sys
 import time
 import datetime
 import math
+import multiprocessing
+import numpy as np
 from osgeo import gdal, ogr, osr
 from optparse import OptionParser, OptionGroup
 
+from basic_functions.pool_tools import bounded_imap
+
 gdal.UseExceptions()
 
+# layer creation options that give each output format a built-in spatial index
+LAYER_CREATION_OPTIONS = {
+    'FlatGeobuf': ['SPATIAL_INDEX=YES'],
+    'GPKG': ['SPATIAL_INDEX=YES'],
+    'Parquet': ['GEOMETRY_ENCODING=WKB']
+}
+# bounding box columns (used like a spatial index by Parquet readers) are only available since GDAL 3.9
+if int(gdal.VersionInfo()) >= 3090000:
+    LAYER_CREATION_OPTIONS['Parquet'] += ['WRITE_COVERING_BBOX=YES', 'SORT_BY_BBOX=YES']
+
+# little endian WKB record of a polygon with one ring of five points
+WKB_POLYGON = np.dtype([('byte_order', 'u1'), ('wkb_type', '<u4'), ('num_rings', '<u4'), ('num_points', '<u4'),
+                        ('coords', '<f8', (10,))])
+
+
+def cells_to_wkb(x_min, x_max, y_min, y_max):
+    """
+    Build the WKB geometries of rectangular grid cells in bulk
+
+    :param x_min: Array of minimum x coordinates
+    :param x_max: Array of maximum x coordinates
+    :param y_min: Array of minimum y coordinates
+    :param y_max: Array of maximum y coordinates
+    :return: List of WKB geometries (as bytes)
+    """
+    records = np.empty(len(x_min), dtype=WKB_POLYGON)
+    records['byte_order'] = 1
+    records['wkb_type'] = ogr.wkbPolygon
+    records['num_rings'] = 1
+    records['num_points'] = 5
+    coords = records['coords']
+    coords[:, 0::2] = np.column_stack((x_min, x_max, x_max, x_min, x_min))
+    coords[:, 1::2] = np.column_stack((y_max, y_max, y_min, y_min, y_max))
+    raw = records.tobytes()
+    size = WKB_POLYGON.itemsize
+    return [raw[i * size:(i + 1) * size] for i in range(len(records))]
+
+
+def _block_to_wkb(args):
+    """
+    Build the WKB geometries of all cells within a block of grid columns and rows, in column-major order
+
+    :param args: Tuple of (grid x_min, grid y_max, cell width, cell height, total number of grid rows, first column,
+            last column + 1, first row, last row + 1)
+    :return: Tuple of (array of cell IDs, list of WKB geometries as bytes)
+    """
+    x_min, y_max, h_space, v_space, grid_rows, col_start, col_end, row_start, row_end = args
+    cols = np.repeat(np.arange(col_start, col_end, dtype=np.int64), row_end - row_start)
+    rows = np.tile(np.arange(row_start, row_end, dtype=np.int64), col_end - col_start)
+    cell_x_min = x_min + cols * h_space
+    cell_y_max = y_max - rows * v_space
+    return cols * grid_rows + rows, cells_to_wkb(cell_x_min, cell_x_min + h_space, cell_y_max - v_space, cell_y_max)
+
+
+def get_grid_spacing(extent, cols, rows):
+    """
+    Calculate the cell width and height of a grid with given extent and number of columns and rows
+
+    :param extent: Grid extent as (x_min, x_max, y_min, y_max)
+    :param cols: Number of columns
+    :param rows: Number of rows
+    :return: Tuple of (cell width, cell height)
+    """
+    gridHspace = (float(extent[1]) - float(extent[0])) / cols
+    gridVspace = (float(extent[3]) - float(extent[2])) / rows
+    return gridHspace, gridVspace
+
+
+def get_cols_rows(extent, hspace, vspace, adjust='expand'):
+    """
+    Calculate the number of columns and rows of a grid with given extent and cell width and height
+
+    :param extent: Grid extent as (x_min, x_max, y_min, y_max)
+    :param hspace: Cell width
+    :param vspace: Cell height
+    :param adjust: "expand" to round up, so the grid covers the whole extent, or "shrink" to round down
+    :return: Tuple of (columns, rows)
+    """
+    if adjust == 'expand':
+        cols = math.ceil((float(extent[1]) - float(extent[0])) / hspace)
+        rows = math.ceil((float(extent[3]) - float(extent[2])) / vspace)
+    else:
+        cols = math.floor((float(extent[1]) - float(extent[0])) / hspace)
+        rows = math.floor((float(extent[3]) - float(extent[2])) / vspace)
+    return int(cols), int(rows)
+
+
+class FishnetGrid(object):
+    """
+    Implicit fishnet that answers cell queries arithmetically instead of materializing the grid polygons. Cell IDs
+    follow the order in which CreateFishnet writes the cells (column-major, starting in the upper left corner) and are
+    stored in the attribute "cell_id" of each polygon written by CreateFishnet. They do not necessarily equal the FIDs,
+    which start at 1 for some formats (e.g. GPKG).
+    """
+    def __init__(self, extent, h_space=None, v_space=None, cols=None, rows=None, adjust='expand'):
+        """
+        :param extent: Grid extent as (x_min, x_max, y_min, y_max)
+        :param h_space: Cell width (in projection units)
+        :param v_space: Cell height (in projection units)
+        :param cols: Number of columns. Either cols and rows or cell width and height must be given.
+        :param rows: Number of rows
+        :param adjust: "expand" or "shrink" the extent, if cell width and height do not fit exactly into it
+        """
+        self.x_min = float(extent[0])
+        self.y_max = float(extent[3])
+        if h_space and v_space:
+            self.h_space = float(h_space)
+            self.v_space = float(v_space)
+            if cols and rows:
+                self.cols, self.rows = int(cols), int(rows)
+            else:
+                self.cols, self.rows = get_cols_rows(extent, self.h_space, self.v_space, adjust)
+        elif cols and rows:
+            self.cols, self.rows = int(cols), int(rows)
+            self.h_space, self.v_space = get_grid_spacing(extent, self.cols, self.rows)
+        else:
+            raise ValueError('Either cell width and height or cols and rows must be given!')
+        self.x_max = self.x_min + self.cols * self.h_space
+        self.y_min = self.y_max - self.rows * self.v_space
+
+    def __len__(self):
+        return self.cols * self.rows
+
+    def cell_id(self, x, y):
+        """
+        Get the IDs of the cells containing the given coordinates
+
+        :param x: Array of x coordinates
+        :param y: Array of y coordinates
+        :return: Array of cell IDs, -1 for coordinates outside the grid
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        col = np.floor((x - self.x_min) / self.h_space).astype(np.int64)
+        row = np.floor((self.y_max - y) / self.v_space).astype(np.int64)
+        # coordinates on the right and bottom edge still belong to the grid
+        col[x == self.x_max] = self.cols - 1
+        row[y == self.y_min] = self.rows - 1
+        valid = (col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows)
+        return np.where(valid, col * self.rows + row, -1)
+
+    def pixel_to_cell_id(self, px, py, geotrans):
+        """
+        Get the IDs of the cells containing the centres of the given raster pixels
+
+        :param px: Array of pixel columns
+        :param py: Array of pixel rows
+        :param geotrans: GDAL geotransform of the raster
+        :return: Array of cell IDs, -1 for pixels outside the grid
+        """
+        x = geotrans[0] + (np.asarray(px) + 0.5) * geotrans[1] + (np.asarray(py) + 0.5) * geotrans[2]
+        y = geotrans[3] + (np.asarray(px) + 0.5) * geotrans[4] + (np.asarray(py) + 0.5) * geotrans[5]
+        return self.cell_id(x, y)
+
+    def cell_bounds(self, ids):
+        """
+        Get the bounds of the given cells
+
+        :param ids: Array of cell IDs
+        :return: Tuple of arrays (x_min, x_max, y_min, y_max)
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if np.any((ids < 0) | (ids >= len(self))):
+            raise IndexError('Cell ID out of range!')
+        col = ids // self.rows
+        row = ids % self.rows
+        x_min = self.x_min + col * self.h_space
+        y_max = self.y_max - row * self.v_space
+        return x_min, x_min + self.h_space, y_max - self.v_space, y_max
+
+    def cells_in_bbox(self, x_min, x_max, y_min, y_max):
+        """
+        Get the IDs of all cells intersecting a bounding box
+
+        :param x_min: Minimum x coordinate of the bounding box
+        :param x_max: Maximum x coordinate of the bounding box
+        :param y_min: Minimum y coordinate of the bounding box
+        :param y_max: Maximum y coordinate of the bounding box
+        :return: Array of cell IDs (in ascending order)
+        """
+        col_start = max(0, int(math.floor((x_min - self.x_min) / self.h_space)))
+        col_end = min(self.cols, int(math.ceil((x_max - self.x_min) / self.h_space)))
+        row_start = max(0, int(math.floor((self.y_max - y_max) / self.v_space)))
+        row_end = min(self.rows, int(math.ceil((self.y_max - y_min) / self.v_space)))
+        if col_start >= col_end or row_start >= row_end:
+            return np.array([], dtype=np.int64)
+        cols, rows = np.meshgrid(np.arange(col_start, col_end), np.arange(row_start, row_end), indexing='ij')
+        return (cols * self.rows + rows).ravel()
+
+    def materialize(self, ids, outfile, of='ESRI Shapefile', srs=None, batch=100000):
+        """
+        Write the polygons of the given cells only, with their cell ID as attribute "cell_id"
+
+        :param ids: Array of cell IDs
+        :param outfile: Output file (will be overwritten)
+        :param of: Output format according to OGR driver standard
+        :param srs: osr.SpatialReference of the grid
+        :param batch: Number of cells written per transaction
+        :return: Number of written cells
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        drv = ogr.GetDriverByName(of)
+        if os.path.exists(outfile):
+            drv.DeleteDataSource(outfile)
+        ds = drv.CreateDataSource(outfile)
+        lyr = ds.CreateLayer(os.path.splitext(os.path.basename(outfile))[0], srs, ogr.wkbPolygon)
+        lyr.CreateField(ogr.FieldDefn('cell_id', ogr.OFTInteger64))
+        featureDefn = lyr.GetLayerDefn()
+        for start in range(0, len(ids), batch):
+            chunk = ids[start:start + batch]
+            lyr.StartTransaction()
+            for cell, wkb in zip(chunk, cells_to_wkb(*self.cell_bounds(chunk))):
+                feature = ogr.Feature(featureDefn)
+                feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb))
+                feature.SetField(0, int(cell))
+                lyr.CreateFeature(feature)
+                feature = None
+            lyr.CommitTransaction()
+        lyr = None
+        ds = None
+        return len(ids)
+
 
 class CreateFishnet(object):
     def __init__(self, argv):
@@ -22,11 +248,16 @@ class CreateFishnet(object):
         self._overwrite = False
         self._spatialRef = None
         self._grid = None
+        self._processes = None
+        self._batch = 100000
+        self._shardRows = None
+        self._tile = None
 
     def setup_option_parser(self):
         parser = OptionParser('''
 Description:
-    Create a vector grid of equally sized polygons.
+    Create a vector grid of equally sized polygons, each one holding its cell ID (column-major,
+    starting at 0 in the upper left corner) as attribute "cell_id".
 ''', conflict_handler='resolve')
         group = OptionGroup(parser, 'Mandatory Options', 'Must be defined')
         group.add_option('-e', '--extent', dest='extent',
@@ -51,13 +282,26 @@ Description:
         group = OptionGroup(parser, 'Additional Options', 'Can be defined')
         group.add_option('-f', '--format', dest='format', default='ESRI Shapefile',
                          help='File format for output. Default is "ESRI Shapefile". See '
-                               'http://www.gdal.org/ogr_formats.html for valid codes')
+                               'http://www.gdal.org/ogr_formats.html for valid codes. "FlatGeobuf", '
+                               '"Parquet" (GeoParquet) and "GPKG" are written with a spatial index')
         group.add_option('-a', '--adjust', dest='adjust', default='expand',
                          help='Adjustment of grid extent if cell width and height do not match '
                               'exactly with given extent. Either "expand" (default; extent will '
                               'become greater) or "shrink" (extent will become smaller')
         group.add_option('-o', '--overwrite', dest='overwrite', action='store_true', default=False,
                          help='Overwrite output if it already exists')
+        group.add_option('-p', '--processes', dest='processes', type='int',
+                         help='Number of worker processes building the cell geometries. Default is the number of '
+                              'CPUs, 1 disables the process pool')
+        group.add_option('-b', '--batch', dest='batch', type='int', default=100000,
+                         help='Number of cells written per transaction. Default is 100000')
+        group.add_option('-s', '--shard-rows', dest='shard_rows', type='int',
+                         help='Split the grid into several files of this many grid rows each. The files are named '
+                              'after the output grid with the shard index appended, e.g. "grid_0001.fgb"')
+        group.add_option('-t', '--tile', dest='tile',
+                         help='Split the grid into several files of tiles of this many grid columns and rows, '
+                              'separated by comma (no space!), e.g. "1000,1000". Same naming as for --shard-rows, '
+                              'which must not be given as well')
         parser.add_option_group(group)
         return parser
 
@@ -67,6 +311,21 @@ Description:
         self._format = options.format
         self._overwrite = options.overwrite
         self._adjust = options.adjust
+        self._processes = options.processes
+        self._batch = options.batch
+        self._shardRows = options.shard_rows
+        if options.tile:
+            if options.shard_rows:
+                parser.print_help()
+                raise IOError('Either --shard-rows or --tile may be given, not both!')
+            try:
+                self._tile = [int(t) for t in options.tile.split(',')]
+            except ValueError:
+                self._tile = []
+            if len(self._tile) != 2 or min(self._tile) < 1:
+                parser.print_help()
+                raise IOError('Unable to split tile size! Make sure to give two positive integers for columns and '
+                              'rows, separated by comma, but no space!')
         if not options.extent:
             parser.print_help()
             raise IOError('No input file given!')
@@ -99,8 +358,11 @@ Description:
                     self._spatialRef = osr.SpatialReference()
                     self._spatialRef.ImportFromEPSG(epsg)
                     self._extent = self._extent.split(',')[:4]
-                self._cols = int(options.cols)
-                self._rows = int(options.rows)
+                if options.cols and options.rows:
+                    self._cols = int(options.cols)
+                    self._rows = int(options.rows)
+                else:
+                    self._cols, self._rows = self._get_cols_rows(self._extent, self._hSpace, self._vSpace)
             print('Using extent {0}'.format(self._extent))
             print('Grid spacing (h/v): \t{0}\t{1}'.format(self._hSpace, self._vSpace))
         if not options.grid:
@@ -112,41 +374,56 @@ Description:
 
     def run(self):
         self.check_options()
+        if self._shardRows or self._tile:
+            self._write_shards()
+            return
         ds, lyr = self._create_ds(self._grid, self._spatialRef)
+        lyr.CreateField(ogr.FieldDefn('cell_id', ogr.OFTInteger64))
         x_min = float(self._extent[0])
         y_max = float(self._extent[3])
-        # first polygon
-        poly_xmin = x_min
-        poly_xmax = x_min + self._hSpace
-        poly_ymin = y_max
-        poly_ymax = y_max - self._vSpace
-        # loop polygon creation
-        for colcount in range(self._cols):
-            ring_ymax = poly_ymax
-            ring_ymin = poly_ymin
-            for rowcount in range(self._rows):
-                ring = ogr.Geometry(ogr.wkbLinearRing)
-                ring.AddPoint(poly_xmin, ring_ymax)
-                ring.AddPoint(poly_xmax, ring_ymax)
-                ring.AddPoint(poly_xmax, ring_ymin)
-                ring.AddPoint(poly_xmin, ring_ymin)
-                ring.AddPoint(poly_xmin, ring_ymax)
-                poly = ogr.Geometry(ogr.wkbPolygon)
-                poly.AddGeometry(ring)
-                # add polygon to layer
-                featureDefn = lyr.GetLayerDefn()
-                feature = ogr.Feature(featureDefn)
-                feature.SetGeometry(poly)
-                lyr.CreateFeature(feature)
-                feature.Destroy()
-                # new extent for polygon in next row
-                ring_ymax = ring_ymax - self._vSpace
-                ring_ymin = ring_ymin - self._vSpace
-            # new extent for polygon in next column
-            poly_xmin = poly_xmin + self._hSpace
-            poly_xmax = poly_xmax + self._hSpace
+        # build the cells in strips of columns, each strip holding about one transaction of cells
+        strip_cols = max(1, self._batch // self._rows)
+        strips = [(x_min, y_max, self._hSpace, self._vSpace, self._rows, col, min(col + strip_cols, self._cols), 0,
+                   self._rows) for col in range(0, self._cols, strip_cols)]
+        pool, cells = self._map(_block_to_wkb, strips)
+        for ids, wkbs in cells:
+            self._write_cells(lyr, wkbs, ids)
+        if pool:
+            pool.close()
+            pool.join()
         ds.Destroy()
 
+    def _write_shards(self):
+        grid = self.get_grid()
+        if self._tile:
+            tile_cols, tile_rows = self._tile
+        else:
+            tile_cols, tile_rows = grid.cols, self._shardRows
+        shards = [(grid.x_min, grid.y_max, grid.h_space, grid.v_space, grid.rows, col, min(col + tile_cols, grid.cols),
+                   row, min(row + tile_rows, grid.rows))
+                  for row in range(0, grid.rows, tile_rows) for col in range(0, grid.cols, tile_cols)]
+        digits = len(str(len(shards)))
+        base, ext = os.path.splitext(self._grid)
+        total = time.time()
+        pool, cells = self._map(_block_to_wkb, shards)
+        for s, (ids, wkbs) in enumerate(cells):
+            start = time.time()
+            shard = '{b}_{n}{e}'.format(b=base, n=str(s + 1).zfill(digits), e=ext)
+            ds, lyr = self._create_ds(shard, self._spatialRef)
+            lyr.CreateField(ogr.FieldDefn('cell_id', ogr.OFTInteger64))
+            self._write_cells(lyr, wkbs, ids)
+            lyr = None
+            ds = None
+            duration = time.time() - start
+            print('Shard {s} of {n}: {f} - {c} cells in {d:.1f} s ({r:.0f} cells/s)'.format(
+                s=s + 1, n=len(shards), f=shard, c=len(wkbs), d=duration, r=len(wkbs) / max(duration, 1e-6)))
+        if pool:
+            pool.close()
+            pool.join()
+        duration = time.time() - total
+        print('All shards: {c} cells in {d:.1f} s ({r:.0f} cells/s)'.format(
+            c=len(grid), d=duration, r=len(grid) / max(duration, 1e-6)))
+
 # --------------------------------------------------------------------------- #
 # HELPER FUNCTIONS
     def _get_extent(self, dataset):
@@ -188,9 +465,30 @@ Description:
             sys.exit(1)
         ds = drv.CreateDataSource(dataset)
         lyr_name = os.path.splitext(os.path.basename(dataset))[0]
-        lyr = ds.CreateLayer(lyr_name, srs, ogr.wkbPolygon)
+        lyr = ds.CreateLayer(lyr_name, srs, ogr.wkbPolygon, options=LAYER_CREATION_OPTIONS.get(self._format, []))
         return ds, lyr
 
+    def _map(self, function, tasks):
+        if self._processes == 1:
+            return None, (function(task) for task in tasks)
+        pool = multiprocessing.Pool(self._processes)
+        return pool, bounded_imap(pool, function, tasks, 2 * (self._processes or multiprocessing.cpu_count()))
+
+    def _write_cells(self, lyr, wkbs, ids=None):
+        featureDefn = lyr.GetLayerDefn()
+        lyr.StartTransaction()
+        for i, wkb in enumerate(wkbs):
+            feature = ogr.Feature(featureDefn)
+            feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb))
+            if ids is not None:
+                feature.SetField(0, int(ids[i]))
+            lyr.CreateFeature(feature)
+            feature = None
+            if (i + 1) % self._batch == 0:
+                lyr.CommitTransaction()
+                lyr.StartTransaction()
+        lyr.CommitTransaction()
+
     def _delete_ds(self, dataset):
         drv = ogr.GetDriverByName(self._format)
         drv.DeleteDataSource(dataset)
@@ -198,18 +496,18 @@ Description:
         return True
 
     def _get_grid_spacing(self, extent, cols, rows):
-        gridHspace = (extent[1] - extent[0]) / cols
-        gridVspace = (extent[3] - extent[2]) / rows
-        return gridHspace, gridVspace
+        return get_grid_spacing(extent, cols, rows)
 
     def _get_cols_rows(self, extent, hspace, vspace):
-        if self._adjust == 'expand':
-            cols = math.ceil((extent[1] - extent[0]) / vspace)
-            rows = math.ceil((extent[3] - extent[2]) / hspace)
-        else:
-            cols = math.floor((extent[1] - extent[0]) / vspace)
-            rows = math.floor((extent[3] - extent[2]) / hspace)
-        return int(cols), int(rows)
+        return get_cols_rows(extent, hspace, vspace, self._adjust)
+
+    def get_grid(self):
+        """
+        Get the implicit grid of the parsed options, e.g. to query cells without writing the whole fishnet
+
+        :return: FishnetGrid
+        """
+        return FishnetGrid(self._extent, self._hSpace, self._vSpace, self._cols, self._rows, self._adjust)
 
 
 if __name__ == '__main__':
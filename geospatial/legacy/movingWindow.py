@@ -1,17 +1,24 @@
-import string
+import ast
 import numpy as np
 import importlib
 
+from basic_functions import filter_tools
 
-def movingWindow(array, window, fun, args, module=None, package=None):
+
+MODULE_ALIASES = {'np': 'numpy'}
+
+
+def movingWindow(array, window, fun, args=None, module=None, package=None):
     """
     Apply a function using a moving window. The array will be expanded by duplicating the outer pixels, so the output
     array will have the same size as the input array.
 
     :param array array: Input array (must be 2D)
     :param int window: window size for array slices. Must be odd!
-    :param str fun: Function to apply, e.g. 'numpy.nanmean'
-    :param str args: additional arguments to be passed to function, e.g. axis=0
+    :param str fun: Function to apply, e.g. 'numpy.nanmean'. It is called with a view of all windows and must reduce
+            the window axes, which are passed as axis=(-2, -1).
+    :param str args: additional keyword arguments to be passed to function, separated by comma, e.g. 'ddof=1'. "axis"
+            is ignored.
     :param str module: Python module from which to take 'fun' (as used with 'importlib')
     :param str package: Python package from which to take 'fun' (as used with 'importlib')
     :return: array
@@ -23,48 +30,31 @@ def movingWindow(array, window, fun, args, module=None, package=None):
                         [2, 2, 3, 3, 0, 0], \n
                         [1, 2, 2, 0, 0, 4], \n
                         [1, 2, 0, 0, 0, 3]], dtype=np.uint8)
-    out = movingWindow(image, 2, 'nanmean', 'axis=0', module='numpy)
+    out = movingWindow(image, 3, 'nanmean', 'axis=0', module='numpy')
     """
 
     if module:
         mod = importlib.import_module(module, package=package)
+        function = getattr(mod, fun)
+    else:
+        # e.g. 'numpy.nanmean' or 'np.nanmean'
+        module, _, name = fun.rpartition('.')
+        mod = importlib.import_module(MODULE_ALIASES.get(module, module), package=package)
+        function = getattr(mod, name)
     if len(array.shape) != 2:
         raise ValueError('Input array must be 2-dimensional!')
     if window % 2 == 0:
         raise ValueError('Window size must be odd!')
-    rows = array.shape[0]
-    cols = array.shape[1]
-    rev = list(reversed(range(window)))
-    # duplicate outer pixels to expand image, so the output will have the same size as the input
-    inData = array
-    for n in range(window/2):
-        inData = np.insert(inData, 0, inData[:, 0], axis=1) # left
-        inData = np.insert(inData, -1, inData[:, -1], axis=1) # right
-        inData = np.insert(inData, 0, inData[0, :], axis=0)  # top
-        inData = np.insert(inData, -1, inData[-1, :], axis=0)  # bottom
-    exp = string.join(['mod.', fun, '(['], sep='')
-    for i in range(window):
-        for j in rev:
-            exp = string.join(
-                [exp, 'inData[', str(i), ':rows-', str(rev[i]), ', ', str(rev[j]), ':cols-', str(j), '], '], sep='')
-    exp = string.join([exp[:-2], '], {args})'.format(args=args)], sep='')
-    # ----------------------------------------------------------------------- #
-    # for a window of 3x3 for a filter, exp would look like this:
-    # outData[1:rows-1,1:cols-1] = np.nanmean(inData[0:rows-2, 0:cols-2] + \
-    #                                           inData[0:rows-2, 1:cols-1] + \
-    #                                           inData[0:rows-2, 2:cols-0] + \
-    #                                           inData[1:rows-1, 0:cols-2] + \
-    #                                           inData[1:rows-1, 1:cols-1] + \
-    #                                           inData[1:rows-1, 2:cols-0] + \
-    #                                           inData[2:rows-0, 0:cols-2] + \
-    #                                           inData[2:rows-0, 1:cols-1] + \
-    #                                           inData[2:rows-0, 2:cols-0], \
-    #                                           axis=0)
-    # ----------------------------------------------------------------------- #
-    # evaluate string expression and fill outData with it
-    outData = np.zeros(array.shape, dtype=np.float32)
-    outData[(window/2):rows - (window/2), (window/2):cols - (window/2)] = eval(exp)
-    return outData
+    # keyword arguments, e.g. "ddof=1"; the window axes are always passed as axis=(-2, -1)
+    kwargs = {}
+    if args:
+        for arg in args.split(','):
+            key, value = arg.split('=', 1)
+            if key.strip() != 'axis':
+                kwargs[key.strip()] = ast.literal_eval(value.strip())
+    # the array is expanded by duplicating the outer pixels ("nearest"), tile by tile
+    outData = filter_tools.moving_window(array, window, function, edge_mode='nearest', **kwargs)
+    return outData.astype(np.float32)
 
 
 if __name__ == '__main__':
@@ -75,5 +65,5 @@ if __name__ == '__main__':
                       [1, 2, 2, 0, 0, 4],
                       [1, 2, 0, 0, 0, 3]], dtype=np.uint8)
     out = movingWindow(image, 3, 'np.nanmean', 'axis=0')
-    print image
-    print out
+    print(image)
+    print(out)
@@ -1,15 +1,61 @@
 # -*- coding: utf-8 -*-
 
-import os, sys, re, time, datetime, warnings
+import os, sys, re, time, datetime, warnings, glob, multiprocessing
 import numpy as np
-import subprocess as sub
 from osgeo import ogr, osr, gdal, gdal_array
 from optparse import OptionParser, OptionGroup
 
+from basic_functions import journal_tools
+from basic_functions.pool_tools import bounded_imap
+
 
 OGR_TYPES = {int: ogr.OFTInteger,
              float: ogr.OFTReal}
 
+# drivers which store pixels uncompressed in a raw layout that can be mapped into memory
+MMAP_DRIVERS = ('GTiff', 'ENVI', 'EHdr', 'GenBin', 'PAux', 'MFF', 'ISCE', 'ROI_PAC')
+
+# output formats of the attribute table written in multi-raster (time-series) mode
+TABLE_DRIVERS = {'.csv': 'CSV',
+                 '.gpkg': 'GPKG',
+                 '.sqlite': 'SQLite',
+                 '.parquet': 'Parquet',
+                 '.dbf': 'ESRI Shapefile'}
+
+# point coordinates, shared once with each worker process of the multi-raster mode
+_POINTS = {}
+
+
+def _init_worker(xs, ys, wkt):
+    _POINTS['x'] = xs
+    _POINTS['y'] = ys
+    _POINTS['wkt'] = wkt
+
+
+def _sample_scene(args):
+    """
+    Sample one raster of a time-series at all points (worker of the multi-raster mode)
+
+    :param args: Tuple of (image, bands, radius, mode, dismiss, mmap)
+    :return: Tuple of (image, bands, values), values being an array of shape (points, bands)
+    """
+    image, bands, radius, mode, dismiss, mmap = args
+    ds = gdal.Open(image, gdal.GA_ReadOnly)
+    if not bands:
+        bands = [b for b in range(1, ds.RasterCount + 1)]
+    xs, ys = PointSampling._transform_coordinates(_POINTS['x'], _POINTS['y'], _POINTS['wkt'],
+                                                  ds.GetProjection())
+    px, py = PointSampling._to_pixel(xs, ys, ds.GetGeoTransform())
+    arrays = PointSampling._memory_map(ds, bands) if mmap else None
+    if arrays is not None:
+        no_data = [ds.GetRasterBand(b).GetNoDataValue() for b in bands]
+        values = PointSampling._sample_arrays(arrays, px, py, radius, mode, no_data, dismiss)
+    else:
+        values = PointSampling._sample_blocks(ds, bands, px, py, radius, mode, dismiss)
+    arrays = None
+    ds = None
+    return image, bands, values
+
 
 class PointSampling(object):
     def __init__(self, argv):
@@ -23,6 +69,13 @@ class PointSampling(object):
         self._dismiss = None
         self._names = None
         self._crs = 'raster'
+        self._mmap = False
+        self._series = None
+        self._table = None
+        self._layout = 'long'
+        self._processes = None
+        self._chunk = 0
+        self._resume = False
         print('Running "PointSampling"...\n')
 
     def setup_option_parser(self):
@@ -42,8 +95,6 @@ Requirements:
 NumPy (1.10.4 +)
 
 GDAL / OGR installation with Python bindings (OSGeo 1.11.3 +)
-
-GDAL / OGR commands in PATH environment
 """, conflict_handler='resolve')
         group = OptionGroup(parser, 'Mandatory options', 'Must be defined')
         group.add_option('-i', '--image', dest='image', type='str',
@@ -69,9 +120,8 @@ GDAL / OGR commands in PATH environment
                               '"a-z,A-Z,0-9,_". If a field already exists, its values will be '
                               'overwritten!')
         group.add_option('-c', '--crs', dest='crs', type='str', default='raster',
-                         help='Use spatial reference system from input image ("raster"; default) or'
-                              ' sampling points '
-                              '("points") if internal reprojection is necessary.')
+                         help='Deprecated. The point coordinates are always transformed in memory '
+                              'into the spatial reference system of the input image.')
         group.add_option('-o', '--output', dest='output', type='str',
                          help='Output file, if desired. If not given, the new attributes will be'
                               ' appended to the input '
@@ -80,6 +130,35 @@ GDAL / OGR commands in PATH environment
                               'will be in the same format.')
         group.add_option('', '--overwrite', dest='overwrite', action='store_true',
                          default=False, help='Overwrite output file, if it already exists.')
+        group.add_option('', '--mmap', dest='mmap', action='store_true', default=False,
+                         help='Memory-map the raw pixel data of uncompressed rasters (e.g. GTiff '
+                              'without compression and tiling, ENVI) instead of reading blocks. '
+                              'Falls back to block reads if the raster cannot be mapped.')
+        group.add_option('', '--chunk', dest='chunk', type='int', default=0,
+                         help='Number of points per chunk. If given, results are committed chunk '
+                              'by chunk and the progress is recorded in a journal next to the '
+                              'output (<output>.journal), which allows to resume the run with '
+                              '--resume after a crash. Default is 0 (all points at once, no '
+                              'journal).')
+        group.add_option('', '--resume', dest='resume', action='store_true', default=False,
+                         help='Resume an interrupted run from its journal, skipping all points '
+                              'already processed. Implies --chunk 100000, if not given.')
+        parser.add_option_group(group)
+        group = OptionGroup(parser, 'Multi-raster mode', 'Extract a time-series from many rasters '
+                            'into one attribute table, instead of adding fields to the points')
+        group.add_option('-s', '--series', dest='series', type='str',
+                         help='Input rasters, separated by comma (no space!), or a glob pattern '
+                              '(in quotes), e.g. "scenes/*.tif". Replaces -i/--image.')
+        group.add_option('-t', '--table', dest='table', type='str',
+                         help='Output attribute table. One of {f}.'.format(
+                             f=', '.join(sorted(TABLE_DRIVERS.keys()))))
+        group.add_option('-l', '--layout', dest='layout', type='str', default='long',
+                         help='Table layout. Either "long" (default; one row per point, raster and '
+                              'band) or "wide" (one row per point, one column per raster and '
+                              'band).')
+        group.add_option('', '--processes', dest='processes', type='int',
+                         help='Number of processes to sample rasters in parallel. Default is the '
+                              'number of CPUs.')
         parser.add_option_group(group)
         return parser
 
@@ -87,7 +166,31 @@ GDAL / OGR commands in PATH environment
         parser = self.setup_option_parser()
         (options, args) = parser.parse_args()
         self._image = options.image
-        if not options.image:
+        if options.series:
+            if ',' in options.series:
+                self._series = options.series.split(',')
+            else:
+                self._series = sorted(glob.glob(options.series))
+            if not self._series:
+                parser.print_help()
+                raise IOError('No input images found for {s}!'.format(s=options.series))
+            self._table = options.table
+            if not self._table:
+                parser.print_help()
+                raise IOError('No output table for multi-raster mode!')
+            if os.path.splitext(self._table)[1].lower() not in TABLE_DRIVERS:
+                parser.print_help()
+                raise IOError('Unsupported output table format {f}!'.format(f=self._table))
+            if os.path.exists(self._table) and not options.overwrite:
+                parser.print_help()
+                raise IOError('Desired output table {f} already exists and shall not be '
+                              'overwritten!'.format(f=self._table))
+            self._layout = options.layout
+            if self._layout not in ('long', 'wide'):
+                parser.print_help()
+                raise IOError('Unknown table layout {l}!'.format(l=self._layout))
+            self._processes = options.processes
+        elif not options.image:
             parser.print_help()
             raise IOError('No input image!')
         self._points = options.points
@@ -96,7 +199,9 @@ GDAL / OGR commands in PATH environment
             raise IOError('No sampling points!')
         self._output = options.output
         self._overwrite = options.overwrite
-        if os.path.exists(self._output) and not self._overwrite:
+        self._resume = options.resume
+        if self._output and os.path.exists(self._output) and not self._overwrite and \
+                not self._resume:
             parser.print_help()
             raise IOError('Desired output file {f} already exists and shall not be overwritten!'
                           ''.format(f=self._output))
@@ -111,7 +216,7 @@ GDAL / OGR commands in PATH environment
                               ' but no space!')
         else:
             self._bands = options.bands
-        self._dismiss = options.dismiss
+        self._dismiss = float(options.dismiss) if options.dismiss is not None else None
         if options.names:
             try:
                 self._names = options.names.split(',')
@@ -122,26 +227,28 @@ GDAL / OGR commands in PATH environment
         else:
             self._names = options.names
         self._crs = options.crs
+        if self._crs != 'raster':
+            warnings.warn('Option -c/--crs is deprecated! The points are always transformed into '
+                          'the spatial reference system of the raster.')
+        self._mmap = options.mmap
+        self._chunk = options.chunk
+        if self._resume and not self._chunk:
+            self._chunk = 100000
         return True
 
     def run(self):
         start = time.time()
         warnings.simplefilter('ignore', FutureWarning)
         self.check_options()
-        print('Checking spatial references...')
-        self._points, self._image = self._match_projection(self._points, self._image,
-                                                           match=self._crs)
+        if self._series:
+            return self.run_series()
         # get raster information
         ds_img = gdal.Open(self._image, gdal.GA_ReadOnly)
-        cols = ds_img.RasterXSize
-        rows = ds_img.RasterYSize
         geotrans = ds_img.GetGeoTransform()
-        ulx = geotrans[0]
-        uly = geotrans[3]
-        resolution = geotrans[1]
         # get band count and band names
         if not self._bands:
             self._bands = [b for b in range(1, ds_img.RasterCount + 1)]
+        self._bands = [int(b) for b in self._bands]
         if not self._names:
             self._names = [bn.split('=')[1] for bn in ds_img.GetMetadata_List() if
                            bn.startswith('Band') and int(bn.split('=')[0].split('_')[1]) in
@@ -150,8 +257,27 @@ GDAL / OGR commands in PATH environment
                            re.sub(r'[^a-zA-Z0-9_]', r'', n)[:10] for n in self._names]
             if not self._names:
                 self._names = ['band_{b}'.format(b=bn) for bn in self._bands]
+        # check for a journal of an interrupted run
+        input_points = self._output if self._output else self._points
+        journal = input_points + '.journal'
+        done = []
+        if self._resume and os.path.exists(journal):
+            content = journal_tools.read_journal(journal)
+            if content['image'] != os.path.abspath(self._image) or \
+                    content['fields'] != self._names or content['mode'] != self._mode or \
+                    content['radius'] != self._radius:
+                raise IOError('Journal {j} belongs to a different run! Remove it to start over.'
+                              ''.format(j=journal))
+            done = content['done']
+            print('Resuming from {j}...'.format(j=journal))
+        elif os.path.exists(journal):
+            os.remove(journal)
+        resume = bool(done)
+        if self._output and not resume and os.path.exists(self._output) and not self._overwrite:
+            raise IOError('Nothing to resume and desired output file {f} already exists!'.format(
+                f=self._output))
         # open vector file
-        if self._output:
+        if self._output and not resume:
             print('Creating new output file...')
             ds = ogr.Open(self._points)
             drv = ds.GetDriver()
@@ -159,73 +285,148 @@ GDAL / OGR commands in PATH environment
                 drv.DeleteDataSource(self._output)
             drv.CopyDataSource(ds, self._output)
             ds = None
-            input_points = self._output
-        else:
-            input_points = self._points
         ds_points = ogr.Open(input_points, 1)
         lyr = ds_points.GetLayer()
         lyr_defn = lyr.GetLayerDefn()
         # check if new attribute names already exist
         fields = [lyr_defn.GetFieldDefn(f).name for f in range(lyr_defn.GetFieldCount())]
         for n in self._names:
-            if n in fields:
+            if n in fields and not resume:
                 warnings.warn('Field {f} already exists! Values will be overwritten!'.format(f=n))
-                lyr.DeleteField(fields.index(n))
-        # get coordinates
-        points = [(p.GetGeometryRef().GetX(), p.GetGeometryRef().GetY()) for p in lyr]
-        # loop over each band
+                lyr.DeleteField(lyr.FindFieldIndex(n, 1))
+        # create all fields at once
+        no_data = []
         for b, bandnum in enumerate(self._bands):
             band = ds_img.GetRasterBand(bandnum)
-            no_data = band.GetNoDataValue()
+            no_data.append(band.GetNoDataValue())
+            if resume and self._names[b] in fields:
+                continue
             dt = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
-            # create field
             if not self._mode == 'majority':
                 field = ogr.FieldDefn(self._names[b], OGR_TYPES[type(dt(0).item())])
             else:
                 field = ogr.FieldDefn(self._names[b], ogr.OFTInteger)
             lyr.CreateField(field)
-            # loop points
-            for p, point in enumerate(points):
-                # fit sampling window
-                xoff = int((point[0] - ulx) / resolution) - self._radius
-                yoff = int((uly - point[1]) / resolution) - self._radius
-                if xoff < 0:
-                    xwin = self._radius * 2 - abs(xoff)
-                    xoff = 0
-                if xoff + (self._radius * 2) > cols:
-                    xwin = cols - xoff
-                else:
-                    xwin = self._radius * 2
-                if yoff < 0:
-                    ywin = self._radius * 2 - abs(yoff)
-                    yoff = 0
-                if yoff + (self._radius * 2) > rows:
-                    ywin = rows - yoff
-                else:
-                    ywin = self._radius * 2
-                if self._radius == 0:
-                    xwin, ywin = (1, 1)
-                # read data
-                window = band.ReadAsArray(xoff, yoff, xwin, ywin)
-                if len(window) > 1:
-                    window = window[window != no_data]
-                    window = window[window != dt(self._dismiss)]
-                else:
-                    if window.flatten()[0] == self._dismiss or window.flatten()[0] == no_data:
-                        window = np.array([])
-                # calculate statistic
-                data = self.calculate_stats(window, self._mode, no_data)
-                # set attribute
-                feat = lyr.GetFeature(p)
-                feat.SetField(self._names[b], data)
-                lyr.SetFeature(feat)
-                feat.Destroy()
             band = None
+        # get pixel coordinates, transformed into the spatial reference of the raster if necessary
+        fids, xs, ys = self._read_coordinates(lyr)
+        srs = lyr.GetSpatialRef()
+        if srs is not None:
+            xs, ys = self._transform_coordinates(xs, ys, srs.ExportToWkt(), ds_img.GetProjection())
+        px, py = self._to_pixel(xs, ys, geotrans)
+        todo = ~journal_tools.in_ranges(fids, done)
+        print('Sampling {n} points in {b} bands...'.format(n=int(todo.sum()), b=len(self._bands)))
+        arrays = self._memory_map(ds_img, self._bands) if self._mmap else None
+        if arrays is not None:
+            print('Using memory-mapped pixel data...')
+        elif self._mmap:
+            warnings.warn('Unable to memory-map {r}! Falling back to block reads.'.format(
+                r=self._image))
+        # process the points in chunks, each one committed and journaled
+        chunk = self._chunk if self._chunk else max(len(fids), 1)
+        for first in range(0, len(fids), chunk):
+            idx = np.flatnonzero(todo[first:first + chunk]) + first
+            if idx.size == 0:
+                continue
+            if arrays is not None:
+                values = self._sample_arrays(arrays, px[idx], py[idx], self._radius, self._mode,
+                                             no_data, self._dismiss)
+            else:
+                values = self._sample_blocks(ds_img, self._bands, px[idx], py[idx], self._radius,
+                                             self._mode, self._dismiss)
+            self._write_fields(lyr, fids[idx], self._names, values, no_data,
+                               random_access=bool(self._chunk))
+            if self._chunk:
+                journal_tools.sync_layer(lyr)
+                done += journal_tools.fid_ranges(fids[idx])
+                journal_tools.write_journal(journal, {'image': os.path.abspath(self._image),
+                                                      'fields': self._names, 'mode': self._mode,
+                                                      'radius': self._radius, 'done': done})
+                print('{n} of {t} points done'.format(n=min(first + chunk, len(fids)),
+                                                      t=len(fids)))
+        arrays = None
         lyr = None
         ds_points.Destroy()
         ds_img = None
-        if self._temp:
-            os.remove(self._temp)
+        if os.path.exists(journal):
+            os.remove(journal)
+        print('\nDuration (hh:mm:ss): \t {dur}'.format(dur=datetime.timedelta(seconds=time.time()
+                                                                                      - start)))
+        return True
+
+    def run_series(self):
+        """
+        Sample many rasters at the same points in parallel and write all values into one
+        attribute table
+        """
+        start = time.time()
+        ds_points = ogr.Open(self._points)
+        lyr = ds_points.GetLayer()
+        srs = lyr.GetSpatialRef()
+        wkt = srs.ExportToWkt() if srs is not None else None
+        fids, xs, ys = self._read_coordinates(lyr)
+        lyr = None
+        ds_points = None
+        bands = [int(b) for b in self._bands] if self._bands else None
+        tasks = [(image, bands, self._radius, self._mode, self._dismiss, self._mmap) for image in
+                 self._series]
+        print('Sampling {n} points in {s} rasters...'.format(n=len(fids), s=len(tasks)))
+        pool = multiprocessing.Pool(self._processes, initializer=_init_worker,
+                                    initargs=(xs, ys, wkt))
+        results = bounded_imap(pool, _sample_scene, tasks,
+                               2 * (self._processes or multiprocessing.cpu_count()))
+        if self._layout == 'long':
+            fields = [('point_fid', ogr.OFTInteger64), ('raster', ogr.OFTString),
+                      ('band', ogr.OFTInteger), ('value', ogr.OFTReal)]
+            ds, lyr = self._create_table(self._table, fields, self._overwrite)
+            count = 0
+            for i, (image, scene_bands, values) in enumerate(results):
+                name = os.path.splitext(os.path.basename(image))[0]
+                lyr.StartTransaction()
+                for b, band in enumerate(scene_bands):
+                    for p in range(len(fids)):
+                        feat = ogr.Feature(lyr.GetLayerDefn())
+                        feat.SetField(0, int(fids[p]))
+                        feat.SetField(1, name)
+                        feat.SetField(2, int(band))
+                        if not np.isnan(values[p, b]):
+                            feat.SetField(3, float(values[p, b]))
+                        lyr.CreateFeature(feat)
+                        count += 1
+                lyr.CommitTransaction()
+                print('{i}/{n}: {r}'.format(i=i + 1, n=len(tasks), r=name))
+        else:
+            columns = []
+            table = []
+            for i, (image, scene_bands, values) in enumerate(results):
+                name = os.path.splitext(os.path.basename(image))[0]
+                columns += ['{r}_b{b}'.format(r=name, b=band) for band in scene_bands]
+                table.append(values)
+                print('{i}/{n}: {r}'.format(i=i + 1, n=len(tasks), r=name))
+            table = np.hstack(table)
+            if os.path.splitext(self._table)[1].lower() == '.dbf':
+                # dBASE field names are cut to 10 characters
+                columns = self._unique_names(['point_fid'] + columns, 10)[1:]
+            fields = [('point_fid', ogr.OFTInteger64)] + [(c, ogr.OFTReal) for c in columns]
+            ds, lyr = self._create_table(self._table, fields, self._overwrite)
+            count = 0
+            lyr.StartTransaction()
+            for p in range(len(fids)):
+                feat = ogr.Feature(lyr.GetLayerDefn())
+                feat.SetField(0, int(fids[p]))
+                for c in np.flatnonzero(~np.isnan(table[p])):
+                    feat.SetField(int(c) + 1, float(table[p, c]))
+                lyr.CreateFeature(feat)
+                count += 1
+                if count % 50000 == 0:
+                    lyr.CommitTransaction()
+                    lyr.StartTransaction()
+            lyr.CommitTransaction()
+        pool.close()
+        pool.join()
+        lyr = None
+        ds = None
+        print('{c} rows written to {t}'.format(c=count, t=self._table))
         print('\nDuration (hh:mm:ss): \t {dur}'.format(dur=datetime.timedelta(seconds=time.time()
                                                                                       - start)))
         return True
@@ -233,53 +434,301 @@ GDAL / OGR commands in PATH environment
     # ----------------------------------------------------------------------- #
     # HELPER FUNCTIONS
     @staticmethod
-    def run_cmd(command):
-        p = sub.Popen(command, stdout=sub.PIPE, stderr=sub.PIPE)
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            print command
-            print stdout
-            print stderr
-            sys.exit(1)
-        return True
+    def _read_coordinates(lyr):
+        """
+        Read the FIDs and coordinates of all points, without parsing any attribute
+        """
+        defn = lyr.GetLayerDefn()
+        lyr.SetIgnoredFields([defn.GetFieldDefn(f).GetName() for f in
+                              range(defn.GetFieldCount())] + ['OGR_STYLE'])
+        fids = []
+        xs = []
+        ys = []
+        lyr.ResetReading()
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            if geom is None:
+                continue
+            fids.append(feat.GetFID())
+            xs.append(geom.GetX())
+            ys.append(geom.GetY())
+        lyr.SetIgnoredFields([])
+        lyr.ResetReading()
+        return np.array(fids, dtype=np.int64), np.array(xs, dtype=float), np.array(ys, dtype=float)
 
-    def _match_projection(self, shape, raster, match='raster'):
-        # get raster information
-        ds = gdal.Open(raster)
-        wkt = ds.GetProjection()
-        srs_raster = osr.SpatialReference(wkt=wkt)
-        srs_raster.AutoIdentifyEPSG()
-        epsg_raster = int(srs_raster.GetAttrValue('AUTHORITY', 1))
-        ds = None
-        # get shape projection
-        ds = ogr.Open(shape)
-        srs_shape = ds.GetLayer().GetSpatialRef()
-        srs_shape.AutoIdentifyEPSG()
-        epsg_shape = int(srs_shape.GetAttrValue('AUTHORITY', 1))
-        ds.Destroy()
-        if epsg_raster != epsg_shape:
-            if match == 'raster':
-                print('Reprojecting shape to EPSG:{0}'.format(epsg_raster))
-                proj_shape = os.path.splitext(shape)[0] + '_projected.shp'
-                warnings.warn('Need to re-project points! New output dataset will be {ds}'.format(
-                    ds=proj_shape))
-                cmd = 'ogr2ogr -overwrite -f "ESRI Shapefile" -t_srs EPSG:{e} {ds} {s}'.format(
-                    e=epsg_raster, ds=proj_shape, s=shape)
-                self.run_cmd(cmd)
-                shape = proj_shape
-                self._temp = None
-            else:
-                print('Reprojecting raster to EPSG:{0}'.format(epsg_shape))
-                temp_raster = os.path.splitext(raster)[0] + '_projected.tif'
-                cmd = 'gdalwarp -of GTiff -overwrite -te_srs EPSG:{e} {r} {t}'.format(
-                    e=epsg_shape, r=raster, t=temp_raster)
-                self.run_cmd(cmd)
-                raster = temp_raster
-                self._temp = temp_raster
+    @staticmethod
+    def _to_pixel(xs, ys, geotrans):
+        """
+        Convert coordinates to pixel coordinates of a (north-up) raster
+        """
+        px = np.floor((xs - geotrans[0]) / geotrans[1]).astype(np.int64)
+        py = np.floor((ys - geotrans[3]) / geotrans[5]).astype(np.int64)
+        return px, py
+
+    @staticmethod
+    def _transform_coordinates(xs, ys, src_wkt, dst_wkt):
+        """
+        Transform coordinates between two spatial references in one batch. Coordinates are
+        returned unchanged if one of them is unknown or both are the same.
+        """
+        if not src_wkt or not dst_wkt or len(xs) == 0:
+            return xs, ys
+        src = osr.SpatialReference(wkt=src_wkt)
+        dst = osr.SpatialReference(wkt=dst_wkt)
+        if src.IsSame(dst):
+            return xs, ys
+        for srs in (src, dst):
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src, dst)
+        points = np.array(transform.TransformPoints(np.column_stack((xs, ys)).tolist()))
+        return points[:, 0], points[:, 1]
+
+    @staticmethod
+    def _unique_names(names, max_length):
+        """
+        Cut field names to the maximum length and append a suffix to those clashing with a
+        previous one (case insensitive), like vector_tools does for the fields of an overlay
+        """
+        existing = []
+        unique = []
+        for name in names:
+            new = name[:max_length]
+            n = 1
+            while new.lower() in existing:
+                suffix = '_{n}'.format(n=n)
+                new = name[:max_length - len(suffix)] + suffix
+                n += 1
+            if new != name:
+                warnings.warn('Column {c} is written as {n}!'.format(c=name, n=new))
+            existing.append(new.lower())
+            unique.append(new)
+        return unique
+
+    @staticmethod
+    def _create_table(outfile, fields, overwrite=False):
+        """
+        Create an attribute table without geometries
+
+        :param fields: List of tuples (name, OGR field type)
+        :return: Data source and layer
+        """
+        drv = ogr.GetDriverByName(TABLE_DRIVERS[os.path.splitext(outfile)[1].lower()])
+        if os.path.exists(outfile):
+            if not overwrite:
+                raise IOError('{f} already exists!'.format(f=outfile))
+            drv.DeleteDataSource(outfile)
+        ds = drv.CreateDataSource(outfile)
+        lyr = ds.CreateLayer(os.path.splitext(os.path.basename(outfile))[0], None, ogr.wkbNone)
+        for name, field_type in fields:
+            lyr.CreateField(ogr.FieldDefn(name, field_type))
+        return ds, lyr
+
+    @staticmethod
+    def _sample_blocks(ds, bands, px, py, radius=0, mode='median', dismiss=None):
+        """
+        Sample all bands at the given pixel coordinates. Points are grouped by the GDAL block they
+        fall into, and each touched block (plus a margin of "radius" pixels) is read only once for
+        all of its points.
+
+        :return: Array of shape (points, bands), NaN where no valid value was found
+        """
+        cols = ds.RasterXSize
+        rows = ds.RasterYSize
+        block_x, block_y = ds.GetRasterBand(bands[0]).GetBlockSize()
+        no_data = [ds.GetRasterBand(b).GetNoDataValue() for b in bands]
+        values = np.full((len(px), len(bands)), np.nan)
+        inside = np.flatnonzero((px >= 0) & (px < cols) & (py >= 0) & (py < rows))
+        if inside.size == 0:
+            return values
+        blocks_per_row = (cols + block_x - 1) // block_x
+        block_ids = (py[inside] // block_y) * blocks_per_row + px[inside] // block_x
+        order = np.argsort(block_ids, kind='mergesort')
+        inside = inside[order]
+        block_ids = block_ids[order]
+        starts = np.flatnonzero(np.r_[True, block_ids[1:] != block_ids[:-1]])
+        for group in np.split(inside, starts[1:]):
+            bx = px[group[0]] // block_x
+            by = py[group[0]] // block_y
+            x0 = max(bx * block_x - radius, 0)
+            x1 = min((bx + 1) * block_x + radius, cols)
+            y0 = max(by * block_y - radius, 0)
+            y1 = min((by + 1) * block_y + radius, rows)
+            block = [ds.GetRasterBand(b).ReadAsArray(int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+                     for b in bands]
+            values[group] = PointSampling._window_values(block, py[group] - y0, px[group] - x0,
+                                                         radius, mode, no_data, dismiss)
+        return values
+
+    @staticmethod
+    def _memory_map(ds, bands):
+        """
+        Map the raw pixel data of the given bands into memory, without copying. This only succeeds
+        for uncompressed and untiled rasters in a raw layout, where the driver provides a direct
+        file mapping.
+
+        :return: List of 2D arrays (one per band), or None if the raster cannot be mapped
+        """
+        if ds.GetDriver().ShortName not in MMAP_DRIVERS:
+            return None
+        compression = ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE')
+        if compression is not None and compression.upper() != 'NONE':
+            return None
+        if ds.GetRasterBand(bands[0]).GetBlockSize()[0] != ds.RasterXSize:
+            return None
+        arrays = []
+        for b in bands:
+            try:
+                # only accept a real file mapping, not GDAL's generic (block reading) implementation
+                array = ds.GetRasterBand(b).GetVirtualMemAutoArray(
+                    gdal.GF_Read, options=['USE_DEFAULT_IMPLEMENTATION=NO'])
+            except Exception:
+                return None
+            if array is None:
+                return None
+            arrays.append(array)
+        return arrays
+
+    @staticmethod
+    def _sample_arrays(arrays, px, py, radius=0, mode='median', no_data=None, dismiss=None):
+        """
+        Sample full in-memory (or memory-mapped) bands at the given pixel coordinates by plain
+        indexing
+
+        :return: Array of shape (points, bands), NaN where no valid value was found
+        """
+        rows, cols = arrays[0].shape
+        if no_data is None:
+            no_data = [None] * len(arrays)
+        values = np.full((len(px), len(arrays)), np.nan)
+        inside = np.flatnonzero((px >= 0) & (px < cols) & (py >= 0) & (py < rows))
+        if inside.size > 0:
+            values[inside] = PointSampling._window_values(arrays, py[inside], px[inside], radius,
+                                                          mode, no_data, dismiss)
+        return values
+
+    @staticmethod
+    def _valid(data, nodata=None, dismiss=None):
+        """
+        Get a mask of all values that are neither NaN, NoData nor the value to dismiss
+        """
+        valid = np.ones(data.shape, dtype=bool)
+        if data.dtype.kind == 'f':
+            valid &= ~np.isnan(data)
+        if nodata is not None:
+            valid &= data != nodata
+        if dismiss is not None:
+            valid &= data != dismiss
+        return valid
+
+    @staticmethod
+    def _window_values(block, rows, cols, radius, mode, no_data, dismiss=None):
+        """
+        Calculate the statistic within the window around each point for all bands (a sequence of
+        2D arrays) of a block. The windows of all points are gathered at once into an array of
+        shape (points, window size) per band, with pixels outside the block or without valid data
+        being masked.
+
+        :return: Array of shape (points, bands), NaN where no valid value was found
+        """
+        offsets = np.arange(-radius, radius + 1)
+        win_rows, win_cols = np.broadcast_arrays(rows[:, None, None] + offsets[None, :, None],
+                                                 cols[:, None, None] + offsets[None, None, :])
+        height, width = block[0].shape
+        inside = ((win_rows >= 0) & (win_rows < height) &
+                  (win_cols >= 0) & (win_cols < width)).reshape(len(rows), -1)
+        win_rows = np.clip(win_rows, 0, height - 1).reshape(len(rows), -1)
+        win_cols = np.clip(win_cols, 0, width - 1).reshape(len(rows), -1)
+        values = np.full((len(rows), len(block)), np.nan)
+        for b in range(len(block)):
+            windows = block[b][win_rows, win_cols]
+            valid = inside & PointSampling._valid(windows, no_data[b], dismiss)
+            values[:, b] = PointSampling.window_stats(windows, valid, mode)
+        return values
+
+    @staticmethod
+    def window_stats(windows, valid, mode):
+        """
+        Vectorized version of "calculate_stats" for many windows at once
+
+        :param windows: Array of shape (points, window size)
+        :param valid: Boolean array of the same shape, False for values to ignore
+        :param mode: One of "median", "mean", "min", "max", "majority"
+        :return: Array of shape (points, ), NaN where a window has no valid value
+        """
+        if mode == 'majority':
+            if not windows.dtype.kind in 'iu':
+                warnings.warn('Mode "majority" only works with integer values! Converting '
+                              'accordingly!')
+            windows = windows.astype(np.int64)
+            # sort every window, invalid values last, and count the runs of equal values
+            order = np.lexsort((windows, ~valid))
+            values = np.take_along_axis(windows, order, axis=1)
+            flags = np.take_along_axis(valid, order, axis=1)
+            new = np.ones(values.shape, dtype=bool)
+            new[:, 1:] = (values[:, 1:] != values[:, :-1]) | (flags[:, 1:] != flags[:, :-1])
+            starts = np.flatnonzero(new)
+            lengths = np.diff(np.append(starts, values.size))
+            lengths[~flags.ravel()[starts]] = -1
+            rows = starts // values.shape[1]
+            # longest run per window; on ties, the smallest value, like numpy.bincount(...).argmax() does
+            best = np.lexsort((-lengths, rows))
+            first = best[np.r_[True, rows[best][1:] != rows[best][:-1]]]
+            data = values.ravel()[starts[first]].astype(float)
+            data[~valid.any(axis=1)] = np.nan
+            return data
+        array = np.ma.masked_array(windows.astype(float), mask=~valid)
+        if mode == 'median':
+            data = np.ma.median(array, axis=1)
+        elif mode == 'mean':
+            data = array.mean(axis=1)
+        elif mode == 'min':
+            data = array.min(axis=1)
+        elif mode == 'max':
+            data = array.max(axis=1)
         else:
-            print('Points and raster have the same projection! No reprojection necessary!')
-            self._temp = None
-        return shape, raster
+            return np.full(len(windows), np.nan)
+        return np.ma.filled(data.astype(float), np.nan)
+
+    @staticmethod
+    def _write_fields(lyr, fids, names, values, no_data, batch=50000, random_access=False):
+        """
+        Write the sampled values of all fields in one sequential pass over the layer, committed in
+        transactions. With random_access, only the given features are fetched by FID instead,
+        which is faster for small chunks of a large layer.
+        """
+        rows = dict(zip(fids.tolist(), range(len(fids))))
+        defn = lyr.GetLayerDefn()
+        indices = [lyr.FindFieldIndex(n, 1) for n in names]
+        integer = [defn.GetFieldDefn(i).GetType() == ogr.OFTInteger for i in indices]
+        count = 0
+        lyr.ResetReading()
+        lyr.StartTransaction()
+        features = (lyr.GetFeature(int(fid)) for fid in fids) if random_access else lyr
+        for feat in features:
+            if feat is None:
+                continue
+            row = rows.get(feat.GetFID())
+            if row is None:
+                continue
+            for b, index in enumerate(indices):
+                value = values[row, b]
+                if np.isnan(value):
+                    value = no_data[b]
+                # the NoData value of the band may be NaN as well
+                if value is None or np.isnan(value):
+                    feat.UnsetField(index)
+                elif integer[b]:
+                    feat.SetField(index, int(value))
+                else:
+                    feat.SetField(index, float(value))
+            lyr.SetFeature(feat)
+            count += 1
+            if count % batch == 0:
+                lyr.CommitTransaction()
+                lyr.StartTransaction()
+        lyr.CommitTransaction()
+        return count
 
     @staticmethod
     def calculate_stats(array, mode, nodata=None):
@@ -2,19 +2,20 @@
 
 import os
 import sys
-import string
-import shutil
 import math
 import re
 import time
 import datetime
 import warnings
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
-import subprocess as sub
-from tqdm import tqdm
 from osgeo import ogr, osr, gdal, gdal_array
 from optparse import OptionParser, OptionGroup
 
+from basic_functions import journal_tools, zonal_tools
+
 
 OGR_TYPES = {int: ogr.OFTInteger,
              float: ogr.OFTReal}
@@ -32,6 +33,11 @@ class PolygonSampling(object):
         self._nodata = None
         self._names = None
         self._crs = 'raster'
+        self._strategy = 'auto'
+        self._threads = None
+        self._explain = False
+        self._chunk = 0
+        self._resume = False
         print('Running "PolygonSampling"...\n')
 
     def setup_option_parser(self):
@@ -49,8 +55,6 @@ Requirements:
 NumPy (1.10.4 +)
 
 GDAL / OGR installation with Python bindings (OSGeo 1.11.3 +)
-
-GDAL / OGR commands in PATH environment
 """, conflict_handler='resolve')
         group = OptionGroup(parser, 'Mandatory options', 'Must be defined')
         group.add_option('-i', '--image', dest='image', type='str',
@@ -70,8 +74,9 @@ GDAL / OGR commands in PATH environment
                               ' and only contain "a-z,A-Z,0-9,_". If a field already exists, its '
                               'values will be overwritten!')
         group.add_option('-c', '--crs', dest='crs', type='str', default='raster',
-                         help='Use spatial reference system from input image ("raster"; default) or'
-                              ' sampling points ("points") if internal reprojection is necessary.')
+                         help='Deprecated. The polygons are always reprojected and clipped in '
+                              'memory to the spatial reference system and extent of the input '
+                              'image.')
         group.add_option('-o', '--output', dest='output', type='str',
                          help='Output file, if desired. If not given, the new attributes will be '
                               'appended to the input dataset. The file extension needs to match the'
@@ -82,6 +87,27 @@ GDAL / OGR commands in PATH environment
                          help='Additional raster NoData value. It will be ignored for statistical '
                               'calculation in addition to the rasters internal NoData value, which '
                               'is ignored anyway.')
+        group.add_option('-s', '--strategy', dest='strategy', type='str', default='auto',
+                         help='Sampling strategy. One of "auto" (default; choose by estimated '
+                              'cost), "grid" (rasterize all polygons into one ID grid covering '
+                              'their extent; overlapping polygons are sampled separately) or '
+                              '"window" (rasterize and read each polygon\'s bounding box '
+                              'separately; for few or sparse polygons over huge rasters).')
+        group.add_option('-t', '--threads', dest='threads', type='int',
+                         help='Number of threads for the "window" strategy. Default is the number '
+                              'of CPUs.')
+        group.add_option('', '--explain', dest='explain', action='store_true', default=False,
+                         help='Only print the estimated I/O, memory and runtime of each sampling '
+                              'strategy and the chosen one, without sampling.')
+        group.add_option('', '--chunk', dest='chunk', type='int', default=0,
+                         help='Number of polygons per chunk. If given, results are committed chunk '
+                              'by chunk and the progress is recorded in a journal next to the '
+                              'output (<output>.journal), which allows to resume the run with '
+                              '--resume after a crash. Default is 0 (all polygons at once, no '
+                              'journal).')
+        group.add_option('', '--resume', dest='resume', action='store_true', default=False,
+                         help='Resume an interrupted run from its journal, skipping all polygons '
+                              'already processed. Implies --chunk 10000, if not given.')
         parser.add_option_group(group)
         return parser
 
@@ -98,7 +124,9 @@ GDAL / OGR commands in PATH environment
             raise IOError('No sampling polygons!')
         self._output = options.output
         self._overwrite = options.overwrite
-        if self._output and os.path.exists(self._output) and not self._overwrite:
+        self._resume = options.resume
+        if self._output and os.path.exists(self._output) and not self._overwrite and \
+                not self._resume:
             parser.print_help()
             raise IOError('Desired output file {f} already exists and shall not be overwritten!'
                           ''.format(f=self._output))
@@ -123,28 +151,31 @@ GDAL / OGR commands in PATH environment
         else:
             self._names = None
         self._crs = options.crs
+        if self._crs != 'raster':
+            warnings.warn('Option -c/--crs is deprecated! The polygons are always reprojected into '
+                          'the spatial reference system of the raster.')
+        self._strategy = options.strategy
+        if self._strategy not in ('auto', 'grid', 'window'):
+            parser.print_help()
+            raise IOError('Unknown sampling strategy {s}!'.format(s=self._strategy))
+        self._threads = options.threads
+        self._explain = options.explain
+        self._chunk = options.chunk
+        if self._resume and not self._chunk:
+            self._chunk = 10000
         return True
 
     def run(self):
         start = time.time()
         warnings.simplefilter('ignore', FutureWarning)
         self.check_options()
-        tmp_dir = os.path.join(os.path.dirname(self._poly), '__tmp')
-        for ti in time.localtime():
-            tmp_dir += str(ti)
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
-        print('Checking spatial references...')
-        self._poly, self._image = self._match_projection(self._poly, self._image, tmp_dir,
-                                                         match=self._crs)
-        self._poly = self._reproject_and_cut_shape(self._image, self._poly, tmp_dir)
-        cols, rows, bandnum, _dtype, _proj, geotrans = self.get_raster_properties(self._image)
+        print('Reprojecting and clipping polygons...')
+        mem_ds, mem_lyr = self._load_polygons(self._poly, self._image)
         ds_img = gdal.Open(self._image, gdal.GA_ReadOnly)
         # get band count and band names
         if not self._bands:
-            self._bands = [b for b in range(1, bandnum + 1)]
+            self._bands = [b for b in range(1, ds_img.RasterCount + 1)]
+        self._bands = [int(b) for b in self._bands]
         if not self._names:
             self._names = [bn.split('=')[1] for bn in ds_img.GetMetadata_List() if
                            bn.startswith('Band') and int(bn.split('=')[0].split('_')[1]) in
@@ -153,8 +184,38 @@ GDAL / OGR commands in PATH environment
                            re.sub(r'[^a-zA-Z0-9_]', r'', n)[:10] for n in self._names]
             if not self._names:
                 self._names = ['band_{b}'.format(b=bn) for bn in self._bands]
+        # choose the sampling strategy
+        fids, windows, wkbs = self._polygon_windows(mem_lyr, ds_img)
+        threads = self._threads if self._threads else multiprocessing.cpu_count()
+        strategy, estimates = zonal_tools.plan_strategy(ds_img, windows, len(self._bands), threads)
+        if self._strategy != 'auto':
+            strategy = self._strategy
+        if self._explain:
+            zonal_tools.print_estimates(estimates, strategy)
+            mem_lyr = None
+            mem_ds = None
+            ds_img = None
+            return True
+        # check for a journal of an interrupted run
+        input_polys = self._output if self._output else self._poly
+        journal = input_polys + '.journal'
+        done = []
+        if self._resume and os.path.exists(journal):
+            content = journal_tools.read_journal(journal)
+            if content['image'] != os.path.abspath(self._image) or \
+                    content['fields'] != self._names or content['mode'] != self._mode:
+                raise IOError('Journal {j} belongs to a different run! Remove it to start over.'
+                              ''.format(j=journal))
+            done = content['done']
+            print('Resuming from {j}...'.format(j=journal))
+        elif os.path.exists(journal):
+            os.remove(journal)
+        resume = bool(done)
+        if self._output and not resume and os.path.exists(self._output) and not self._overwrite:
+            raise IOError('Nothing to resume and desired output file {f} already exists!'.format(
+                f=self._output))
         # open vector file
-        if self._output:
+        if self._output and not resume:
             print('Creating new output file...')
             ds = ogr.Open(self._poly)
             drv = ds.GetDriver()
@@ -162,95 +223,78 @@ GDAL / OGR commands in PATH environment
                 drv.DeleteDataSource(self._output)
             drv.CopyDataSource(ds, self._output)
             ds = None
-            input_polys = self._output
-        else:
-            input_polys = self._poly
         ds_polys = ogr.Open(input_polys, 1)
         lyr = ds_polys.GetLayer()
         lyr_defn = lyr.GetLayerDefn()
-        crs = lyr.GetSpatialRef()
         # check if new attribute names already exist
         fields = [lyr_defn.GetFieldDefn(f).name for f in range(lyr_defn.GetFieldCount())]
         for n in self._names:
-            if n in fields:
+            if n in fields and not resume:
                 warnings.warn('Field {f} already exists! Values will be overwritten!'.format(f=n))
-                lyr.DeleteField(fields.index(n))
-        # loop over each band
-        print('')
+                lyr.DeleteField(lyr.FindFieldIndex(n, 1))
+        # create all fields at once
         for b, bandnum in enumerate(self._bands):
-            print('Working on band {b} of {n}...'.format(b=b+1, n=len(self._bands)))
-            band = ds_img.GetRasterBand(int(bandnum))
-            no_data = band.GetNoDataValue()
+            if resume and self._names[b] in fields:
+                continue
+            band = ds_img.GetRasterBand(bandnum)
             dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
-            # create field
-            if not self._mode == 'majority':
-                field = ogr.FieldDefn(self._names[b], OGR_TYPES[type(dtype(0).item())])
-                field.SetWidth(20)
-                field.SetPrecision(8)
-            else:
+            if self._mode == 'majority':
                 field = ogr.FieldDefn(self._names[b], ogr.OFTInteger)
                 field.SetWidth(10)
-            lyr.CreateField(field)
-            # loop features
-            start = time.time()
-            # for f in xrange(len(lyr)):
-            for f in tqdm(xrange(len(lyr)), mininterval=1, maxinterval=1, smoothing=0.5,
-                          desc='Progress: '):
-                tmp_shp = os.path.join(tmp_dir, '__tmp.shp')
-                tmp_tif = os.path.join(tmp_dir, '__tmp.tif')
-                drv = ogr.GetDriverByName('ESRI Shapefile')
-                tmp_ds = drv.CreateDataSource(tmp_shp)
-                tmp_lyr = tmp_ds.CreateLayer('tmp', crs, ogr.wkbPolygon)
-                tmp_lyr.CreateFeature(lyr.GetFeature(f))
-                tmp_lyr = None
-                tmp_ds.Destroy()
-                self._rasterize_polygon(tmp_shp, self._image, tmp_tif)
-                tmp_ulx, tmp_lrx, tmp_lry, tmp_uly = self.get_raster_extent(tmp_tif)
-                tmp_ds = gdal.Open(tmp_tif, gdal.GA_ReadOnly)
-                poly_mask = tmp_ds.GetRasterBand(1).ReadAsArray()
-                tmp_ds = None
-                window_index_ulx, window_index_uly = self.geo_to_pixel_coords(tmp_ulx, tmp_uly,
-                                                                              geotrans, cols, rows)
-                window_index_lrx, window_index_lry = self.geo_to_pixel_coords(tmp_lrx, tmp_lry,
-                                                                              geotrans, cols, rows)
-                window_cols = window_index_lrx - window_index_ulx
-                window_rows = window_index_lry - window_index_uly
-                window = band.ReadAsArray(window_index_ulx, window_index_lry, window_cols,
-                                          window_rows)
-                window = window[np.equal(poly_mask, 1)]
-                window = np.ma.masked_equal(window, no_data)
-                window = np.ma.masked_equal(window, self._nodata)
-                # calculate statistic
-                data = self.calculate_stats(window, self._mode, no_data)
-                if data == no_data:
-                    data = None
-                elif not data:
-                    data = None
-                # set attribute
-                feat = lyr.GetFeature(f)
-                if data:
-                    if type(dtype(0).item()) == float:
-                        try:
-                            feat.SetField(self._names[b], float(round(data, 8)))
-                        except:
-                            pass
-                    elif type(dtype(0).item()) == int:
-                        feat.SetField(self._names[b], int(data))
-                    else:
-                        print self._names[b], data
-                        raise ValueError('Should not happen!')
+            else:
+                if self._mode in ('mean', 'stdv'):
+                    field = ogr.FieldDefn(self._names[b], ogr.OFTReal)
                 else:
-                    feat.SetField(self._names[b], data)
-                lyr.SetFeature(feat)
-                feat.Destroy()
-                self.delete_ds(tmp_shp)
-                os.remove(tmp_tif)
+                    field = ogr.FieldDefn(self._names[b], OGR_TYPES[type(dtype(0).item())])
+                field.SetWidth(20)
+                field.SetPrecision(8)
+            lyr.CreateField(field)
             band = None
+        mem_lyr = None
+        mem_ds = None
+        if self._mode == 'majority' and any(
+                np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(
+                    ds_img.GetRasterBand(b).DataType)).kind not in 'iu' for b in self._bands):
+            warnings.warn('Mode "majority" only works with integer values! Converting '
+                          'accordingly!')
+        # process the polygons in (spatially sorted) chunks, each one committed and journaled
+        chunk = self._chunk if self._chunk else max(len(fids), 1)
+        todo = ~journal_tools.in_ranges(fids, done)
+        print('Sampling {n} polygons ({s} strategy)...'.format(n=int(todo.sum()), s=strategy))
+        for first in range(0, len(fids), chunk):
+            chunk_idx = np.flatnonzero(todo[first:first + chunk]) + first
+            if chunk_idx.size == 0:
+                continue
+            chunk_wkbs = [wkbs[i] for i in chunk_idx]
+            if strategy == 'window':
+                values = self._sample_windows(self._image, self._bands, windows[chunk_idx],
+                                              chunk_wkbs, self._mode, self._nodata, threads)
+            else:
+                ids, xoff, yoff, overlapping = zonal_tools.rasterize_zones(
+                    ds_img, windows[chunk_idx], chunk_wkbs)
+                values = self._sample_id_grid(ds_img, self._bands, ids, xoff, yoff,
+                                              len(chunk_idx), self._mode, self._nodata)
+                # the ID grid holds only one of overlapping polygons per pixel
+                separate = np.flatnonzero(overlapping)
+                if separate.size:
+                    values[separate] = self._sample_windows(
+                        self._image, self._bands, windows[chunk_idx[separate]],
+                        [chunk_wkbs[i] for i in separate], self._mode, self._nodata, threads)
+            self._write_fields(lyr, fids[chunk_idx], self._names, values,
+                               random_access=bool(self._chunk))
+            if self._chunk:
+                journal_tools.sync_layer(lyr)
+                done += journal_tools.fid_ranges(fids[chunk_idx])
+                journal_tools.write_journal(journal, {'image': os.path.abspath(self._image),
+                                                      'fields': self._names, 'mode': self._mode,
+                                                      'done': done})
+                print('{n} of {t} polygons done'.format(n=min(first + chunk, len(fids)),
+                                                        t=len(fids)))
         lyr = None
         ds_polys.Destroy()
         ds_img = None
-        self.delete_ds(self._poly)
-        shutil.rmtree(tmp_dir)
+        if os.path.exists(journal):
+            os.remove(journal)
         print('\nDuration (hh:mm:ss): \t {dur}'.format(dur=datetime.timedelta(seconds=time.time()
                                                                                       - start)))
         return True
@@ -258,105 +302,236 @@ GDAL / OGR commands in PATH environment
     # ----------------------------------------------------------------------- #
     # HELPER FUNCTIONS
     @staticmethod
-    def run_cmd(command):
-        p = sub.Popen(command, stdout=sub.PIPE, stderr=sub.PIPE)
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            print string.join(command)
-            print stdout
-            print stderr
-            sys.exit(1)
-        return True
-
-    @staticmethod
-    def delete_ds(ds_name):
-        ds = ogr.Open(ds_name)
-        drv = ds.GetDriver()
-        ds.Destroy()
-        drv.DeleteDataSource(ds_name)
-        return True
+    def _load_polygons(shape, raster):
+        """
+        Load the polygons into an in-memory layer, reprojected into the spatial reference system of
+        the raster and clipped to its extent. The FIDs of the input features are kept, polygons
+        outside the raster are dropped.
 
-    def _match_projection(self, shape, raster, outputdir, match='raster'):
-        ds = gdal.Open(raster)
-        wkt = ds.GetProjection()
-        srs_raster = osr.SpatialReference(wkt=wkt)
-        srs_raster.AutoIdentifyEPSG()
-        epsg_raster = int(srs_raster.GetAttrValue('AUTHORITY', 1))
+        :param shape: Input polygons
+        :param raster: Reference raster
+        :return: In-memory data source and layer
+        """
+        ds = gdal.Open(raster, gdal.GA_ReadOnly)
+        srs_raster = osr.SpatialReference(wkt=ds.GetProjection())
         ds = None
+        xmin, xmax, ymin, ymax = PolygonSampling.get_raster_extent(raster)
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in ((xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin), (xmin, ymax)):
+            ring.AddPoint_2D(x, y)
+        extent = ogr.Geometry(ogr.wkbPolygon)
+        extent.AddGeometry(ring)
         ds = ogr.Open(shape)
-        srs_shape = ds.GetLayer().GetSpatialRef()
-        srs_shape.AutoIdentifyEPSG()
-        epsg_shape = int(srs_shape.GetAttrValue('AUTHORITY', 1))
-        ds.Destroy()
-        ulx, lrx, lry, uly = self.get_raster_extent(raster)
-        if epsg_raster != epsg_shape:
-            if match == 'raster':
-                print('Reprojecting shape to EPSG:{0}'.format(epsg_raster))
-                proj_shape = os.path.join(outputdir, os.path.splitext(os.path.basename(shape))[0]
-                                          + '_projected.shp')
-                if os.path.exists(proj_shape):
-                    self.delete_ds(proj_shape)
-                warnings.warn('Need to reproject polygons! New output dataset will be {ds}'.format(
-                    ds=proj_shape))
-                cmd = ['ogr2ogr', '-overwrite', '-f', 'ESRI Shapefile', '-t_srs', 'EPSG:{e}'.format(
-                    e=epsg_raster),
-                       '-clipdst', ulx, lry, lrx, uly, proj_shape, shape]
-                self.run_cmd([str(i) for i in cmd])
-                return proj_shape, raster
-            else:
-                print('Reprojecting raster to EPSG:{0}'.format(epsg_shape))
-                temp_raster = os.path.join(outputdir, os.path.splitext(os.path.basename(raster)[0]
-                                                                       + '_projected.tif'))
-                cmd = 'gdalwarp -of GTiff -overwrite -te_srs EPSG:{e} {r} {t}'.format(
-                    e=epsg_shape, r=raster, t=temp_raster)
-                self.run_cmd(cmd)
-                return shape, temp_raster
-        else:
-            print('Polygons and raster have the same projection! No reprojection necessary!')
-        return shape, raster
-
-    def _reproject_and_cut_shape(self, raster, shape, outputdir):
-        out_shape = os.path.join(outputdir, 'temp_utm.shp')
-        if os.path.exists(out_shape):
-            self.delete_ds(out_shape)
-        # read raster information
-        _c, _r, _b, _d, proj, _g = self.get_raster_properties(raster)
-        ulx, lrx, lry, uly = self.get_raster_extent(raster)
-        ds = ogr.Open(shape)
-        proj_shape = ds.GetLayer().GetSpatialRef()
-        ds.Destroy()
-        proj_shape = str(proj_shape).replace('\n', '').replace(' ', '')
-        sr_raster = osr.SpatialReference()
-        sr_shape = osr.SpatialReference()
-        sr_raster.ImportFromWkt(proj)
-        sr_shape.ImportFromWkt(proj_shape)
-        sr_raster.AutoIdentifyEPSG()
-        sr_shape.AutoIdentifyEPSG()
-        epsg_raster = int(sr_raster.GetAttrValue('AUTHORITY', 1))
-        epsg_shape = int(sr_shape.GetAttrValue('AUTHORITY', 1))
-        cmd = ['ogr2ogr', '-s_srs', 'EPSG:{es}'.format(es=epsg_shape), '-t_srs', 'EPSG:{er}'.format(
-            er=epsg_raster),
-               '-f', 'ESRI Shapefile', '-skipfailures', '-clipdst', str(ulx), str(lry), str(lrx),
-               str(uly), out_shape, shape]
-        self.run_cmd(cmd)
-        return out_shape
-
-    def _rasterize_polygon(self, polygon, refraster, outraster, outformat='GTiff'):
-        ds = gdal.Open(refraster, gdal.GA_ReadOnly)
-        geotrans = ds.GetGeoTransform()
-        drv = ds.GetDriver()
-        ds = None
-        if os.path.exists(outraster):
-            drv.DeleteDataSource()
-        ds = ogr.Open(polygon)
         lyr = ds.GetLayer()
-        ulx, lrx, uly, lry = lyr.GetExtent()
-        xres, yres = geotrans[1], abs(geotrans[5])
-        lyrname = os.path.splitext(os.path.basename(polygon))[0]
-        cmd = ['gdal_rasterize', '-burn', '1', '-of', outformat, '-te', ulx, uly, lrx, lry, '-tr',
-               xres, yres, '-ot', 'Byte', '-l', lyrname, polygon, outraster]
-        self.run_cmd([str(i) for i in cmd])
-        return True
+        srs_shape = lyr.GetSpatialRef()
+        transform = None
+        if srs_shape is not None and srs_raster.ExportToWkt() and not srs_shape.IsSame(srs_raster):
+            for srs in (srs_shape, srs_raster):
+                if hasattr(srs, 'SetAxisMappingStrategy'):
+                    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            transform = osr.CoordinateTransformation(srs_shape, srs_raster)
+        defn = lyr.GetLayerDefn()
+        lyr.SetIgnoredFields([defn.GetFieldDefn(f).GetName() for f in
+                              range(defn.GetFieldCount())] + ['OGR_STYLE'])
+        mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('polygons')
+        mem_lyr = mem_ds.CreateLayer('polygons', srs_raster, lyr.GetGeomType())
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            if geom is None:
+                continue
+            geom = geom.Clone()
+            if transform is not None:
+                geom.Transform(transform)
+            if not geom.Intersects(extent):
+                continue
+            if not geom.Within(extent):
+                geom = geom.Intersection(extent)
+                if geom is None or geom.IsEmpty():
+                    continue
+            out = ogr.Feature(mem_lyr.GetLayerDefn())
+            out.SetFID(feat.GetFID())
+            out.SetGeometry(geom)
+            mem_lyr.CreateFeature(out)
+            out = None
+        lyr = None
+        ds = None
+        return mem_ds, mem_lyr
+
+    @staticmethod
+    def _sample_id_grid(ds_img, bands, ids, xoff, yoff, count, mode, nodata=None):
+        """
+        Calculate the statistic of all polygons in all bands in one grouped pass per band
+
+        :param ids: ID grid (0 being background)
+        :param xoff: Column offset of the ID grid within the image
+        :param yoff: Row offset of the ID grid within the image
+        :param count: Number of polygons (highest ID)
+        :param nodata: Additional NoData value to ignore
+        :return: Array of shape (polygons, bands), NaN where a polygon has no valid pixel
+        """
+        values = np.full((count, len(bands)), np.nan)
+        zones = ids.ravel()
+        inside = zones > 0
+        zones = zones[inside]
+        if zones.size == 0:
+            return values
+        for b, bandnum in enumerate(bands):
+            band = ds_img.GetRasterBand(bandnum)
+            data = band.ReadAsArray(xoff, yoff, ids.shape[1], ids.shape[0]).ravel()[inside]
+            valid = PolygonSampling._valid(data, band.GetNoDataValue(), nodata)
+            values[:, b] = zonal_tools.grouped_statistics(zones[valid] - 1, data[valid], count,
+                                                          mode)
+            band = None
+        return values
+
+    @staticmethod
+    def _polygon_windows(lyr, ds_img):
+        """
+        Get the pixel window (bounding box) of each polygon within the image, in spatially sorted
+        order (by the image block of the window's upper left corner)
+
+        :param lyr: Polygon layer in the spatial reference system of the image
+        :param ds_img: Image data source
+        :return: FIDs, windows as array of shape (polygons, 4) with (xoff, yoff, cols, rows) and
+            geometries as WKB
+        """
+        geotrans = ds_img.GetGeoTransform()
+        fids = []
+        envelopes = []
+        wkbs = []
+        lyr.ResetReading()
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            fids.append(feat.GetFID())
+            envelopes.append(geom.GetEnvelope())
+            wkbs.append(geom.ExportToWkb())
+        lyr.ResetReading()
+        fids = np.array(fids, dtype=np.int64)
+        envelopes = np.array(envelopes, dtype=float).reshape(-1, 4)
+        windows = zonal_tools.pixel_windows(envelopes, geotrans, ds_img.RasterXSize,
+                                            ds_img.RasterYSize)
+        block_x, block_y = ds_img.GetRasterBand(1).GetBlockSize()
+        order = np.lexsort((windows[:, 0] // block_x, windows[:, 1] // block_y))
+        return fids[order], windows[order], [wkbs[i] for i in order]
+
+    @staticmethod
+    def _sample_windows(image, bands, windows, wkbs, mode, nodata=None, threads=None):
+        """
+        Sample each polygon separately within its own window: the polygon is rasterized into a
+        small MEM dataset covering its bounding box, and the window is read for all bands at
+        once. Polygons are processed in the given (spatially sorted) order by a pool of threads,
+        each working on contiguous chunks with its own image handle, to keep the GDAL block cache
+        hit rate high.
+
+        :param image: Input image
+        :param windows: Pixel windows (xoff, yoff, cols, rows) of the polygons
+        :param wkbs: Polygon geometries as WKB, in the spatial reference system of the image
+        :param nodata: Additional NoData value to ignore
+        :param threads: Number of threads. Default is the number of CPUs.
+        :return: Array of shape (polygons, bands), NaN where a polygon has no valid pixel
+        """
+        local = threading.local()
+
+        def sample(p):
+            if not hasattr(local, 'ds'):
+                local.ds = gdal.Open(image, gdal.GA_ReadOnly)
+            return PolygonSampling._sample_window(local.ds, bands, windows[p], wkbs[p], mode,
+                                                  nodata)
+
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        values = np.full((len(windows), len(bands)), np.nan)
+        if len(windows) == 0:
+            return values
+        chunk_size = max(1, min(256, len(windows) // (threads * 4)))
+        pool = ThreadPool(threads)
+        for p, result in enumerate(pool.imap(sample, range(len(windows)), chunk_size)):
+            values[p] = result
+        pool.close()
+        pool.join()
+        return values
+
+    @staticmethod
+    def _sample_window(ds_img, bands, window, wkb, mode, nodata=None):
+        """
+        Sample all bands within a single polygon
+
+        :return: Array of shape (bands, ), NaN where the polygon has no valid pixel
+        """
+        xoff, yoff, cols, rows = [int(w) for w in window]
+        mask = zonal_tools.rasterize_window(ds_img, window, [wkb]) == 1
+        values = np.full(len(bands), np.nan)
+        if not mask.any():
+            return values
+        # read the window of all bands at once
+        if list(bands) == list(range(1, ds_img.RasterCount + 1)):
+            data = ds_img.ReadAsArray(xoff, yoff, cols, rows)
+        else:
+            try:
+                data = ds_img.ReadAsArray(xoff, yoff, cols, rows, band_list=list(bands))
+            except TypeError:
+                # older GDAL versions cannot read a subset of bands at once
+                data = np.stack([ds_img.GetRasterBand(b).ReadAsArray(xoff, yoff, cols, rows)
+                                 for b in bands])
+        data = data.reshape(len(bands), rows, cols)
+        zones = np.zeros(int(mask.sum()), dtype=np.int64)
+        for b, bandnum in enumerate(bands):
+            band_data = data[b][mask]
+            no_data = ds_img.GetRasterBand(bandnum).GetNoDataValue()
+            valid = PolygonSampling._valid(band_data, no_data, nodata)
+            values[b] = zonal_tools.grouped_statistics(zones[valid], band_data[valid], 1, mode)[0]
+        return values
+
+    @staticmethod
+    def _valid(data, nodata=None, dismiss=None):
+        """
+        Get a mask of all values that are neither NaN, NoData nor the additional value to ignore
+        """
+        valid = np.ones(data.shape, dtype=bool)
+        if data.dtype.kind == 'f':
+            valid &= ~np.isnan(data)
+        if nodata is not None:
+            valid &= data != nodata
+        if dismiss is not None:
+            valid &= data != dismiss
+        return valid
+
+    @staticmethod
+    def _write_fields(lyr, fids, names, values, batch=50000, random_access=False):
+        """
+        Write the sampled values of all fields in one sequential pass over the layer, committed in
+        transactions. With random_access, only the given features are fetched by FID instead,
+        which is faster for small chunks of a large layer.
+        """
+        rows = dict(zip(fids.tolist(), range(len(fids))))
+        defn = lyr.GetLayerDefn()
+        indices = [lyr.FindFieldIndex(n, 1) for n in names]
+        integer = [defn.GetFieldDefn(i).GetType() == ogr.OFTInteger for i in indices]
+        count = 0
+        lyr.ResetReading()
+        lyr.StartTransaction()
+        features = (lyr.GetFeature(int(fid)) for fid in fids) if random_access else lyr
+        for feat in features:
+            if feat is None:
+                continue
+            row = rows.get(feat.GetFID())
+            if row is None:
+                continue
+            for b, index in enumerate(indices):
+                value = values[row, b]
+                if np.isnan(value):
+                    feat.UnsetField(index)
+                elif integer[b]:
+                    feat.SetField(index, int(value))
+                else:
+                    feat.SetField(index, float(round(value, 8)))
+            lyr.SetFeature(feat)
+            count += 1
+            if count % batch == 0:
+                lyr.CommitTransaction()
+                lyr.StartTransaction()
+        lyr.CommitTransaction()
+        return count
 
     @staticmethod
     def get_raster_properties(raster):